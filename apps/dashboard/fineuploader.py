@@ -6,8 +6,27 @@ from io import StringIO
 from os.path import join
 
 from django.conf import settings
+from django.core.cache import cache
+from django.core.files import File
 
 import apps.utils.mixins
+from apps.files.helpers import get_hasher, rm_file
+
+# fixed buffer used when streaming chunks into the final file
+COMBINE_BUFFER_SIZE = 1024 * 1024
+
+# state of uploads combined in the background, polled by the client
+UPLOAD_STATUS_KEY = "upload_status:{}"
+UPLOAD_STATUS_TIMEOUT = 60 * 60
+
+
+class ChunksError(Exception):
+    """Uploaded chunks are missing or don't add up to the uploaded file"""
+
+
+def algorithm_name(hasher):
+    """Name of a hash object's algorithm, as clients look it up (md5, xxh3_128)"""
+    return getattr(hasher, "name", type(hasher).__name__).lower()
 
 
 def strip_delimiters(input_string):
@@ -57,6 +76,24 @@ class BaseFineUploader(object):
         file_storage = apps.utils.mixins.import_class(self.storage_class)
         return file_storage()
 
+    def set_status(self, state, **kwargs):
+        cache.set(UPLOAD_STATUS_KEY.format(self.uuid), {"state": state, **kwargs}, UPLOAD_STATUS_TIMEOUT)
+
+    def get_status(self):
+        return cache.get(UPLOAD_STATUS_KEY.format(self.uuid))
+
+    def create_media(self, user):
+        """Create a Media from the uploaded file and remove the upload"""
+
+        from apps.files.models import Media
+
+        media_file = join(settings.MEDIA_ROOT, self.real_path)
+        with open(media_file, "rb") as f:
+            media = Media.objects.create(media_file=File(f), user=user)
+        rm_file(media_file)
+        shutil.rmtree(join(settings.MEDIA_ROOT, self.file_path))
+        return media
+
     @property
     def url(self):
         if not self.finished:
@@ -78,6 +115,8 @@ class ChunkedFineUploader(BaseFineUploader):
             # something nasty client side could be happening here
             qqpartindex = 0
         self.part_index = qqpartindex
+        self.checksum = None
+        self.checksum_algorithm = None
 
     @property
     def chunks_path(self):
@@ -99,15 +138,49 @@ class ChunkedFineUploader(BaseFineUploader):
     def is_time_to_combine_chunks(self):
         return self.total_parts - 1 == self.part_index
 
+    def _chunk_files(self):
+        """Return the part names, checking that all parts are there
+        and, when the client sent it, that they add up to qqtotalfilesize
+        """
+
+        parts = [join(self.chunks_path, str(i)) for i in range(self.total_parts)]
+        total_size = 0
+        for part in parts:
+            if not self.storage.exists(part):
+                raise ChunksError(f"missing part {part}")
+            size = self.storage.size(part)
+            if not size:
+                raise ChunksError(f"empty part {part}")
+            total_size += size
+
+        expected_size = self.data.get("qqtotalfilesize")
+        if isinstance(expected_size, int) and expected_size != total_size:
+            raise ChunksError(f"parts add up to {total_size} bytes, expected {expected_size}")
+        return parts
+
     def combine_chunks(self):
-        # implement the same behaviour.
+        """Concatenate the uploaded parts into the final file
+
+        Parts are streamed through a fixed size buffer, so memory use does not
+        depend on the chunk size. The checksum is computed during the copy and
+        kept on self.checksum
+        """
+
+        parts = self._chunk_files()
         self.real_path = self.storage.save(self._full_file_path, StringIO())
+        hasher = get_hasher()
 
+        buffer = bytearray(COMBINE_BUFFER_SIZE)
+        view = memoryview(buffer)
         with self.storage.open(self.real_path, "wb") as final_file:
-            for i in range(self.total_parts):
-                part = join(self.chunks_path, str(i))
+            for part in parts:
                 with self.storage.open(part, "rb") as source:
-                    final_file.write(source.read())
+                    for size in iter(lambda: source.readinto(buffer), 0):
+                        hasher.update(view[:size])
+                        final_file.write(view[:size])
+
+        self.checksum = hasher.hexdigest()
+        self.checksum_algorithm = algorithm_name(hasher)
         shutil.rmtree(self._abs_chunks_path)
 
     def _save_chunk(self):
@@ -121,5 +194,10 @@ class ChunkedFineUploader(BaseFineUploader):
                 return self.real_path
             return chunk
         else:
+            hasher = get_hasher()
+            for chunk in self.file.chunks():
+                hasher.update(chunk)
+            self.checksum = hasher.hexdigest()
+            self.checksum_algorithm = algorithm_name(hasher)
             self.real_path = self.storage.save(self._full_file_path, self.file)
             return self.real_path
@@ -162,3 +162,30 @@ def schedule_validation_jobs():
         except Exception as e:
             logger.error(f"Task failed: {e}")
             self.retry(countdown=60, exc=e)
+
+
+@shared_task(queue="long_tasks")
+def combine_upload_chunks(data, user_id):
+    """Combine the chunks of a finished upload and create its Media,
+    the client polls the upload status meanwhile
+    """
+
+    from django.conf import settings
+    from django.contrib.auth import get_user_model
+
+    from .fineuploader import ChunkedFineUploader, ChunksError
+
+    upload = ChunkedFineUploader(data, settings.CONCURRENT_UPLOADS)
+    upload.set_status("combining")
+    try:
+        upload.combine_chunks()
+        media = upload.create_media(get_user_model().objects.get(id=user_id))
+    except (OSError, ChunksError) as e:
+        upload.set_status("failed", error="Error with File Uploading")
+        return str(e)
+    except Exception:
+        # eg a database error creating the media, the client stops polling
+        upload.set_status("failed", error="Error with File Uploading")
+        raise
+    upload.set_status("done", media_url=media.get_absolute_url(), checksum=upload.checksum, checksum_algorithm=upload.checksum_algorithm)
+    return media.friendly_token
@@ -10,6 +10,9 @@ from .views import (
     CreateVidraJobApi,
     ListVidraJobs,
     FineUploaderView,
+    FineUploaderStatusView,
+    FineUploaderApiView,
+    FineUploaderStatusApiView,
     doc_view,
     wunderbaum_tree,
 )
@@ -19,6 +22,9 @@ app_name = "dashboard"
 urlpatterns = [
     path('', vod_ingest_list, name='mediahub_list'),
     path("upload/", FineUploaderView.as_view(), name="upload"),
+    path("upload/status/<str:uuid>/", FineUploaderStatusView.as_view(), name="upload_status"),
+    path("api/upload/", FineUploaderApiView.as_view(), name="upload_api"),
+    path("api/upload/status/<str:uuid>/", FineUploaderStatusApiView.as_view(), name="upload_status_api"),
     path('api/files/root/', get_root_nodes, name='root_nodes'),
     path('api/files/children/<path:parent_path>/', get_child_nodes, name='child_nodes'),
     path("vidra/tasks/", ListVidraJobs.as_view(), name="tasks_list"),  # UI list
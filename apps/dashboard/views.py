@@ -2,29 +2,27 @@ import datetime
 import glob
 import structlog as logging
 import os
-import shutil
 from pathlib import Path
 
 import markdown
 from celery import Celery
 from django.conf import settings
 from django.core.exceptions import PermissionDenied
-from django.core.files import File
 from django.http import JsonResponse
 from django.shortcuts import render
+from django.urls import reverse
 from django.views import generic
 from django.views.generic import TemplateView
 from rest_framework import status
+from rest_framework.authentication import TokenAuthentication
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
 from vidra_kit.backends.api import fetch_rabbitmq_queues, RabbitMQMonitor
 from ..dashboard.models import FileEntry
 from ..dashboard.serializers import JobSerializer
-from ..files.helpers import rm_file
 from ..files.methods import user_allowed_to_upload
-from ..files.models import Media
-from .fineuploader import ChunkedFineUploader
+from .fineuploader import ChunkedFineUploader, ChunksError
 from .forms import FineUploaderUploadForm, FineUploaderUploadSuccessForm
 from ..utils.mixins import PageTitleMixin
 
@@ -333,9 +331,17 @@ class FineUploaderView(generic.FormView):
     def form_valid(self, form):
         self.upload = ChunkedFineUploader(form.cleaned_data, self.concurrent)
         if self.upload.concurrent and self.chunks_done:
+            if settings.UPLOAD_COMBINE_IN_BACKGROUND:
+                from .tasks import combine_upload_chunks
+
+                self.upload.set_status("pending")
+                combine_upload_chunks.delay(form.cleaned_data, self.request.user.id)
+                status_url = reverse("dashboard:upload_status", kwargs={"uuid": self.upload.uuid})
+                return self.make_response({"success": True, "status_url": status_url}, status=202)
             try:
                 self.upload.combine_chunks()
-            except FileNotFoundError:
+            except (FileNotFoundError, ChunksError) as e:
+                logger.info("could not combine chunks", uuid=self.upload.uuid, error=str(e))
                 data = {"success": False, "error": "Error with File Uploading"}
                 return self.make_response(data, status=400)
         elif self.upload.total_parts == 1:
@@ -344,14 +350,42 @@ class FineUploaderView(generic.FormView):
             self.upload.save()
             return self.make_response({"success": True})
         # create media!
-        media_file = os.path.join(settings.MEDIA_ROOT, self.upload.real_path)
-        with open(media_file, "rb") as f:
-            myfile = File(f)
-            new = Media.objects.create(media_file=myfile, user=self.request.user)
-        rm_file(media_file)
-        shutil.rmtree(os.path.join(settings.MEDIA_ROOT, self.upload.file_path))
-        return self.make_response({"success": True, "media_url": new.get_absolute_url()})
+        new = self.upload.create_media(self.request.user)
+        return self.make_response({"success": True, "media_url": new.get_absolute_url(), "checksum": self.upload.checksum, "checksum_algorithm": self.upload.checksum_algorithm})
 
     def form_invalid(self, form):
         data = {"success": False, "error": "%s" % repr(form.errors)}
         return self.make_response(data, status=400)
+
+
+class FineUploaderStatusView(generic.View):
+    """Polled by the client while an upload is combined in the background"""
+
+    http_method_names = ("get",)
+
+    def get(self, request, uuid):
+        if not user_allowed_to_upload(request):
+            raise PermissionDenied
+        status = ChunkedFineUploader({"qquuid": uuid, "qqfilename": ""}).get_status()
+        if status is None:
+            return JsonResponse({"success": False, "error": "Unknown upload"}, status=404)
+        return JsonResponse({"success": status["state"] != "failed", **status})
+
+
+class FineUploaderApiView(APIView):
+    """Token authenticated entry to the chunked upload, for API clients
+    as the cli tool. Requests are handled by FineUploaderView
+    """
+
+    authentication_classes = (TokenAuthentication,)
+    upload_view = staticmethod(FineUploaderView.as_view())
+
+    def post(self, request, *args, **kwargs):
+        return self.upload_view(request._request, *args, **kwargs)
+
+
+class FineUploaderStatusApiView(FineUploaderApiView):
+    upload_view = staticmethod(FineUploaderStatusView.as_view())
+
+    def get(self, request, *args, **kwargs):
+        return self.upload_view(request._request, *args, **kwargs)
@@ -1,8 +1,9 @@
 # ffmpeg only backend
 
+import collections
 import locale
 import structlog as logging
-import re
+import threading
 from subprocess import PIPE, Popen
 
 logger = logging.getLogger(__name__)
@@ -14,9 +15,12 @@ class VideoEncodingError(Exception):
         super(VideoEncodingError, self).__init__(*args, **kwargs)
 
 
-RE_TIMECODE = re.compile(r"time=(\d+:\d+:\d+.\d+)")
 console_encoding = locale.getlocale()[1] or "UTF-8"
 
+# how much of ffmpeg's stderr is kept for logs/errors
+OUTPUT_TAIL_SIZE = 1000
+STDERR_READ_SIZE = 4096
+
 
 class FFmpegBackend(object):
     name = "FFmpeg"
@@ -39,39 +43,51 @@ class FFmpegBackend(object):
 
     def _check_returncode(self, process):
         ret = {}
-        stdout, stderr = process.communicate()
+        process.wait()
         ret["code"] = process.returncode
         return ret
 
+    def _drain_stderr(self, process, tail):
+        # keep reading stderr so ffmpeg never blocks on a full pipe,
+        # only the last reads are kept
+        for out in iter(lambda: process.stderr.read(STDERR_READ_SIZE), b""):
+            tail.append(out.decode(console_encoding, errors="replace"))
+
     def encode(self, cmd):
+        """Run an ffmpeg command, reading its -progress output
+
+        Yields the encoded time in seconds (float) each time ffmpeg reports
+        progress, and finally the tail of ffmpeg's output (str)
+        """
+
+        # structured key=value progress blocks on stdout instead of
+        # parsing the \r separated stats lines on stderr
+        cmd = [cmd[0], "-progress", "pipe:1", "-nostats", *cmd[1:]]
         process = self._spawn(cmd)
-        buf = output = ""
-        while True:
-            out = process.stderr.read(10)
-
-            if not out:
-                break
-            try:
-                out = out.decode(console_encoding)
-            except UnicodeDecodeError:
-                out = ""
-            output = output[-500:] + out
-            buf = buf[-500:] + out
-            try:
-                line, buf = buf.split("\r", 1)
-            except BaseException:
-                continue
-
-            progress = RE_TIMECODE.findall(line)
-            if progress:
-                progress = progress[0]
-            yield progress
+
+        # two full reads always hold at least OUTPUT_TAIL_SIZE chars
+        tail = collections.deque(maxlen=2)
+        stderr_reader = threading.Thread(target=self._drain_stderr, args=(process, tail), daemon=True)
+        stderr_reader.start()
+
+        out_time = None
+        for line in process.stdout:
+            key, _, value = line.decode(console_encoding, errors="replace").strip().partition("=")
+            if key == "out_time_us" and value.isdigit():
+                out_time = int(value) / 1000000
+            elif key == "progress":
+                # end of a progress block
+                if out_time is not None:
+                    yield out_time
+
+        stderr_reader.join()
+        output = "".join(tail)[-OUTPUT_TAIL_SIZE:]  # output could be huge
 
         process_check = self._check_returncode(process)
         if process_check["code"] != 0:
-            raise VideoEncodingError(output[-1000:])  # output could be huge
+            raise VideoEncodingError(output)
 
         if not output:
             raise VideoEncodingError("No output from FFmpeg.")
 
-        yield output[-1000:]  # output could be huge
+        yield output
@@ -0,0 +1,220 @@
+# Write-behind counters for Media views/likes/dislikes
+#
+# Counter increments and watch actions are kept in redis and written to the
+# database in batches by the flush_media_counters task. When the default
+# cache is not redis (or MEDIA_COUNTERS_WRITE_BEHIND is off) everything is
+# written right away, with F() expressions so no increment is lost.
+# Watch actions are not in the database until flushed, so the repeat view
+# throttle of pre_save_action is complemented by allow_watch.
+
+import json
+import math
+import structlog as logging
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, Q, Value, When
+from django.utils.dateparse import parse_datetime
+
+from apps.users.models import MediaAction
+
+from .models import Media
+
+logger = logging.getLogger(__name__)
+
+# MediaAction.action -> Media counter field
+COUNTER_FIELDS = {"watch": "views", "like": "likes", "dislike": "dislikes"}
+
+COUNTERS_KEY = "media_counters:{}"
+DIRTY_KEY = "media_counters:dirty"
+ACTIONS_KEY = "media_counters:actions"
+WATCHED_KEY = "media_counters:watched:{}:{}"
+FLUSH_BATCH_SIZE = 500
+# how long a watch of media without duration blocks another one, by then
+# the watch action is flushed and pre_save_action takes over
+WATCH_THROTTLE_TIMEOUT = 60 * 60
+
+
+def get_connection():
+    """Return the redis connection of the default cache,
+    None if counters should be written to the database right away
+    """
+
+    if not settings.MEDIA_COUNTERS_WRITE_BEHIND:
+        return None
+    try:
+        from django_redis import get_redis_connection
+
+        return get_redis_connection("default")
+    except (ImportError, NotImplementedError):
+        return None
+
+
+def allow_watch(media, user_id, session_key, remote_ip):
+    """Repeat view throttle for watches that are not flushed yet,
+    same windows as pre_save_action: the media duration for users,
+    at least TIME_TO_ACTION_ANONYMOUS for anonymous (by ip)
+    """
+
+    conn = get_connection()
+    if conn is None:
+        return True
+
+    if user_id:
+        who = f"user:{user_id}"
+        timeout = media.duration or WATCH_THROTTLE_TIMEOUT
+    else:
+        who = f"ip:{remote_ip}" if remote_ip else f"session:{session_key}"
+        timeout = max(media.duration or 0, settings.TIME_TO_ACTION_ANONYMOUS)
+    return bool(conn.set(WATCHED_KEY.format(media.id, who), 1, nx=True, ex=max(1, math.ceil(timeout))))
+
+
+def record_action(media_action):
+    """Count a watch/like/dislike MediaAction
+
+    Watch actions are saved with the next flush. Like/dislike actions are
+    saved now, since pre_save_action looks them up to allow them once
+    """
+
+    field = COUNTER_FIELDS[media_action.action]
+    conn = get_connection()
+    if conn is None:
+        save_actions([media_action])
+        Media.objects.filter(id=media_action.media_id).update(**{field: F(field) + 1})
+        return True
+
+    if media_action.action != "watch":
+        media_action.save()
+
+    pipe = conn.pipeline()
+    pipe.hincrby(COUNTERS_KEY.format(media_action.media_id), field, 1)
+    pipe.sadd(DIRTY_KEY, media_action.media_id)
+    if media_action.action == "watch":
+        pipe.rpush(ACTIONS_KEY, json.dumps(serialize_action(media_action)))
+    pipe.execute()
+    return True
+
+
+def serialize_action(media_action):
+    return {
+        "user_id": media_action.user_id,
+        "session_key": media_action.session_key,
+        "media_id": media_action.media_id,
+        "action": media_action.action,
+        "extra_info": media_action.extra_info,
+        "remote_ip": media_action.remote_ip,
+        "action_date": media_action.action_date.isoformat(),
+    }
+
+
+def deserialize_action(data):
+    data = json.loads(data)
+    data["action_date"] = parse_datetime(data["action_date"])
+    return MediaAction(**data)
+
+
+def save_actions(media_actions):
+    """Save MediaAction objects in bulk
+    a user/session keeps only its latest watch action per media
+    """
+
+    watched = {}
+    others = []
+    for ma in media_actions:
+        if ma.action == "watch" and (ma.user_id or ma.session_key):
+            watched[(ma.user_id, ma.session_key, ma.media_id)] = ma
+        else:
+            others.append(ma)
+
+    query = Q()
+    for user_id, session_key, media_id in watched:
+        if user_id:
+            query |= Q(user_id=user_id, media_id=media_id)
+        else:
+            query |= Q(session_key=session_key, media_id=media_id)
+
+    with transaction.atomic():
+        if watched:
+            MediaAction.objects.filter(query, action="watch").delete()
+        MediaAction.objects.bulk_create(others + list(watched.values()), batch_size=FLUSH_BATCH_SIZE)
+
+
+def update_counters(deltas):
+    """Add deltas ({media_id: {field: delta}}) to Media counters,
+    with a single UPDATE
+    """
+
+    if not deltas:
+        return 0
+
+    updates = {}
+    for field in COUNTER_FIELDS.values():
+        whens = [When(id=media_id, then=Value(counts[field])) for media_id, counts in deltas.items() if counts.get(field)]
+        if whens:
+            updates[field] = F(field) + Case(*whens, default=Value(0))
+    return Media.objects.filter(id__in=list(deltas)).update(**updates)
+
+
+def flush():
+    """Write pending counters and watch actions to the database
+
+    What is read from redis is put back if writing it to the database fails
+    """
+
+    conn = get_connection()
+    if conn is None:
+        return 0
+
+    flushed = 0
+    while True:
+        media_ids = conn.spop(DIRTY_KEY, FLUSH_BATCH_SIZE)
+        if not media_ids:
+            break
+        # read and reset each hash atomically, increments that arrive
+        # afterwards go to a new hash
+        pipe = conn.pipeline()
+        for media_id in media_ids:
+            key = COUNTERS_KEY.format(int(media_id))
+            pipe.hgetall(key)
+            pipe.delete(key)
+        results = pipe.execute()[::2]
+
+        deltas = {}
+        for media_id, counts in zip(media_ids, results):
+            if counts:
+                deltas[int(media_id)] = {k.decode(): int(v) for k, v in counts.items()}
+        try:
+            update_counters(deltas)
+        except Exception:
+            restore_counters(conn, deltas)
+            raise
+        flushed += len(deltas)
+
+    while True:
+        pipe = conn.pipeline()
+        pipe.lrange(ACTIONS_KEY, 0, FLUSH_BATCH_SIZE - 1)
+        pipe.ltrim(ACTIONS_KEY, FLUSH_BATCH_SIZE, -1)
+        actions = pipe.execute()[0]
+        if not actions:
+            break
+        media_actions = [deserialize_action(a) for a in actions]
+        # media deleted since the action was recorded
+        existing = set(Media.objects.filter(id__in={ma.media_id for ma in media_actions}).values_list("id", flat=True))
+        try:
+            save_actions([ma for ma in media_actions if ma.media_id in existing])
+        except Exception:
+            conn.lpush(ACTIONS_KEY, *reversed(actions))
+            raise
+
+    return flushed
+
+
+def restore_counters(conn, deltas):
+    """Add deltas that could not be written back to redis"""
+
+    pipe = conn.pipeline()
+    for media_id, counts in deltas.items():
+        for field, delta in counts.items():
+            pipe.hincrby(COUNTERS_KEY.format(media_id), field, delta)
+        pipe.sadd(DIRTY_KEY, media_id)
+    pipe.execute()
@@ -1,18 +1,24 @@
 # Kudos to Werner Robitza, AVEQ GmbH, for helping with ffmpeg
 # related content
 
+import array
+import bisect
 import hashlib
 import json
 import structlog as logging
 import os
 import random
+import re
 import shutil
 import subprocess
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from fractions import Fraction
 
 import filetype
+from django.apps import apps
 from django.conf import settings
+from django.core.cache import cache
 
 CHARS = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
 
@@ -97,6 +103,18 @@ EXTENSIONS = {"h264": "mp4", "h265": "mp4", "vp9": "webm"}
 
 VIDEO_PROFILES = {"h264": "main", "h265": "main"}
 
+# media_file_info results are cached by file signature, so this can be long
+PROBE_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+
+# read size when hashing files
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# EXT-X-MEDIA attributes identifying a rendition of a group
+HLS_MEDIA_KEY_ATTRIBUTES = ("TYPE", "GROUP-ID", "NAME")
+
+# JPEG images (and ffmpeg's mjpeg encoder) are at most 65500px high
+MAX_JPEG_DIMENSION = 65500
+
 
 def get_portal_workflow():
     return 'public'
@@ -115,6 +133,19 @@ def get_default_state(user=None):
     return state
 
 
+def get_rbac_model(model_name):
+    """Return a model of the rbac app (RBACGroup, RBACMembership),
+    None when RBAC is disabled or the app is not installed
+    """
+
+    if not getattr(settings, 'USE_RBAC', False):
+        return None
+    try:
+        return apps.get_model("rbac", model_name)
+    except LookupError:
+        return None
+
+
 def get_file_name(filename):
     return filename.split("/")[-1]
 
@@ -236,7 +267,159 @@ def run_command(cmd, cwd=None):
     return ret
 
 
-def media_file_info(input_file):
+def file_signature(input_file):
+    """Return a string identifying a file's current content on disk
+
+    Built from device, inode, size and mtime, so it changes whenever the
+    file is rewritten or replaced, without reading the file itself
+    """
+    st = os.stat(input_file)
+    return f"{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}"
+
+
+def get_hasher(algorithm=None):
+    """Return a new hash object for the configured checksum algorithm
+
+    CHECKSUM_ALGORITHM can be "md5" (default) or "xxhash", which needs the
+    optional xxhash package. Falls back to md5 if xxhash is not installed
+    """
+
+    algorithm = algorithm or getattr(settings, "CHECKSUM_ALGORITHM", "md5")
+    if algorithm == "xxhash":
+        try:
+            import xxhash
+
+            return xxhash.xxh3_128()
+        except ImportError:
+            logger.info("xxhash is not installed, falling back to md5")
+    return hashlib.md5()
+
+
+def file_checksum(input_file, algorithm=None, block_size=HASH_BLOCK_SIZE):
+    """Calculate the checksum of a file, reading it once in large blocks"""
+
+    hasher = get_hasher(algorithm)
+    with open(input_file, "rb", buffering=0) as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def checksum_files(input_files, algorithm=None, max_workers=None):
+    """Calculate checksums of many files concurrently
+
+    hashlib and xxhash release the GIL while hashing large buffers, so a
+    thread pool reads and hashes files in parallel. Returns a dict of
+    path to checksum, with an empty string for files that can't be read
+    """
+
+    input_files = list(input_files)
+    if not input_files:
+        return {}
+    max_workers = max_workers or getattr(settings, "CHECKSUM_WORKERS", 4)
+
+    def _checksum(input_file):
+        try:
+            return file_checksum(input_file, algorithm=algorithm)
+        except OSError:
+            return ""
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(input_files))) as executor:
+        return dict(zip(input_files, executor.map(_checksum, input_files)))
+
+
+def get_file_size(input_file):
+    """Size of a file in bytes, or None if it can't be stat-ed"""
+
+    try:
+        return os.stat(input_file).st_size
+    except OSError:
+        return None
+
+
+def parse_duration_tag(duration_str):
+    """Parse a DURATION tag (eg mkv) of format HH:MM:SS.nnnnnnnnn to seconds"""
+
+    try:
+        hms, msec = duration_str.split(".")
+    except ValueError:
+        hms, msec = duration_str.split(",")
+    total_dur = sum(int(x) * 60**i for i, x in enumerate(reversed(hms.split(":"))))
+    return total_dur + float("0." + msec)
+
+
+def get_stream_duration(stream_info, format_info):
+    """Duration of a stream in seconds, falling back to the
+    DURATION tag and then to the container duration (eg for webm)
+    """
+
+    if "duration" in stream_info.keys():
+        return float(stream_info["duration"])
+    if "tags" in stream_info.keys() and "DURATION" in stream_info["tags"]:
+        return parse_duration_tag(stream_info["tags"]["DURATION"])
+    if "duration" in format_info.keys():
+        return float(format_info["duration"])
+    return None
+
+
+def ffprobe_media(input_file):
+    """Run ffprobe once, returning streams and format info
+
+    Returns the decoded ffprobe json, or None if ffprobe failed
+    """
+
+    cmd = [
+        settings.FFPROBE_COMMAND,
+        "-loglevel",
+        "error",
+        "-show_streams",
+        "-show_format",
+        "-of",
+        "json",
+        input_file,
+    ]
+    stdout = run_command(cmd).get("out")
+    try:
+        info = json.loads(stdout)
+    except (TypeError, ValueError):
+        return None
+    info.setdefault("streams", [])
+    info.setdefault("format", {})
+    return info
+
+
+def ffprobe_stream_sizes(input_file):
+    """Sum packet sizes per stream index, in a single pass over the file
+
+    Only needed when a stream does not report its bit_rate
+    """
+
+    cmd = [
+        settings.FFPROBE_COMMAND,
+        "-loglevel",
+        "error",
+        "-show_entries",
+        "packet=stream_index,size",
+        "-of",
+        "compact=p=0:nk=1",
+        input_file,
+    ]
+    stdout = run_command(cmd).get("out") or ""
+    sizes = {}
+    for line in stdout.split("\n"):
+        # ffprobe appends a pipe at the end of the output, thus we have to remove it
+        values = [v for v in line.split("|") if v != ""]
+        if len(values) < 2:
+            continue
+        try:
+            stream_index, size = int(values[0]), int(values[1])
+        except ValueError:
+            continue
+        sizes[stream_index] = sizes.get(stream_index, 0) + size
+    return sizes
+
+
+def media_file_info(input_file, checksum=True, use_cache=True):
     """
     Get the info about an input file, as determined by ffprobe
 
@@ -257,56 +440,61 @@ def media_file_info(input_file):
     - `audio_bitrate`: Bitrate of the video stream in kBit/s
 
     Also returns the video and audio info raw from ffprobe.
+
+    Results are cached by file signature (device, inode, size, mtime), so
+    probing an unchanged file again does not touch ffprobe or re-read it.
+    Pass checksum=False when the md5sum is not needed (eg encoding outputs)
     """
-    ret = {}
 
     if not os.path.isfile(input_file):
-        ret["fail"] = True
+        return {"fail": True}
+
+    try:
+        signature = file_signature(input_file)
+    except OSError:
+        return {"fail": True}
+
+    cache_key = f"media_file_info:{signature}"
+    cached = cache.get(cache_key) if use_cache else None
+    ret = cached if cached is not None else _probe_media_file(input_file)
+    if ret.get("fail"):
         return ret
 
-    video_info = {}
-    audio_info = {}
-    cmd = ["stat", "-c", "%s", input_file]
+    if checksum and ret.get("is_video") and not ret.get("md5sum"):
+        try:
+            ret["md5sum"] = file_checksum(input_file)
+        except OSError:
+            ret["md5sum"] = ""
+        cached = None
 
-    stdout = run_command(cmd).get("out")
-    if stdout:
-        file_size = int(stdout.strip())
-    else:
-        ret["fail"] = True
-        return ret
+    if use_cache and cached is None:
+        cache.set(cache_key, ret, PROBE_CACHE_TIMEOUT)
+    return ret
 
-    cmd = ["md5sum", input_file]
-    stdout = run_command(cmd).get("out")
-    if stdout:
-        md5sum = stdout.split()[0]
-    else:
-        md5sum = ""
 
-    cmd = [
-        settings.FFPROBE_COMMAND,
-        "-loglevel",
-        "error",
-        "-show_streams",
-        "-show_entries",
-        "format=format_name",
-        "-of",
-        "json",
-        input_file,
-    ]
-    stdout = run_command(cmd).get("out")
-    try:
-        info = json.loads(stdout)
-    except TypeError:
+def _probe_media_file(input_file):
+    """Gather media_file_info from one ffprobe call, plus one packet scan
+    only if a stream is missing its bit_rate
+    """
+
+    ret = {}
+    file_size = get_file_size(input_file)
+
+    info = ffprobe_media(input_file)
+    if info is None:
         ret["fail"] = True
         return ret
 
+    format_info = info["format"]
+    video_info = {}
+    audio_info = {}
     has_video = False
     has_audio = False
     for stream_info in info["streams"]:
-        if stream_info["codec_type"] == "video":
+        if stream_info.get("codec_type") == "video":
             video_info = stream_info
             has_video = True
-            if info.get("format") and info["format"].get("format_name", "") in [
+            if format_info.get("format_name", "") in [
                 "tty",
                 "image2",
                 "image2pipe",
@@ -316,7 +504,7 @@ def media_file_info(input_file):
             ]:
                 ret["fail"] = True
                 return ret
-        elif stream_info["codec_type"] == "audio":
+        elif stream_info.get("codec_type") == "audio":
             audio_info = stream_info
             has_audio = True
 
@@ -326,54 +514,20 @@ def media_file_info(input_file):
         ret["audio_info"] = audio_info
         return ret
 
-    if "duration" in video_info.keys():
-        video_duration = float(video_info["duration"])
-    elif "tags" in video_info.keys() and "DURATION" in video_info["tags"]:
-        duration_str = video_info["tags"]["DURATION"]
-        try:
-            hms, msec = duration_str.split(".")
-        except ValueError:
-            hms, msec = duration_str.split(",")
+    video_duration = get_stream_duration(video_info, format_info)
+    if video_duration is None:
+        ret["fail"] = True
+        return ret
 
-        total_dur = sum(int(x) * 60**i for i, x in enumerate(reversed(hms.split(":"))))
-        video_duration = total_dur + float("0." + msec)
-    else:
-        # fallback to format, eg for webm
-        cmd = [
-            settings.FFPROBE_COMMAND,
-            "-loglevel",
-            "error",
-            "-show_format",
-            "-of",
-            "json",
-            input_file,
-        ]
-        stdout = run_command(cmd).get("out")
-        format_info = json.loads(stdout)["format"]
-        try:
-            video_duration = float(format_info["duration"])
-        except KeyError:
-            ret["fail"] = True
-            return ret
+    stream_sizes = None
+    if "bit_rate" not in video_info.keys() or (has_audio and "bit_rate" not in audio_info.keys()):
+        stream_sizes = ffprobe_stream_sizes(input_file)
 
     if "bit_rate" in video_info.keys():
         video_bitrate = round(float(video_info["bit_rate"]) / 1024.0, 2)
     else:
-        cmd = [
-            settings.FFPROBE_COMMAND,
-            "-loglevel",
-            "error",
-            "-select_streams",
-            "v",
-            "-show_entries",
-            "packet=size",
-            "-of",
-            "compact=p=0:nk=1",
-            input_file,
-        ]
-        stdout = run_command(cmd).get("out")
-        stream_size = sum([int(line.replace("|", "")) for line in stdout.split("\n") if line != ""])
-        video_bitrate = round((stream_size * 8 / 1024.0) / video_duration, 2)
+        stream_size = stream_sizes.get(video_info.get("index"), 0)
+        video_bitrate = round((stream_size * 8 / 1024.0) / video_duration, 2) if video_duration else 0
 
     if "r_frame_rate" in video_info.keys():
         video_frame_rate = video_info["r_frame_rate"].partition("/")
@@ -406,51 +560,14 @@ def media_file_info(input_file):
     }
 
     if has_audio:
-        if "duration" in audio_info.keys():
-            audio_duration = float(audio_info["duration"])
-        elif "tags" in audio_info.keys() and "DURATION" in audio_info["tags"]:
-            duration_str = audio_info["tags"]["DURATION"]
-            try:
-                hms, msec = duration_str.split(".")
-            except ValueError:
-                hms, msec = duration_str.split(",")
-            total_dur = sum(int(x) * 60**i for i, x in enumerate(reversed(hms.split(":"))))
-            audio_duration = total_dur + float("0." + msec)
-        else:
-            # fallback to format, eg for webm
-            cmd = [
-                settings.FFPROBE_COMMAND,
-                "-loglevel",
-                "error",
-                "-show_format",
-                "-of",
-                "json",
-                input_file,
-            ]
-            stdout = run_command(cmd).get("out")
-            format_info = json.loads(stdout)["format"]
-            audio_duration = float(format_info["duration"])
+        audio_duration = get_stream_duration(audio_info, format_info) or 0
 
         if "bit_rate" in audio_info.keys():
             audio_bitrate = round(float(audio_info["bit_rate"]) / 1024.0, 2)
         else:
-            # fall back to calculating from accumulated frame duration
-            cmd = [
-                settings.FFPROBE_COMMAND,
-                "-loglevel",
-                "error",
-                "-select_streams",
-                "a",
-                "-show_entries",
-                "packet=size",
-                "-of",
-                "compact=p=0:nk=1",
-                input_file,
-            ]
-            stdout = run_command(cmd).get("out")
-            # ffprobe appends a pipe at the end of the output, thus we have to remove it
-            stream_size = sum([int(line.replace("|", "")) for line in stdout.split("\n") if line != ""])
-            audio_bitrate = round((stream_size * 8 / 1024.0) / audio_duration, 2)
+            # fall back to calculating from accumulated packet sizes
+            stream_size = stream_sizes.get(audio_info.get("index"), 0)
+            audio_bitrate = round((stream_size * 8 / 1024.0) / audio_duration, 2) if audio_duration else 0
 
         ret.update(
             {
@@ -465,7 +582,7 @@ def media_file_info(input_file):
     ret["video_info"] = video_info
     ret["audio_info"] = audio_info
     ret["is_video"] = True
-    ret["md5sum"] = md5sum
+    ret["md5sum"] = ""
     return ret
 
 
@@ -493,41 +610,8 @@ def show_file_size(size):
     return size
 
 
-def get_base_ffmpeg_command(
-    input_file,
-    output_file,
-    has_audio,
-    codec,
-    encoder,
-    audio_encoder,
-    target_fps,
-    interlaced,
-    target_height,
-    target_rate,
-    target_rate_audio,
-    pass_file,
-    pass_number,
-    enc_type,
-    chunk,
-):
-    """Get the base command for a specific codec, height/rate, and pass
-
-    Arguments:
-        input_file {str} -- input file name
-        output_file {str} -- output file name
-        has_audio {bool} -- does the input have audio?
-        codec {str} -- video codec
-        encoder {str} -- video encoder
-        audio_encoder {str} -- audio encoder
-        target_fps {fractions.Fraction} -- target FPS
-        interlaced {bool} -- true if interlaced
-        target_height {int} -- height
-        target_rate {int} -- target bitrate in kbps
-        target_rate_audio {int} -- audio target bitrate
-        pass_file {str} -- path to temp pass file
-        pass_number {int} -- number of passes
-        enc_type {str} -- encoding type (twopass or crf)
-    """
+def get_target_fps(target_fps):
+    """Clamp a source frame rate to the range used for encodings"""
 
     # avoid very high frame rates
     while target_fps > 60:
@@ -535,11 +619,11 @@ def get_base_ffmpeg_command(
 
     if target_fps < 1:
         target_fps = 1
+    return target_fps
 
-    filters = []
 
-    if interlaced:
-        filters.append("yadif")
+def get_scale_filter(target_height):
+    """Scale filter for a target height, handles vertical videos too"""
 
     target_width = round(target_height * 16 / 9)
     scale_filter_opts = [
@@ -549,36 +633,44 @@ def get_base_ffmpeg_command(
         "force_divisible_by=2",
         "flags=lanczos",
     ]
-    scale_filter_str = "scale=" + ":".join(scale_filter_opts)
-    filters.append(scale_filter_str)
+    return "scale=" + ":".join(scale_filter_opts)
 
-    fps_str = f"fps=fps={target_fps}"
-    filters.append(fps_str)
 
-    filters_str = ",".join(filters)
+def get_ffmpeg_output_args(
+    output_file,
+    has_audio,
+    codec,
+    encoder,
+    audio_encoder,
+    target_fps,
+    target_height,
+    target_rate,
+    target_rate_audio,
+    pass_file,
+    pass_number,
+    enc_type,
+    chunk,
+):
+    """Get the encoder arguments of a single output, after its video filters
 
-    base_cmd = [
-        settings.FFMPEG_COMMAND,
-        "-y",
-        "-i",
-        input_file,
-        "-c:v",
-        encoder,
-        "-filter:v",
-        filters_str,
+    Arguments are the same as get_base_ffmpeg_command, target_fps
+    is expected to be clamped already
+    """
+
+    cmd = [
         "-pix_fmt",
         "yuv420p",
     ]
 
     if enc_type == "twopass":
-        base_cmd.extend(["-b:v", str(target_rate) + "k"])
+        cmd.extend(["-b:v", str(target_rate) + "k"])
     elif enc_type == "crf":
-        base_cmd.extend(["-crf", str(VIDEO_CRFS[codec])])
+        cmd.extend(["-crf", str(VIDEO_CRFS[codec])])
         if encoder == "libvpx-vp9":
-            base_cmd.extend(["-b:v", str(target_rate) + "k"])
+            cmd.extend(["-b:v", str(target_rate) + "k"])
 
     if has_audio:
-        base_cmd.extend(
+        cmd.extend(
             [
                 "-c:a",
                 audio_encoder,
@@ -593,9 +685,6 @@ def get_base_ffmpeg_command(
     # get keyframe distance in frames
     keyframe_distance = int(target_fps * KEYFRAME_DISTANCE)
 
-    # start building the command
-    cmd = base_cmd[:]
-
     # preset settings
     preset = getattr(settings, "FFMPEG_DEFAULT_PRESET", "medium")
 
@@ -698,31 +787,122 @@ def get_base_ffmpeg_command(
     return cmd
 
 
-def produce_ffmpeg_commands(media_file, media_info, resolution, codec, output_filename, pass_file, chunk=False):
-    try:
-        media_info = json.loads(media_info)
-    except BaseException:
-        media_info = {}
+def get_base_ffmpeg_command(
+    input_file,
+    output_file,
+    has_audio,
+    codec,
+    encoder,
+    audio_encoder,
+    target_fps,
+    interlaced,
+    target_height,
+    target_rate,
+    target_rate_audio,
+    pass_file,
+    pass_number,
+    enc_type,
+    chunk,
+):
+    """Get the base command for a specific codec, height/rate, and pass
+
+    Arguments:
+        input_file {str} -- input file name
+        output_file {str} -- output file name
+        has_audio {bool} -- does the input have audio?
+        codec {str} -- video codec
+        encoder {str} -- video encoder
+        audio_encoder {str} -- audio encoder
+        target_fps {fractions.Fraction} -- target FPS
+        interlaced {bool} -- true if interlaced
+        target_height {int} -- height
+        target_rate {int} -- target bitrate in kbps
+        target_rate_audio {int} -- audio target bitrate
+        pass_file {str} -- path to temp pass file
+        pass_number {int} -- number of passes
+        enc_type {str} -- encoding type (twopass or crf)
+    """
+
+    target_fps = get_target_fps(target_fps)
+
+    filters = []
+
+    if interlaced:
+        filters.append("yadif")
+
+    filters.append(get_scale_filter(target_height))
+
+    fps_str = f"fps=fps={target_fps}"
+    filters.append(fps_str)
+
+    filters_str = ",".join(filters)
+
+    cmd = [
+        settings.FFMPEG_COMMAND,
+        "-y",
+        "-i",
+        input_file,
+        "-c:v",
+        encoder,
+        "-filter:v",
+        filters_str,
+    ]
+    cmd.extend(
+        get_ffmpeg_output_args(
+            output_file,
+            has_audio=has_audio,
+            codec=codec,
+            encoder=encoder,
+            audio_encoder=audio_encoder,
+            target_fps=target_fps,
+            target_height=target_height,
+            target_rate=target_rate,
+            target_rate_audio=target_rate_audio,
+            pass_file=pass_file,
+            pass_number=pass_number,
+            enc_type=enc_type,
+            chunk=chunk,
+        )
+    )
+    return cmd
+
+
+def get_encoder(codec):
+    """ffmpeg video encoder for a codec, or None if not supported"""
 
     if codec == "h264":
-        encoder = "libx264"
-        # ext = "mp4"
+        return "libx264"
     elif codec in ["h265", "hevc"]:
-        encoder = "libx265"
-        # ext = "mp4"
+        return "libx265"
     elif codec == "vp9":
-        encoder = "libvpx-vp9"
-        # ext = "webm"
-    else:
-        return False
+        return "libvpx-vp9"
+    return None
+
+
+def get_target_rate(codec, resolution, target_fps):
+    """Target video bitrate in kbps for a codec/resolution, or None"""
 
-    target_fps = Fraction(int(media_info.get("video_frame_rate_n", 30)), int(media_info.get("video_frame_rate_d", 1)))
     if target_fps <= 30:
         target_rate = VIDEO_BITRATES[codec][25].get(resolution)
     else:
         target_rate = VIDEO_BITRATES[codec][60].get(resolution)
     if not target_rate:  # INVESTIGATE MORE!
         target_rate = VIDEO_BITRATES[codec][25].get(resolution)
+    return target_rate
+
+
+def produce_ffmpeg_commands(media_file, media_info, resolution, codec, output_filename, pass_file, chunk=False):
+    try:
+        media_info = json.loads(media_info)
+    except BaseException:
+        media_info = {}
+
+    encoder = get_encoder(codec)
+    if not encoder:
+        return False
+
+    target_fps = Fraction(int(media_info.get("video_frame_rate_n", 30)), int(media_info.get("video_frame_rate_d", 1)))
+    target_rate = get_target_rate(codec, resolution, target_fps)
     if not target_rate:
         return False
 
@@ -770,6 +950,223 @@ def produce_ffmpeg_commands(media_file, media_info, resolution, codec, output_fi
     return cmds
 
 
+def produce_ffmpeg_ladder_command(media_file, media_info, outputs, codec, chunk=False):
+    """Produce a single ffmpeg command that encodes many resolutions of
+    the same codec, decoding (and deinterlacing) the input only once
+
+    Arguments:
+        outputs {list} -- list of (resolution, output_filename)
+
+    Returns a tuple of the command and the list of resolutions it encodes.
+    The command is False when a ladder can't be used (eg twopass encoding),
+    in which case the resolutions should be encoded with produce_ffmpeg_commands
+    """
+
+    try:
+        media_info = json.loads(media_info)
+    except BaseException:
+        media_info = {}
+
+    encoder = get_encoder(codec)
+    if not encoder:
+        return False, []
+
+    # a ladder is single pass, twopass encodings are encoded one by one
+    if not media_info.get("video_duration", 0) > CRF_ENCODING_NUM_SECONDS:
+        return False, []
+
+    target_fps = Fraction(int(media_info.get("video_frame_rate_n", 30)), int(media_info.get("video_frame_rate_d", 1)))
+    clamped_fps = get_target_fps(target_fps)
+    has_audio = media_info.get("has_audio")
+
+    rungs = []
+    for resolution, output_filename in outputs:
+        target_rate = get_target_rate(codec, resolution, target_fps)
+        if not target_rate:
+            continue
+        if media_info.get("video_height", 0) < resolution:
+            if resolution not in settings.MINIMUM_RESOLUTIONS_TO_ENCODE:
+                continue
+        rungs.append((resolution, output_filename, target_rate))
+
+    if not rungs:
+        return False, []
+
+    # shared part of the graph, then one scaled branch per resolution
+    shared = []
+    if media_info.get("interlaced"):
+        shared.append("yadif")
+    shared.append(f"fps=fps={clamped_fps}")
+    split_labels = "".join(f"[s{i}]" for i in range(len(rungs)))
+    graph = [f"[0:v]{','.join(shared)},split={len(rungs)}{split_labels}"]
+    for i, (resolution, output_filename, target_rate) in enumerate(rungs):
+        graph.append(f"[s{i}]{get_scale_filter(resolution)}[v{i}]")
+
+    cmd = [
+        settings.FFMPEG_COMMAND,
+        "-y",
+        "-i",
+        media_file,
+        "-filter_complex",
+        ";".join(graph),
+    ]
+    for i, (resolution, output_filename, target_rate) in enumerate(rungs):
+        cmd.extend(["-map", f"[v{i}]"])
+        if has_audio:
+            cmd.extend(["-map", "0:a:0?"])
+        cmd.extend(["-c:v", encoder])
+        cmd.extend(
+            get_ffmpeg_output_args(
+                output_filename,
+                has_audio=has_audio,
+                codec=codec,
+                encoder=encoder,
+                audio_encoder=AUDIO_ENCODERS[codec],
+                target_fps=clamped_fps,
+                target_height=resolution,
+                target_rate=target_rate,
+                target_rate_audio=AUDIO_BITRATES[codec],
+                pass_file=None,
+                pass_number=2,
+                enc_type="crf",
+                chunk=chunk,
+            )
+        )
+    return cmd, [rung[0] for rung in rungs]
+
+
+def produce_sprites(input_file, output_dir, duration, interval=10, width=160, height=90, columns=10, rows=10):
+    """Produce sprite sheets of a video, with ffmpeg runs that decode
+    keyframes only. Writes to output_dir:
+    sprites-001.jpg, ... pages of columns x rows thumbnails,
+    sprites.vtt, a WebVTT thumbnails track pointing to the pages, and
+    sprites.jpg, the first thumbnails in a single column, as many as
+    fit in a JPEG image. The column is a separate run, so the pages do
+    not depend on it
+    Returns the list of page files, empty on failure
+    """
+
+    frames = int(duration // interval) + 1
+    per_page = columns * rows
+    cmd = [
+        settings.FFMPEG_COMMAND,
+        "-y",
+        "-skip_frame",
+        "nokey",
+        "-i",
+        input_file,
+        "-an",
+        "-sn",
+        "-vf",
+        f"fps=1/{interval},scale={width}:{height},tile={columns}x{rows}",
+        "-q:v",
+        "5",
+        os.path.join(output_dir, "sprites-%03d.jpg"),
+    ]
+    run_command(cmd)
+
+    strip_frames = min(frames, MAX_JPEG_DIMENSION // height)
+    cmd = [
+        settings.FFMPEG_COMMAND,
+        "-y",
+        "-skip_frame",
+        "nokey",
+        "-t",
+        str(strip_frames * interval),
+        "-i",
+        input_file,
+        "-an",
+        "-sn",
+        "-vf",
+        f"fps=1/{interval},scale={width}:{height},tile=1x{strip_frames}",
+        "-frames:v",
+        "1",
+        "-q:v",
+        "5",
+        os.path.join(output_dir, "sprites.jpg"),
+    ]
+    run_command(cmd)
+
+    pages = sorted(f for f in os.listdir(output_dir) if f.startswith("sprites-") and f.endswith(".jpg"))
+    if not pages:
+        return []
+
+    cues = ["WEBVTT", ""]
+    for i in range(min(frames, len(pages) * per_page)):
+        page, position = divmod(i, per_page)
+        x = (position % columns) * width
+        y = (position // columns) * height
+        start = seconds_to_timestamp(i * interval)
+        end = seconds_to_timestamp(min((i + 1) * interval, duration))
+        cues.extend([f"{start} --> {end}", f"{pages[page]}#xywh={x},{y},{width},{height}", ""])
+    with open(os.path.join(output_dir, "sprites.vtt"), "w") as f:
+        f.write("\n".join(cues))
+
+    return [os.path.join(output_dir, page) for page in pages]
+
+
+def package_hls_rendition(input_file, output_dir, segment_duration=4):
+    """Package a single mp4 file to HLS with Bento4 mp4hls
+
+    Packaging happens in a temporary directory next to output_dir, which
+    then replaces output_dir. Returns True on success
+    """
+
+    tmp_dir = f"{output_dir}.{produce_friendly_token()}"
+    cmd = [settings.MP4HLS_COMMAND, f"--segment-duration={segment_duration}", f"--output-dir={tmp_dir}", input_file]
+    run_command(cmd)
+    if not os.path.exists(os.path.join(tmp_dir, "master.m3u8")):
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return False
+
+    old_dir = f"{tmp_dir}.old"
+    if os.path.exists(output_dir):
+        os.replace(output_dir, old_dir)
+    os.replace(tmp_dir, output_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return True
+
+
+def write_hls_master(output_dir, renditions):
+    """Write master.m3u8 of output_dir atomically, combining the
+    master playlists of the renditions (subdirectories of output_dir)
+    """
+
+    header = ["#EXTM3U"]
+    lines = []
+    media_keys = set()
+    for rendition in renditions:
+        with open(os.path.join(output_dir, rendition, "master.m3u8")) as f:
+            for line in f.read().splitlines():
+                line = line.strip()
+                if not line or line == "#EXTM3U":
+                    continue
+                if line.startswith("#EXT-X-VERSION") or line == "#EXT-X-INDEPENDENT-SEGMENTS":
+                    if line not in header:
+                        header.append(line)
+                    continue
+                if line.startswith("#EXT-X-MEDIA:"):
+                    # eg the same audio group, in every rendition, with
+                    # its own URI. The first one is kept
+                    attributes = dict(re.findall(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)', line[len("#EXT-X-MEDIA:") :]))
+                    media_key = tuple(attributes.get(name) for name in HLS_MEDIA_KEY_ATTRIBUTES)
+                    if media_key in media_keys:
+                        continue
+                    media_keys.add(media_key)
+                if line.startswith("#"):
+                    line = line.replace('URI="', f'URI="{rendition}/')
+                else:
+                    line = f"{rendition}/{line}"
+                lines.append(line)
+
+    master_file = os.path.join(output_dir, "master.m3u8")
+    tmp_file = f"{master_file}.tmp"
+    with open(tmp_file, "w") as f:
+        f.write("\n".join(header + lines) + "\n")
+    os.replace(tmp_file, master_file)
+    return master_file
+
+
 def clean_query(query):
     """This is used to clear text in order to comply with SearchQuery
     known exception cases
@@ -820,6 +1217,101 @@ def seconds_to_timestamp(seconds):
     return f"{hours:02d}:{minutes:02d}:{seconds_int:02d}.{milliseconds:03d}"  # noqa
 
 
+def keyframe_index_path(input_file):
+    """Path of the keyframe index of a media file, kept next to it"""
+
+    return f"{input_file}.keyframes"
+
+
+def build_keyframe_index(input_file):
+    """Index the keyframes of the first video stream, with a single
+    ffprobe pass over the packets (no decoding)
+
+    The index is stored next to the file as a packed array: the number
+    of keyframes, their timestamps (double) and byte offsets (int64).
+    Returns (timestamps, offsets), or None if ffprobe failed
+    """
+
+    cmd = [
+        settings.FFPROBE_COMMAND,
+        "-loglevel",
+        "error",
+        "-select_streams",
+        "v:0",
+        "-show_entries",
+        "packet=pts_time,pos,flags",
+        "-of",
+        "csv=p=0",
+        input_file,
+    ]
+    stdout = run_command(cmd).get("out")
+    if stdout is None:
+        return None
+
+    timestamps = array.array("d")
+    offsets = array.array("q")
+    for line in stdout.split("\n"):
+        values = line.split(",")
+        if len(values) < 3 or "K" not in values[2]:
+            continue
+        try:
+            timestamps.append(float(values[0]))
+            offsets.append(int(values[1]) if values[1] not in ("", "N/A") else -1)
+        except ValueError:
+            continue
+
+    index_file = keyframe_index_path(input_file)
+    tmp_file = f"{index_file}.tmp"
+    try:
+        with open(tmp_file, "wb") as f:
+            array.array("q", [len(timestamps)]).tofile(f)
+            timestamps.tofile(f)
+            offsets.tofile(f)
+        os.replace(tmp_file, index_file)
+    except OSError as e:
+        logger.info(f"Failed to write keyframe index {index_file}: {e}")
+        rm_file(tmp_file)
+    return timestamps, offsets
+
+
+def load_keyframe_index(input_file, build=False):
+    """Return the (timestamps, offsets) keyframe index of a media file
+
+    An index older than the file is considered stale. Missing or stale
+    indexes are built if build is True, otherwise None is returned
+    """
+
+    index_file = keyframe_index_path(input_file)
+    try:
+        if os.stat(index_file).st_mtime_ns >= os.stat(input_file).st_mtime_ns:
+            with open(index_file, "rb") as f:
+                count = array.array("q")
+                count.fromfile(f, 1)
+                timestamps = array.array("d")
+                timestamps.fromfile(f, count[0])
+                offsets = array.array("q")
+                offsets.fromfile(f, count[0])
+            return timestamps, offsets
+    except (OSError, EOFError):
+        pass
+    if build:
+        return build_keyframe_index(input_file)
+    return None
+
+
+def keyframe_before(input_file, seconds, build=False):
+    """Timestamp of the last keyframe at or before seconds,
+    None if there is no keyframe index for the file
+    """
+
+    index = load_keyframe_index(input_file, build=build)
+    if not index or not index[0]:
+        return None
+    timestamps = index[0]
+    position = bisect.bisect_right(timestamps, seconds)
+    return timestamps[max(position - 1, 0)]
+
+
 def get_trim_timestamps(media_file_path, timestamps_list, run_ffprobe=False):
     """Process a list of timestamps to align start times with I-frames for better video trimming
 
@@ -852,44 +1344,13 @@ def get_trim_timestamps(media_file_path, timestamps_list, run_ffprobe=False):
         startTime = item['startTime']
         endTime = item['endTime']
 
-        # with ffmpeg -ss -i that is getting run, there is no need to call ffprobe to find the I-frame,
-        # as ffmpeg will do that. Keeping this for now in case it is needed
-
-        i_frames = []
-        if run_ffprobe:
-            SEC_TO_SUBTRACT = 10
-            start_seconds = timestamp_to_seconds(startTime)
-            search_start = max(0, start_seconds - SEC_TO_SUBTRACT)
-
-            # Create ffprobe command to find nearest I-frame
-            cmd = [
-                settings.FFPROBE_COMMAND,
-                "-v",
-                "error",
-                "-select_streams",
-                "v:0",
-                "-show_entries",
-                "frame=pts_time,pict_type",
-                "-of",
-                "csv=p=0",
-                "-read_intervals",
-                f"{search_start}%{startTime}",
-                media_file_path,
-            ]
-            cmd = [str(s) for s in cmd]
-            logger.info(f"trim cmd: {cmd}")
-
-            stdout = run_command(cmd).get("out")
-
-            if stdout:
-                for line in stdout.strip().split('\n'):
-                    if line and line.endswith(',I'):
-                        i_frames.append(line.replace(',I', ''))
-
-            if i_frames:
-                adjusted_startTime = seconds_to_timestamp(float(i_frames[-1]))
-
-        if not i_frames:
+        # ffmpeg -ss -i seeks to the I-frame before startTime anyway, snapping to it
+        # keeps the segment durations right. The keyframe index is built when
+        # the media is probed, run_ffprobe builds it if it is missing
+        keyframe = keyframe_before(media_file_path, timestamp_to_seconds(startTime), build=run_ffprobe)
+        if keyframe is not None:
+            adjusted_startTime = seconds_to_timestamp(keyframe)
+        else:
             adjusted_startTime = startTime
 
         timestamps_results.append({'startTime': adjusted_startTime, 'endTime': endTime})
@@ -897,12 +1358,14 @@ def get_trim_timestamps(media_file_path, timestamps_list, run_ffprobe=False):
     return timestamps_results
 
 
-def trim_video_method(media_file_path, timestamps_list):
+def trim_video_method(media_file_path, timestamps_list, output_file=None):
     """Trim a video file based on a list of timestamps
 
     Args:
         media_file_path (str): Path to the media file
         timestamps_list (list): List of dictionaries with startTime and endTime
+        output_file (str): Path to write the trimmed video to, instead of
+            replacing media_file_path
 
     Returns:
         bool: True if successful, False otherwise
@@ -913,11 +1376,12 @@ def trim_video_method(media_file_path, timestamps_list):
     if not os.path.exists(media_file_path):
         return False
 
-    with tempfile.TemporaryDirectory(dir=settings.TEMP_DIRECTORY) as temp_dir:
-        # Detect input file extension to preserve original format
-        _, input_ext = os.path.splitext(media_file_path)
-        output_file = os.path.join(temp_dir, f"output{input_ext}")
+    target_file = output_file or media_file_path
+    # written next to the target file, so that it is moved in place instead of copied
+    _, input_ext = os.path.splitext(media_file_path)
+    output_tmp = os.path.join(os.path.dirname(target_file), f".trimming-{produce_friendly_token()}{input_ext}")
 
+    with tempfile.TemporaryDirectory(dir=settings.TEMP_DIRECTORY) as temp_dir:
         segment_files = []
         for i, item in enumerate(timestamps_list):
             start_time = timestamp_to_seconds(item['startTime'])
@@ -926,7 +1390,7 @@ def trim_video_method(media_file_path, timestamps_list):
 
             # For single timestamp, we can use the output file directly
             # For multiple timestamps, we need to create segment files
-            segment_file = output_file if len(timestamps_list) == 1 else os.path.join(temp_dir, f"segment_{i}{input_ext}")
+            segment_file = output_tmp if len(timestamps_list) == 1 else os.path.join(temp_dir, f"segment_{i}{input_ext}")
 
             cmd = [settings.FFMPEG_COMMAND, "-y", "-ss", str(item['startTime']), "-i", media_file_path, "-t", str(duration), "-c", "copy", "-avoid_negative_ts", "1", segment_file]
 
@@ -936,6 +1400,7 @@ def trim_video_method(media_file_path, timestamps_list):
                 if len(timestamps_list) > 1:
                     segment_files.append(segment_file)
             else:
+                rm_file(output_tmp)
                 return False
 
         if len(timestamps_list) > 1:
@@ -946,21 +1411,36 @@ def trim_video_method(media_file_path, timestamps_list):
             with open(concat_list_path, "w") as f:
                 for segment in segment_files:
                     f.write(f"file '{segment}'\n")
-            concat_cmd = [settings.FFMPEG_COMMAND, "-y", "-f", "concat", "-safe", "0", "-i", concat_list_path, "-c", "copy", output_file]
+            concat_cmd = [settings.FFMPEG_COMMAND, "-y", "-f", "concat", "-safe", "0", "-i", concat_list_path, "-c", "copy", output_tmp]
 
             concat_result = run_command(concat_cmd)  # noqa
 
-            if not os.path.exists(output_file) or os.path.getsize(output_file) == 0:
+            if not os.path.exists(output_tmp) or os.path.getsize(output_tmp) == 0:
+                rm_file(output_tmp)
                 return False
 
-        # Replace the original file with the trimmed version
-        try:
-            rm_file(media_file_path)
-            shutil.copy2(output_file, media_file_path)
-            return True
-        except Exception as e:
-            logger.info(f"Failed to replace original file: {str(e)}")
-            return False
+    # Replace the target file with the trimmed version
+    try:
+        os.replace(output_tmp, target_file)
+        rm_file(keyframe_index_path(target_file))
+        return True
+    except Exception as e:
+        logger.info(f"Failed to replace original file: {str(e)}")
+        rm_file(output_tmp)
+        return False
+
+
+def link_or_copy(source_file, target_file):
+    """Hardlink a file, or copy it if linking is not possible (eg on
+    another filesystem). Files are always replaced, never modified in
+    place, so a link is as good as a copy
+    """
+
+    try:
+        os.link(source_file, target_file)
+    except OSError:
+        shutil.copyfile(source_file, target_file)
+    return True
 
 
 def get_alphanumeric_only(string):
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from ...models import Media
+from ...tasks import update_search_vector
+
+
+class Command(BaseCommand):
+    help = "Rebuild the (weighted) search vectors of all media"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--queue", action="store_true", help="queue update_search_vector tasks instead of updating here")
+
+    def handle(self, *args, **options):
+        count = 0
+        for friendly_token in Media.objects.values_list("friendly_token", flat=True).iterator():
+            if options["queue"]:
+                update_search_vector.delay(friendly_token)
+            else:
+                Media.objects.select_related("user").get(friendly_token=friendly_token).update_search_vector()
+            count += 1
+        self.stdout.write(self.style.SUCCESS(f"Search vectors rebuilt for {count} media"))
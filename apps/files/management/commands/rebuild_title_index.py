@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from ... import suggestions
+
+
+class Command(BaseCommand):
+    help = "Rebuild the title index of search suggestions"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--if-missing", action="store_true", help="only build the index if it was never built, eg on deploy")
+
+    def handle(self, *args, **options):
+        if suggestions.get_connection() is None:
+            self.stdout.write(self.style.WARNING("Title index disabled, or the cache is not redis"))
+            return
+        if options["if_missing"] and suggestions.is_built():
+            self.stdout.write("Title index already built")
+            return
+        count = suggestions.rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Title index rebuilt for {count} media"))
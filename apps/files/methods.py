@@ -1,18 +1,21 @@
 # Kudos to Werner Robitza, AVEQ GmbH, for helping with ffmpeg
 # related content
 
+import hashlib
 import itertools
 import structlog as logging
 import os
 import random
 import re
 import subprocess
+import time
 from datetime import datetime
 
 from django.conf import settings
 from django.core.cache import cache
 from django.core.files import File
 from django.core.mail import EmailMessage
+from django.db import transaction
 from django.db.models import Q
 from django.utils import timezone
 
@@ -23,6 +26,11 @@ from .helpers import mask_ip
 
 logger = logging.getLogger(__name__)
 
+MEDIA_LIST_VERSION_KEY = "media_list_version"
+# bumped for everyone (category changes) or per user (shares, memberships)
+MEDIA_ACCESS_VERSION_KEY = "media_access_version"
+MEDIA_ACCESS_USER_VERSION_KEY = "media_access_version:{}"
+
 
 def get_user_or_session(request):
     """Return a dictionary with user info
@@ -231,6 +239,79 @@ def show_recommended_media(request, limit=100):
     return media
 
 
+def get_media_list_cache_key(request):
+    """Return the cache key of a media listing response,
+    for anonymous requests. Keys change when the listings version
+    is bumped, by bump_media_list_version
+    """
+
+    params = sorted((k, v) for k, v in request.query_params.lists() if any(v))
+    version = cache.get_or_set(MEDIA_LIST_VERSION_KEY, lambda: int(time.time()), None)
+    digest = hashlib.md5(f"{request.build_absolute_uri('/')}{request.path}{params}".encode()).hexdigest()
+    return f"media_list:{version}:{digest}"
+
+
+def bump_media_list_version():
+    """Invalidate cached media listings, once the current transaction
+    commits (so listings are not cached from data about to change)
+    """
+
+    def bump():
+        try:
+            cache.incr(MEDIA_LIST_VERSION_KEY)
+        except ValueError:
+            cache.set(MEDIA_LIST_VERSION_KEY, int(time.time()), None)
+
+    transaction.on_commit(bump)
+    return True
+
+
+def get_media_access_version(user):
+    """Return the version of a user's media access, changes when
+    bump_media_access_version is called for the user or for everyone
+    """
+
+    keys = [MEDIA_ACCESS_VERSION_KEY, MEDIA_ACCESS_USER_VERSION_KEY.format(user.id)]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            versions[key] = int(time.time())
+            cache.add(key, versions[key], None)
+    return "{}.{}".format(*[versions[key] for key in keys])
+
+
+def bump_media_access_version(user=None):
+    """Invalidate cached media access of a user, or of all users.
+    Call it when MediaPermission, RBAC membership or RBAC category changes
+    """
+
+    key = MEDIA_ACCESS_USER_VERSION_KEY.format(user.id) if user else MEDIA_ACCESS_VERSION_KEY
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, int(time.time()), None)
+    return True
+
+
+def get_shared_media_filter(user):
+    """Return a filter for media a user can see through a MediaPermission
+    or RBAC category membership, besides listable and own media
+
+    Both are id__in subqueries, resolved by the database along with the
+    listing, instead of joining permissions and categories, which needed
+    a DISTINCT over the media table
+    """
+
+    shared = Q(id__in=models.MediaPermission.objects.filter(user=user).values("media_id"))
+    if helpers.get_rbac_model("RBACGroup") is not None:
+        rbac_media = models.Media.category.through.objects.filter(
+            category__rbac_groups__memberships__user=user,
+            category__rbac_groups__memberships__role__in=["member", "contributor", "manager"],
+        )
+        shared |= Q(id__in=rbac_media.values("media_id"))
+    return shared
+
+
 def show_related_media(media, request=None, limit=100):
     """Return a list of related media"""
 
@@ -464,12 +545,40 @@ def kill_ffmpeg_process(filepath):
     return result
 
 
-def copy_video(original_media, copy_encodings=True, title_suffix="(Trimmed)"):
+def place_file(instance, field_name, name, source_file=None, write=None):
+    """Set a FileField of instance to a new file in its storage, without
+    streaming it through storage.save: the file is either written there
+    by write(path), or hardlinked/copied from source_file
+
+    Returns True if the file was placed
+    """
+
+    field = instance._meta.get_field(field_name)
+    storage = field.storage
+    name = storage.get_available_name(field.generate_filename(instance, name), max_length=field.max_length)
+    path = storage.path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if write:
+        if not write(path):
+            return False
+    else:
+        helpers.link_or_copy(source_file, path)
+    setattr(instance, field.attname, name)
+    return True
+
+
+def copy_video(original_media, copy_encodings=True, title_suffix="(Trimmed)", timestamps_original=None, timestamps_encodings=None):
     """Create a copy of a media object
 
     Args:
         original_media: Original Media object to copy
         copy_encodings: Whether to copy the encodings too
+        timestamps_original: If set, the media file is trimmed from the
+            original with these timestamps, instead of copied
+        timestamps_encodings: Same, for the mp4 encodings
+
+    Files are written directly in the storage of the new media, and files
+    that are not trimmed are hardlinked where possible
 
     Returns:
         New Media object
@@ -480,39 +589,69 @@ def copy_video(original_media, copy_encodings=True, title_suffix="(Trimmed)"):
         if not models.Media.objects.filter(friendly_token=friendly_token).exists():
             break
 
-    with open(original_media.media_file.path, "rb") as f:
-        myfile = File(f)
-        new_media = models.Media(
-            media_file=myfile,
-            friendly_token=friendly_token,
-            title=f"{original_media.title} {title_suffix}",
-            description=original_media.description,
-            user=original_media.user,
-            media_type=original_media.media_type,
-            enable_comments=original_media.enable_comments,
-            allow_download=original_media.allow_download,
-            state=helpers.get_default_state(user=original_media.user),
-            is_reviewed=original_media.is_reviewed,
-            encoding_status=original_media.encoding_status,
-            add_date=timezone.now(),
-            video_height=original_media.video_height,
-            size=original_media.size,
-            duration=original_media.duration,
-            media_info=original_media.media_info,
+    new_media = models.Media(
+        friendly_token=friendly_token,
+        title=f"{original_media.title} {title_suffix}",
+        description=original_media.description,
+        user=original_media.user,
+        media_type=original_media.media_type,
+        enable_comments=original_media.enable_comments,
+        allow_download=original_media.allow_download,
+        state=helpers.get_default_state(user=original_media.user),
+        is_reviewed=original_media.is_reviewed,
+        encoding_status=original_media.encoding_status,
+        add_date=timezone.now(),
+        video_height=original_media.video_height,
+        size=original_media.size,
+        duration=original_media.duration,
+        media_info=original_media.media_info,
+    )
+    # condition to appear on listings, as in Media.save
+    new_media.listable = new_media.state == "public" and new_media.encoding_status == "success" and new_media.is_reviewed is True
+
+    media_file_name = helpers.get_file_name(original_media.media_file.path)
+    if timestamps_original:
+        placed = place_file(
+            new_media, "media_file", media_file_name, write=lambda path: helpers.trim_video_method(original_media.media_file.path, timestamps_original, output_file=path)
         )
-        models.Media.objects.bulk_create([new_media])
-        # avoids calling signals since signals will call media_init and we don't want that
+        if not placed:
+            logger.info(f"Failed to trim original file for media {original_media.friendly_token}")
+            place_file(new_media, "media_file", media_file_name, source_file=original_media.media_file.path)
+    else:
+        place_file(new_media, "media_file", media_file_name, source_file=original_media.media_file.path)
+
+    for field_name in ["thumbnail", "poster", "uploaded_thumbnail", "uploaded_poster", "sprites"]:
+        if field_name == "sprites" and timestamps_original:
+            # produced again for the trimmed video
+            continue
+        field_file = getattr(original_media, field_name)
+        if field_file and os.path.exists(field_file.path):
+            place_file(new_media, field_name, helpers.get_file_name(field_file.path), source_file=field_file.path)
+
+    models.Media.objects.bulk_create([new_media])
+    # avoids calling signals since signals will call media_init and we don't want that
 
     if copy_encodings:
         for encoding in original_media.encodings.filter(chunk=False, status="success"):
             if encoding.media_file:
-                with open(encoding.media_file.path, "rb") as f:
-                    myfile = File(f)
-                    new_encoding = models.Encoding(
-                        media_file=myfile, media=new_media, profile=encoding.profile, size=encoding.size, status="success", progress=100, chunk=False, logs=f"Copied from encoding {encoding.id}"
+                new_encoding = models.Encoding(
+                    media=new_media, profile=encoding.profile, size=encoding.size, status="success", progress=100, chunk=False, logs=f"Copied from encoding {encoding.id}"
+                )
+                encoding_file_name = helpers.get_file_name(encoding.media_file.path)
+                if timestamps_encodings and encoding.profile.extension == "mp4":
+                    placed = place_file(
+                        new_encoding,
+                        "media_file",
+                        encoding_file_name,
+                        write=lambda path, source=encoding.media_file.path: helpers.trim_video_method(source, timestamps_encodings, output_file=path),
                     )
-                    models.Encoding.objects.bulk_create([new_encoding])
-                    # avoids calling signals as this is still not ready
+                    if not placed:
+                        logger.info(f"Failed to trim encoding {encoding.id} for media {new_media.friendly_token}")
+                        continue
+                else:
+                    place_file(new_encoding, "media_file", encoding_file_name, source_file=encoding.media_file.path)
+                models.Encoding.objects.bulk_create([new_encoding])
+                # avoids calling signals as this is still not ready
 
     # Copy categories and tags
     for category in original_media.category.all():
@@ -521,35 +660,15 @@ def copy_video(original_media, copy_encodings=True, title_suffix="(Trimmed)"):
     for tag in original_media.tags.all():
         new_media.tags.add(tag)
 
-    if original_media.thumbnail:
-        with open(original_media.thumbnail.path, 'rb') as f:
-            thumbnail_name = helpers.get_file_name(original_media.thumbnail.path)
-            new_media.thumbnail.save(thumbnail_name, File(f))
-
-    if original_media.poster:
-        with open(original_media.poster.path, 'rb') as f:
-            poster_name = helpers.get_file_name(original_media.poster.path)
-            new_media.poster.save(poster_name, File(f))
-
-    if original_media.uploaded_thumbnail:
-        with open(original_media.uploaded_thumbnail.path, 'rb') as f:
-            thumbnail_name = helpers.get_file_name(original_media.uploaded_thumbnail.path)
-            new_media.uploaded_thumbnail.save(thumbnail_name, File(f))
+    new_media.schedule_update_related()
+    bump_media_list_version()
 
-    if original_media.uploaded_poster:
-        with open(original_media.uploaded_poster.path, 'rb') as f:
-            poster_name = helpers.get_file_name(original_media.uploaded_poster.path)
-            new_media.uploaded_poster.save(poster_name, File(f))
-
-    if original_media.sprites:
-        with open(original_media.sprites.path, 'rb') as f:
-            sprites_name = helpers.get_file_name(original_media.sprites.path)
-            new_media.sprites.save(sprites_name, File(f))
-
-    if original_media.hls_file and os.path.exists(original_media.hls_file):
+    # HLS is created again for trimmed videos
+    if not timestamps_original and original_media.hls_file and os.path.exists(original_media.hls_file):
         p = os.path.dirname(original_media.hls_file)
         if os.path.exists(p):
             new_hls_file = original_media.hls_file.replace(original_media.uid.hex, new_media.uid.hex)
+            # hls_renditions is parsed again for the new paths, on first use
             models.Media.objects.filter(id=new_media.id).update(hls_file=new_hls_file)
             new_p = p.replace(original_media.uid.hex, new_media.uid.hex)
 
@@ -627,7 +746,7 @@ def list_tasks():
                             task_dict["info"]["media title"] = media.title
                             encoding = models.Encoding.objects.filter(task_id=task.get("id")).first()
                             if encoding:
-                                task_dict["info"]["encoding progress"] = encoding.progress
+                                task_dict["info"]["encoding progress"] = encoding.live_progress
 
                 ret[state]["tasks"].append(task_dict)
     ret["task_ids"] = task_ids
@@ -646,36 +765,28 @@ def handle_video_chapters(media, chapters):
     return {'chapters': media.chapter_data}
 
 
-def change_media_owner(media_id, new_user):
-    """Change the owner of a media
+def change_media_owner(media_ids, new_user):
+    """Change the owner of media, with set based updates
+
+    Media signals are not sent, callers refresh counts and caches
 
     Args:
-        media_id: ID of the media to change owner
+        media_ids: IDs of the media to change owner
         new_user: New user object to set as owner
 
     Returns:
-        Media object or None if media not found
+        Number of media changed
     """
-    media = models.Media.objects.filter(id=media_id).first()
-    if not media:
-        return None
-
-    # Change the owner
-    # previous_user = media.user
-    # keep original user as owner by adding a models.MediaPermission entry with permission=owner
-    # if not models.MediaPermission.objects.filter(media=media, user=previous_user, permission="owner").exists():
-    #    models.MediaPermission.objects.create(media=media, user=previous_user, owner_user=new_user, permission="owner")
 
-    media.user = new_user
-    media.save(update_fields=["user"])
+    changed_count = models.Media.objects.filter(id__in=media_ids).update(user=new_user)
 
-    # Optimize: Update any related permissions in bulk instead of loop
-    models.MediaPermission.objects.filter(media=media).update(owner_user=new_user)
+    # Update any related permissions in bulk
+    models.MediaPermission.objects.filter(media_id__in=media_ids).update(owner_user=new_user)
 
     # remove any existing permissions for the new user, since they are now owner
-    models.MediaPermission.objects.filter(media=media, user=new_user).delete()
+    models.MediaPermission.objects.filter(media_id__in=media_ids, user=new_user).delete()
 
-    return media
+    return changed_count
 
 
 def copy_media(media):
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.8 on 2026-10-18 10:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0015_remove_category_identity_provider'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChunkAssembly',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chunks_info', models.TextField(blank=True)),
+                ('total_chunks', models.PositiveIntegerField(default=0)),
+                ('completed_chunks', models.PositiveIntegerField(default=0)),
+                ('dispatched', models.BooleanField(default=False, help_text='whether assemble_chunks has been started')),
+                ('add_date', models.DateTimeField(auto_now_add=True)),
+                ('media', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunk_assemblies', to='files.media')),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='files.encodeprofile')),
+            ],
+            options={
+                'unique_together': {('media', 'profile')},
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.8 on 2026-10-18 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0016_chunkassembly'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='media',
+            index=models.Index(fields=['listable', 'add_date', 'id'], name='files_media_listabl_0a106e_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='media',
+            index=models.Index(fields=['listable', 'views', 'id'], name='files_media_listabl_8c4fc9_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='media',
+            index=models.Index(fields=['listable', 'likes', 'id'], name='files_media_listabl_3263b6_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='media',
+            index=models.Index(fields=['listable', 'title', 'id'], name='files_media_listabl_76af69_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-18 16:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0017_media_listing_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='media',
+            name='hls_renditions',
+            field=models.JSONField(blank=True, default=dict, help_text='hls_info of hls_file, stored when HLS is created'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.2.8 on 2026-10-18 17:05
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0018_media_hls_renditions'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddIndex(
+            model_name='media',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['title'], name='files_media_title_trgm', opclasses=['gin_trgm_ops']),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.8 on 2026-10-18 18:30
+
+from django.db import migrations, models
+
+
+def unset_empty_hls_renditions(apps, schema_editor):
+    # an empty dict meant "not stored", it is None from now on
+    Media = apps.get_model('files', 'Media')
+    Media.objects.filter(hls_renditions={}).update(hls_renditions=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0019_media_search_ranking'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='media',
+            name='hls_renditions',
+            field=models.JSONField(blank=True, default=None, help_text='hls_info of hls_file, stored when HLS is created', null=True),
+        ),
+        migrations.RunPython(unset_empty_hls_renditions, migrations.RunPython.noop),
+    ]
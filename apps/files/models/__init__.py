@@ -1,7 +1,7 @@
 # Import all models for backward compatibility
 from .category import Category, Tag  # noqa: F401
 from .comment import Comment  # noqa: F401
-from .encoding import EncodeProfile, Encoding  # noqa: F401
+from .encoding import ChunkAssembly, EncodeProfile, Encoding  # noqa: F401
 from .license import License  # noqa: F401
 from .media import Media, MediaPermission  # noqa: F401
 from .page import Page, TinyMCEMedia  # noqa: F401
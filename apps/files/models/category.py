@@ -75,7 +75,6 @@ class Category(models.Model):
         # else:
         #    self.media_count = Media.objects.filter(listable=True, category=self).count()
 
-        self.save(update_fields=["media_count"])
         return True
 
     @property
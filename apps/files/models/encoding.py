@@ -1,9 +1,7 @@
 import json
-import tempfile
 
-from django.conf import settings
-from django.core.files import File
-from django.db import models
+from django.core.cache import cache
+from django.db import models, transaction
 from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.urls import reverse
@@ -17,6 +15,9 @@ from .utils import (
     encoding_media_file_path,
 )
 
+# live progress of running encodings is kept in the cache for this long
+ENCODING_PROGRESS_TIMEOUT = 60 * 60 * 6
+
 
 class EncodeProfile(models.Model):
     """Encode Profile model
@@ -97,32 +98,51 @@ class Encoding(models.Model):
 
     def save(self, *args, **kwargs):
         if self.media_file:
-            cmd = ["stat", "-c", "%s", self.media_file.path]
-            stdout = helpers.run_command(cmd).get("out")
-            if stdout:
-                size = int(stdout.strip())
+            size = helpers.get_file_size(self.media_file.path)
+            if size is not None:
                 self.size = helpers.show_file_size(size)
         if self.chunk_file_path and not self.md5sum:
-            cmd = ["md5sum", self.chunk_file_path]
-            stdout = helpers.run_command(cmd).get("out")
-            if stdout:
-                md5sum = stdout.strip().split()[0]
-                self.md5sum = md5sum
+            try:
+                self.md5sum = helpers.file_checksum(self.chunk_file_path)
+            except OSError:
+                pass
 
         super(Encoding, self).save(*args, **kwargs)
 
     def update_size_without_save(self):
         """Update the size of an encoding without saving to avoid calling signals"""
         if self.media_file:
-            cmd = ["stat", "-c", "%s", self.media_file.path]
-            stdout = helpers.run_command(cmd).get("out")
-            if stdout:
-                size = int(stdout.strip())
+            size = helpers.get_file_size(self.media_file.path)
+            if size is not None:
                 size = helpers.show_file_size(size)
                 Encoding.objects.filter(pk=self.pk).update(size=size)
                 return True
         return False
 
+    @property
+    def progress_cache_key(self):
+        return f"encoding_progress:{self.pk}"
+
+    def publish_progress(self, progress):
+        """Publish the live progress of a running encoding to the cache,
+        without a database write. Returns False if the encoding has been
+        deleted in the meanwhile
+        """
+        if cache.get(f"encoding_deleted:{self.pk}"):
+            return False
+        self.progress = int(min(max(progress, 0), 100))
+        cache.set(self.progress_cache_key, self.progress, ENCODING_PROGRESS_TIMEOUT)
+        return True
+
+    @property
+    def live_progress(self):
+        """Progress as published by a running encoding, else the stored one"""
+        if self.status == "running":
+            progress = cache.get(self.progress_cache_key)
+            if progress is not None:
+                return progress
+        return self.progress
+
     def set_progress(self, progress, commit=True):
         if isinstance(progress, int):
             if 0 <= progress <= 100:
@@ -140,145 +160,81 @@ class Encoding(models.Model):
         return reverse("api_get_encoding", kwargs={"encoding_id": self.id})
 
 
-@receiver(post_save, sender=Encoding)
-def encoding_file_save(sender, instance, created, **kwargs):
-    """Performs actions on encoding file delete
-    For example, if encoding is a chunk file, with encoding_status success,
-    perform a check if this is the final chunk file of a media, then
-    concatenate chunks, create final encoding file and delete chunks
+class ChunkAssembly(models.Model):
+    """Tracks completion of a chunked encoding, one per media and profile
+    Chunk saves update the counter under a row lock, so exactly one of them
+    starts the assemble_chunks task
     """
 
-    if instance.chunk and instance.status == "success":
-        # a chunk got completed
+    media = models.ForeignKey("Media", on_delete=models.CASCADE, related_name="chunk_assemblies")
 
-        # check if all chunks are OK
-        # then concatenate to new Encoding - and remove chunks
-        # this should run only once!
-        if instance.media_file:
-            try:
-                orig_chunks = json.loads(instance.chunks_info).keys()
-            except BaseException:
-                instance.delete()
+    profile = models.ForeignKey(EncodeProfile, on_delete=models.CASCADE)
+
+    chunks_info = models.TextField(blank=True)
+
+    total_chunks = models.PositiveIntegerField(default=0)
+
+    completed_chunks = models.PositiveIntegerField(default=0)
+
+    dispatched = models.BooleanField(default=False, help_text="whether assemble_chunks has been started")
+
+    add_date = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ("media", "profile")
+
+    def __str__(self):
+        return f"{self.profile.name}-{self.media.title} ({self.completed_chunks}/{self.total_chunks})"
+
+    @classmethod
+    def register_chunk(cls, chunk):
+        """Count finished chunks of chunk's media/profile and start
+        assemble_chunks once, when all succeeded or the first one failed
+        """
+
+        try:
+            orig_chunks = list(json.loads(chunk.chunks_info).keys())
+        except BaseException:
+            return False
+
+        with transaction.atomic():
+            assembly = cls.objects.select_for_update().filter(media_id=chunk.media_id, profile_id=chunk.profile_id, chunks_info=chunk.chunks_info).first()
+            if not assembly or assembly.dispatched:
                 return False
 
-            chunks = Encoding.objects.filter(
-                media=instance.media,
-                profile=instance.profile,
-                chunks_info=instance.chunks_info,
-                chunk=True,
-            ).order_by("add_date")
-
-            complete = True
-
-            # perform validation, make sure everything is there
-            for chunk in orig_chunks:
-                if not chunks.filter(chunk_file_path=chunk):
-                    complete = False
-                    break
-
-            for chunk in chunks:
-                if not (chunk.media_file and chunk.media_file.path):
-                    complete = False
-                    break
-
-            if complete:
-                # concatenate chunks and create final encoding file
-                chunks_paths = [f.media_file.path for f in chunks]
-
-                with tempfile.TemporaryDirectory(dir=settings.TEMP_DIRECTORY) as temp_dir:
-                    seg_file = helpers.create_temp_file(suffix=".txt", dir=temp_dir)
-                    tf = helpers.create_temp_file(suffix=f".{instance.profile.extension}", dir=temp_dir)
-                    with open(seg_file, "w") as ff:
-                        for f in chunks_paths:
-                            ff.write(f"file {f}\n")
-                    cmd = [
-                        settings.FFMPEG_COMMAND,
-                        "-y",
-                        "-f",
-                        "concat",
-                        "-safe",
-                        "0",
-                        "-i",
-                        seg_file,
-                        "-c",
-                        "copy",
-                        "-pix_fmt",
-                        "yuv420p",
-                        "-movflags",
-                        "faststart",
-                        tf,
-                    ]
-                    stdout = helpers.run_command(cmd)
-
-                    encoding = Encoding(
-                        media=instance.media,
-                        profile=instance.profile,
-                        status="success",
-                        progress=100,
-                    )
-                    all_logs = "\n".join([st.logs for st in chunks])
-                    encoding.logs = f"{chunks_paths}\n{stdout}\n{all_logs}"
-                    workers = list(set([st.worker for st in chunks]))
-                    encoding.worker = json.dumps({"workers": workers})
-
-                    start_date = min([st.add_date for st in chunks])
-                    end_date = max([st.update_date for st in chunks])
-                    encoding.total_run_time = (end_date - start_date).seconds
-                    encoding.save()
-
-                    with open(tf, "rb") as f:
-                        myfile = File(f)
-                        output_name = f"{helpers.get_file_name(instance.media.media_file.path)}.{instance.profile.extension}"
-                        encoding.media_file.save(content=myfile, name=output_name)
-
-                    # encoding is saved, deleting chunks
-                    # and any other encoding that might exist
-                    # first perform one last validation
-                    # to avoid that this is run twice
-                    if (
-                        len(orig_chunks)
-                        == Encoding.objects.filter(  # noqa
-                            media=instance.media,
-                            profile=instance.profile,
-                            chunks_info=instance.chunks_info,
-                        ).count()
-                    ):
-                        # if two chunks are finished at the same time, this
-                        # will be changed
-                        who = Encoding.objects.filter(media=encoding.media, profile=encoding.profile).exclude(id=encoding.id)
-                        who.delete()
-                    else:
-                        encoding.delete()
-                    if not Encoding.objects.filter(chunks_info=instance.chunks_info):
-                        # TODO: in case of remote workers, files should be deleted
-                        # example
-                        # for worker in workers:
-                        #    for chunk in json.loads(instance.chunks_info).keys():
-                        #        remove_media_file.delay(media_file=chunk)
-                        for chunk in json.loads(instance.chunks_info).keys():
-                            helpers.rm_file(chunk)
-                    instance.media.post_encode_actions(encoding=instance, action="add")
-
-    elif instance.chunk and instance.status == "fail":
-        encoding = Encoding(media=instance.media, profile=instance.profile, status="fail", progress=100)
-
-        chunks = Encoding.objects.filter(media=instance.media, chunks_info=instance.chunks_info, chunk=True).order_by("add_date")
-
-        chunks_paths = [f.media_file.path for f in chunks]
-
-        all_logs = "\n".join([st.logs for st in chunks])
-        encoding.logs = f"{chunks_paths}\n{all_logs}"
-        workers = list(set([st.worker for st in chunks]))
-        encoding.worker = json.dumps({"workers": workers})
-        start_date = min([st.add_date for st in chunks])
-        end_date = max([st.update_date for st in chunks])
-        encoding.total_run_time = (end_date - start_date).seconds
-        encoding.save()
-
-        who = Encoding.objects.filter(media=encoding.media, profile=encoding.profile).exclude(id=encoding.id)
-
-        who.delete()
-        # TODO: merge with above if, do not repeat code
+            # single aggregate query for the completeness check
+            counts = Encoding.objects.filter(media_id=chunk.media_id, profile_id=chunk.profile_id, chunks_info=chunk.chunks_info, chunk=True).aggregate(
+                completed=models.Count(
+                    "chunk_file_path",
+                    distinct=True,
+                    filter=models.Q(status="success", chunk_file_path__in=orig_chunks) & ~models.Q(media_file=""),
+                ),
+                failed=models.Count("id", filter=models.Q(status="fail")),
+            )
+            assembly.completed_chunks = counts["completed"]
+            if counts["failed"] or assembly.completed_chunks >= len(orig_chunks):
+                assembly.dispatched = True
+            assembly.save(update_fields=["completed_chunks", "dispatched"])
+
+            if assembly.dispatched:
+                from .. import tasks
+
+                transaction.on_commit(lambda: tasks.assemble_chunks.delay(assembly.id))
+        return assembly.dispatched
+
+
+@receiver(post_save, sender=Encoding)
+def encoding_file_save(sender, instance, created, **kwargs):
+    """Performs actions on encoding file save
+    For example, if encoding is a chunk file that finished, count it
+    towards its ChunkAssembly. When this is the final chunk of a media,
+    assemble_chunks concatenates chunks, creates the final encoding file
+    and deletes chunks
+    """
+
+    if instance.chunk:
+        if instance.status == "fail" or (instance.status == "success" and instance.media_file):
+            ChunkAssembly.register_chunk(instance)
     else:
         if instance.status in ["fail", "success"]:
             instance.media.post_encode_actions(encoding=instance, action="add")
@@ -295,6 +251,10 @@ def encoding_file_delete(sender, instance, **kwargs):
     when corresponding `Encoding` object is deleted.
     """
 
+    # lets a running encode_media notice it should stop
+    cache.set(f"encoding_deleted:{instance.pk}", True, ENCODING_PROGRESS_TIMEOUT)
+    cache.delete(instance.progress_cache_key)
+
     if instance.media_file:
         helpers.rm_file(instance.media_file.path)
         if not instance.chunk:
@@ -8,9 +8,10 @@ import uuid
 import m3u8
 from django.conf import settings
 from django.contrib.postgres.indexes import GinIndex
-from django.contrib.postgres.search import SearchVectorField
+from django.contrib.postgres.search import SearchVector, SearchVectorField
+from django.core.cache import cache
 from django.core.files import File
-from django.db import models
+from django.db import models, transaction
 from django.db.models import Func, Value
 from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
 from django.dispatch import receiver
@@ -36,6 +37,11 @@ from .video_data import VideoTrimRequest
 
 logger = logging.getLogger(__name__)
 
+# fields that the user/category/tag media counts and the search vector
+# depend on, saves that update other fields only skip them
+MEDIA_RELATED_FIELDS = {"title", "description", "user", "user_id", "state", "listable", "is_reviewed"}
+MEDIA_RELATED_DIRTY_KEY = "media_related_dirty:{}"
+
 
 class Media(models.Model):
     """The most important model for MediaCMS"""
@@ -75,6 +81,8 @@ class Media(models.Model):
 
     hls_file = models.CharField(max_length=1000, blank=True, help_text="Path to HLS file for videos")
 
+    hls_renditions = models.JSONField(blank=True, null=True, default=None, help_text="hls_info of hls_file, stored when HLS is created")
+
     is_reviewed = models.BooleanField(
         default=True,
         db_index=True,
@@ -219,7 +227,14 @@ class Media(models.Model):
         indexes = [
             # TODO: check with pgdash.io or other tool what index need be
             # removed
-            GinIndex(fields=["search"])
+            GinIndex(fields=["search"]),
+            # typo tolerant title autocomplete (pg_trgm)
+            GinIndex(fields=["title"], opclasses=["gin_trgm_ops"], name="files_media_title_trgm"),
+            # listings and keyset pagination, ordered by a sort field plus id
+            models.Index(fields=["listable", "add_date", "id"]),
+            models.Index(fields=["listable", "views", "id"]),
+            models.Index(fields=["listable", "likes", "id"]),
+            models.Index(fields=["listable", "title", "id"]),
         ]
 
     def __str__(self):
@@ -336,8 +351,10 @@ class Media(models.Model):
 
     def update_search_vector(self):
         """
-        Update SearchVector field of SearchModel using raw SQL
-        search field is used to store SearchVector
+        Update SearchVector field of SearchModel
+        search field is used to store SearchVector, weighted so that
+        matches rank by where they are found: title (A), tags (B),
+        description and user (C), subtitles (D)
         """
 
         # first get anything interesting out of the media
@@ -345,32 +362,62 @@ class Media(models.Model):
 
         a_tags = b_tags = ""
         if self.id:
-            a_tags = " ".join([tag.title for tag in self.tags.all()])
-            b_tags = " ".join([tag.title.replace("-", " ") for tag in self.tags.all()])
-
-        items = [
-            self.title,
-            self.user.username,
-            self.user.email,
-            self.user.name,
-            self.description,
-            a_tags,
-            b_tags,
-        ]
+            tags = [tag.title for tag in self.tags.all()]
+            a_tags = " ".join(tags)
+            b_tags = " ".join([tag.replace("-", " ") for tag in tags])
+
+        weighted_items = {
+            "A": [self.title],
+            "B": [a_tags, b_tags],
+            "C": [self.description, self.user.username, self.user.email, self.user.name],
+            "D": [subtitle.subtitle_text for subtitle in self.subtitles.all()],
+        }
+
+        vector = None
+        for weight, items in weighted_items.items():
+            text = " ".join([item for item in items if item])
+            text = " ".join([token for token in text.lower().split(" ") if token not in STOP_WORDS])
+            text = helpers.clean_query(text)
+            if not text:
+                continue
+            item_vector = SearchVector(Value(text, output_field=models.TextField()), config="simple", weight=weight)
+            vector = item_vector if vector is None else vector + item_vector
+
+        if vector is None:
+            vector = Func(Value('simple'), Value(""), function='to_tsvector')
+        Media.objects.filter(id=self.id).update(search=vector)
+
+        return True
+
+    def update_related(self):
+        """Update the media count of the user, categories and tags
+        of the media, its search vector and title suggestions
+        """
 
-        for subtitle in self.subtitles.all():
-            items.append(subtitle.subtitle_text)
+        cache.delete(MEDIA_RELATED_DIRTY_KEY.format(self.id))
 
-        items = [item for item in items if item]
-        text = " ".join(items)
-        text = " ".join([token for token in text.lower().split(" ") if token not in STOP_WORDS])
+        self.user.update_user_media()
+        # this won't catch when a category
+        # is removed from a media, which is what we want...
+        for category in self.category.all():
+            category.update_category_media()
+        for tag in self.tags.all():
+            tag.update_tag_media()
 
-        text = helpers.clean_query(text)
+        self.update_search_vector()
 
-        Media.objects.filter(id=self.id).update(search=Func(Value('simple'), Value(text), function='to_tsvector'))
+        from .. import suggestions
 
+        suggestions.index_media(self)
         return True
 
+    def schedule_update_related(self):
+        """Schedule update_related, saves within MEDIA_SAVE_DEBOUNCE
+        seconds are coalesced into a single task
+        """
+
+        return schedule_update_related([self.id])
+
     def media_init(self):
         """Normally this is called when a media is uploaded
         Performs all related tasks, as check for media type,
@@ -449,6 +496,11 @@ class Media(models.Model):
                 self.duration = int(float(ret.get("audio_info", {}).get("duration", 0)))
                 self.encoding_status = "success"
 
+            if self.media_type == "video":
+                # used for fast seeking by thumbnails, previews and trims,
+                # only built when missing or older than the file
+                helpers.load_keyframe_index(self.media_file.path, build=True)
+
         if save:
             self.save(
                 update_fields=[
@@ -496,6 +548,10 @@ class Media(models.Model):
             thumbnail_time = self.thumbnail_time
         else:
             thumbnail_time = round(random.uniform(0, self.duration - 0.1), 1)
+            # any time will do, a keyframe needs no decoding of previous frames
+            keyframe = helpers.keyframe_before(self.media_file.path, thumbnail_time)
+            if keyframe:
+                thumbnail_time = round(keyframe, 1)
             self.thumbnail_time = thumbnail_time  # so that it gets saved
 
         tf = helpers.create_temp_file(suffix=".jpg")
@@ -538,7 +594,7 @@ class Media(models.Model):
         """Start video encoding tasks
         Create a task per EncodeProfile object, after checking height
         so that no EncodeProfile for highter heights than the video
-        are created
+        are created. With ENCODE_LADDER, a task per codec instead
         """
 
         if not profiles:
@@ -563,6 +619,9 @@ class Media(models.Model):
             profiles = [p.id for p in profiles]
             tasks.chunkize_media.delay(self.friendly_token, profiles, force=force)
         else:
+            # with ENCODE_LADDER, profiles of the same codec share a single
+            # encode_media_ladder task that decodes the source once
+            ladder = {}
             for profile in profiles:
                 if profile.extension != "gif":
                     if self.video_height and self.video_height < profile.resolution:
@@ -570,16 +629,27 @@ class Media(models.Model):
                             continue
                 encoding = Encoding(media=self, profile=profile)
                 encoding.save()
-                enc_url = settings.FRONTEND_URL + encoding.get_absolute_url()
                 if profile.resolution in settings.MINIMUM_RESOLUTIONS_TO_ENCODE:
                     priority = 9
                 else:
                     priority = 0
+                if settings.ENCODE_LADDER and profile.extension != "gif" and profile.codec:
+                    # minimum resolutions get their own (high priority) ladder,
+                    # so they are not held back by the larger ones
+                    ladder.setdefault((profile.codec, priority), []).append([profile.id, encoding.id])
+                    continue
+                enc_url = settings.FRONTEND_URL + encoding.get_absolute_url()
                 tasks.encode_media.apply_async(
                     args=[self.friendly_token, profile.id, encoding.id, enc_url],
                     kwargs={"force": force},
                     priority=priority,
                 )
+            for (codec, priority), encodings in ladder.items():
+                tasks.encode_media_ladder.apply_async(
+                    args=[self.friendly_token, codec, encodings],
+                    kwargs={"force": force},
+                    priority=priority,
+                )
 
         return True
 
@@ -697,8 +767,8 @@ class Media(models.Model):
                     extra.append(encoding.profile.codec)
             for codec in extra:
                 ret[resolution][codec] = {}
-                v = self.encodings.filter(chunk=True, profile__codec=codec).values("progress")
-                ret[resolution][codec]["progress"] = sum([p["progress"] for p in v]) / v.count()
+                chunks = list(self.encodings.filter(chunk=True, profile__codec=codec))
+                ret[resolution][codec]["progress"] = sum([chunk.live_progress for chunk in chunks]) / len(chunks)
                 # TODO; status/logs/errors
         return ret
 
@@ -708,7 +778,7 @@ class Media(models.Model):
         ep = {}
         ep["title"] = encoding.profile.name
         ep["url"] = encoding.media_encoding_url
-        ep["progress"] = encoding.progress
+        ep["progress"] = encoding.live_progress
         ep["size"] = encoding.size
         ep["encoding_id"] = encoding.id
         ep["status"] = encoding.status
@@ -842,6 +912,31 @@ class Media(models.Model):
             return helpers.url_from_path(self.sprites.path)
         return None
 
+    @property
+    def sprites_dir(self):
+        """Directory with the sprite sheet pages and their
+        WebVTT thumbnails track, next to the sprites file. Pages
+        can exist without it, when the single column failed
+        """
+
+        if self.sprites:
+            return os.path.splitext(self.sprites.path)[0]
+        if self.media_file:
+            return os.path.join(settings.MEDIA_ROOT, original_thumbnail_file_path(self, f"{helpers.get_file_name(self.media_file.path)}sprites"))
+        return None
+
+    @property
+    def sprites_vtt_url(self):
+        """Property used on serializers
+        Returns the WebVTT thumbnails track url
+        """
+
+        if self.sprites_dir:
+            vtt_file = os.path.join(self.sprites_dir, "sprites.vtt")
+            if os.path.exists(vtt_file):
+                return helpers.url_from_path(vtt_file)
+        return None
+
     @property
     def preview_url(self):
         """Property used on serializers
@@ -862,13 +957,25 @@ class Media(models.Model):
     def hls_info(self):
         """Property used on serializers
         Returns hls info, curated to be read by video.js
+        Stored when HLS is created, to avoid reading the playlists on requests
         """
 
+        if not self.hls_file:
+            return {}
+        if self.hls_renditions is None:
+            # HLS created before hls_renditions was stored
+            self.hls_renditions = self.parse_hls_info()
+            Media.objects.filter(pk=self.pk).update(hls_renditions=self.hls_renditions)
+        return self.hls_renditions
+
+    def parse_hls_info(self, hls_file=None):
+        """Returns hls info, as read from the HLS master playlist"""
+
         res = {}
         valid_resolutions = [144, 240, 360, 480, 720, 1080, 1440, 2160]
-        if self.hls_file:
-            if os.path.exists(self.hls_file):
-                hls_file = self.hls_file
+        hls_file = hls_file or self.hls_file
+        if hls_file:
+            if os.path.exists(hls_file):
                 p = os.path.dirname(hls_file)
                 m3u8_obj = m3u8.load(hls_file)
                 if os.path.exists(hls_file):
@@ -983,6 +1090,25 @@ class MediaPermission(models.Model):
         return f"{self.user.username} - {self.media.title} ({self.permission})"
 
 
+def schedule_update_related(media_ids):
+    """Schedule Media.update_related for many media, eg after
+    set based changes that don't send Media signals
+    """
+
+    from .. import tasks
+
+    media_ids = list(media_ids)
+
+    def schedule():
+        # marked after commit, so that the task never misses a save
+        for media_id in media_ids:
+            if cache.add(MEDIA_RELATED_DIRTY_KEY.format(media_id), 1, settings.MEDIA_SAVE_DEBOUNCE * 10):
+                tasks.update_media_related.apply_async(args=[media_id], countdown=settings.MEDIA_SAVE_DEBOUNCE)
+
+    transaction.on_commit(schedule)
+    return True
+
+
 @receiver(post_save, sender=Media)
 def media_save(sender, instance, created, **kwargs):
     # media_file path is not set correctly until mode is saved
@@ -999,18 +1125,17 @@ def media_save(sender, instance, created, **kwargs):
         instance.media_init()
         notify_users(friendly_token=instance.friendly_token, action="media_added")
 
-    instance.user.update_user_media()
-    if instance.category.all():
-        # this won't catch when a category
-        # is removed from a media, which is what we want...
-        for category in instance.category.all():
-            category.update_category_media()
+    update_fields = kwargs.get("update_fields")
+    if instance.listable or not update_fields or set(update_fields) & MEDIA_RELATED_FIELDS:
+        from ..methods import bump_media_list_version
 
-    if instance.tags.all():
-        for tag in instance.tags.all():
-            tag.update_tag_media()
+        bump_media_list_version()
 
-    instance.update_search_vector()
+    if update_fields and not set(update_fields) & MEDIA_RELATED_FIELDS:
+        # eg encoding status, thumbnails, counters
+        return True
+
+    instance.schedule_update_related()
 
 
 @receiver(pre_delete, sender=Media)
@@ -1031,8 +1156,14 @@ def media_file_delete(sender, instance, **kwargs):
     Deletes file from filesystem
     when corresponding `Media` object is deleted.
     """
+    from .. import suggestions
+    from ..methods import bump_media_list_version
+
+    bump_media_list_version()
+    suggestions.remove_media(instance.id)
     if instance.media_file:
         helpers.rm_file(instance.media_file.path)
+        helpers.rm_file(helpers.keyframe_index_path(instance.media_file.path))
     if instance.thumbnail:
         helpers.rm_file(instance.thumbnail.path)
     if instance.poster:
@@ -1043,6 +1174,8 @@ def media_file_delete(sender, instance, **kwargs):
         helpers.rm_file(instance.uploaded_poster.path)
     if instance.sprites:
         helpers.rm_file(instance.sprites.path)
+    if instance.sprites_dir:
+        helpers.rm_dir(instance.sprites_dir)
     if instance.hls_file:
         p = os.path.dirname(instance.hls_file)
         helpers.rm_dir(p)
@@ -1059,9 +1192,25 @@ def media_file_delete(sender, instance, **kwargs):
 
 @receiver(m2m_changed, sender=Media.category.through)
 def media_m2m(sender, instance, **kwargs):
+    from ..methods import bump_media_access_version, bump_media_list_version
+
+    bump_media_list_version()
+    action = kwargs.get("action")
+    if action == "post_clear" or (action in ("post_add", "post_remove") and kwargs["model"].objects.filter(id__in=kwargs["pk_set"], is_rbac_category=True).exists()):
+        # media shared through RBAC categories
+        bump_media_access_version()
     if instance.category.all():
         for category in instance.category.all():
             category.update_category_media()
     if instance.tags.all():
         for tag in instance.tags.all():
             tag.update_tag_media()
+
+
+@receiver(post_save, sender=MediaPermission)
+@receiver(post_delete, sender=MediaPermission)
+def media_permission_change(sender, instance, **kwargs):
+    from ..methods import bump_media_access_version
+
+    bump_media_access_version(instance.user)
+
@@ -139,6 +139,7 @@ class SingleMediaSerializer(serializers.ModelSerializer):
             "thumbnail_time",
             "url",
             "sprites_url",
+            "sprites_vtt_url",
             "preview_url",
             "author_name",
             "author_profile",
@@ -0,0 +1,146 @@
+# Title suggestions (search autocomplete) from a redis prefix index
+#
+# Listable media titles are kept in a sorted set, one member per word of
+# the title: "<title from that word on>\x00<media id>". All members have
+# score 0, so ZRANGEBYLEX returns the titles with a word starting with
+# the typed prefix, and the newest of them are suggested. Media are
+# (re)indexed from Media.update_related and removed on delete; rebuild()
+# indexes everything (manage.py rebuild_title_index, on deploy).
+
+import json
+
+from django.conf import settings
+
+from . import helpers
+from .models import Media
+
+TITLES_KEY = "media_titles"
+MEMBERS_KEY = "media_titles:members"
+TITLES_BUILT_KEY = "media_titles:built"
+SEPARATOR = "\x00"
+REBUILD_BATCH_SIZE = 1000
+# matching media read to pick the newest from, for short prefixes
+MAX_CANDIDATES = 500
+
+
+def get_connection():
+    """Return the redis connection of the default cache,
+    None if the index is disabled or the cache is not redis
+    """
+
+    if not settings.MEDIA_TITLE_INDEX:
+        return None
+    try:
+        from django_redis import get_redis_connection
+
+        return get_redis_connection("default")
+    except (ImportError, NotImplementedError):
+        return None
+
+
+def normalize(text):
+    return " ".join(helpers.clean_query(text).split())
+
+
+def title_members(media_id, title):
+    words = normalize(title).split(" ")
+    return [f"{' '.join(words[i:])}{SEPARATOR}{media_id}" for i in range(len(words)) if words[i]]
+
+
+def _index(pipe, media_id, title, add_date, old_entry):
+    # MEMBERS_KEY keeps the title, date and members of each media,
+    # to show and order the titles and to remove the members later
+    if old_entry:
+        pipe.zrem(TITLES_KEY, *json.loads(old_entry)["members"])
+    members = title_members(media_id, title)
+    if members:
+        pipe.zadd(TITLES_KEY, {member: 0 for member in members})
+        date = add_date.timestamp() if add_date else 0
+        pipe.hset(MEMBERS_KEY, media_id, json.dumps({"title": title, "add_date": date, "members": members}))
+    else:
+        pipe.hdel(MEMBERS_KEY, media_id)
+
+
+def index_media(media):
+    """Add, update or remove (when not listable) the title of a media"""
+
+    conn = get_connection()
+    if conn is None:
+        return False
+
+    old_entry = conn.hget(MEMBERS_KEY, media.id)
+    pipe = conn.pipeline()
+    _index(pipe, media.id, media.title if media.listable else "", media.add_date, old_entry)
+    pipe.execute()
+    return True
+
+
+def remove_media(media_id):
+    conn = get_connection()
+    if conn is None:
+        return False
+
+    old_entry = conn.hget(MEMBERS_KEY, media_id)
+    if old_entry:
+        pipe = conn.pipeline()
+        pipe.zrem(TITLES_KEY, *json.loads(old_entry)["members"])
+        pipe.hdel(MEMBERS_KEY, media_id)
+        pipe.execute()
+    return True
+
+
+def rebuild():
+    """Index the titles of all listable media"""
+
+    conn = get_connection()
+    if conn is None:
+        return 0
+
+    conn.delete(TITLES_KEY, MEMBERS_KEY, TITLES_BUILT_KEY)
+    count = 0
+    pipe = conn.pipeline()
+    for media_id, title, add_date in Media.objects.filter(listable=True).values_list("id", "title", "add_date").iterator(chunk_size=REBUILD_BATCH_SIZE):
+        _index(pipe, media_id, title, add_date, None)
+        count += 1
+        if count % REBUILD_BATCH_SIZE == 0:
+            pipe.execute()
+    pipe.set(TITLES_BUILT_KEY, 1)
+    pipe.execute()
+    return count
+
+
+def is_built():
+    conn = get_connection()
+    return conn is not None and bool(conn.exists(TITLES_BUILT_KEY))
+
+
+def suggest_titles(query, limit=40):
+    """Return up to limit listable titles with a word starting with query,
+    newest first. None if the index is not available or nothing matches,
+    so the caller can fall back to the database
+    """
+
+    conn = get_connection()
+    if conn is None or not conn.exists(TITLES_BUILT_KEY):
+        return None
+
+    prefix = normalize(query)
+    if not prefix:
+        return None
+
+    media_ids = set()
+    start = 0
+    # a media matches once per word, read in batches up to MAX_CANDIDATES media
+    while len(media_ids) < MAX_CANDIDATES:
+        members = conn.zrangebylex(TITLES_KEY, b"[" + prefix.encode(), b"[" + prefix.encode() + b"\xff", start=start, num=limit * 2)
+        for member in members:
+            media_ids.add(int(member.decode().rsplit(SEPARATOR, 1)[1]))
+        if len(members) < limit * 2:
+            break
+        start += len(members)
+
+    if not media_ids:
+        return None
+    entries = [json.loads(entry) for entry in conn.hmget(MEMBERS_KEY, list(media_ids)) if entry]
+    entries.sort(key=lambda entry: entry.get("add_date", 0), reverse=True)
+    return [{"title": entry["title"]} for entry in entries[:limit]] or None
@@ -3,6 +3,7 @@ import os
 import re
 import shutil
 import tempfile
+import time
 from datetime import datetime, timedelta
 
 from celery import Task
@@ -15,24 +16,32 @@ from django.conf import settings
 from django.core.cache import cache
 from django.core.files import File
 from django.db import DatabaseError
-from django.db.models import Q
+from django.db.models import Count, Q
 
 from apps.users.models import User, MediaAction, USER_MEDIA_ACTIONS
 
+from . import counters, suggestions
 from .backends import FFmpegBackend
 from .exceptions import VideoEncodingError
 from .helpers import (
-    calculate_seconds,
+    checksum_files,
     create_temp_file,
+    file_signature,
     get_file_name,
     get_file_type,
     get_trim_timestamps,
+    keyframe_before,
     media_file_info,
+    package_hls_rendition,
     produce_ffmpeg_commands,
+    produce_ffmpeg_ladder_command,
     produce_friendly_token,
+    produce_sprites,
+    rm_dir,
     rm_file,
     run_command,
     trim_video_method,
+    write_hls_master,
 )
 from .methods import (
     copy_video,
@@ -43,6 +52,7 @@ from .methods import (
 )
 from .models import (
     Category,
+    ChunkAssembly,
     EncodeProfile,
     Encoding,
     Language,
@@ -64,6 +74,9 @@ ERRORS_LIST = [
     "Unable to find a suitable output format for",
 ]
 
+# upper limit for an HLS packaging run of a media
+HLS_LOCK_TIMEOUT = 60 * 60
+
 
 def handle_pending_running_encodings(media):
     """Handle pending and running encodings for a media object.
@@ -176,13 +189,10 @@ def chunkize_media(self, friendly_token, profiles, force=True):
 
     chunks = [os.path.join(cwd, ch) for ch in chunks]
     to_profiles = []
-    chunks_dict = {}
-    # calculate once md5sums
-    for chunk in chunks:
-        cmd = ["md5sum", chunk]
-        stdout = run_command(cmd).get("out")
-        md5sum = stdout.strip().split()[0]
-        chunks_dict[chunk] = md5sum
+    # calculate once checksums, reading chunks in parallel
+    chunks_dict = checksum_files(chunks)
+    chunks_info = json.dumps(chunks_dict)
+    ladder = {}
 
     for profile in profiles:
         if media.video_height and media.video_height < profile.resolution:
@@ -190,28 +200,46 @@ def chunkize_media(self, friendly_token, profiles, force=True):
                 continue
         to_profiles.append(profile)
 
+        # completion counter for this media/profile, see ChunkAssembly.register_chunk
+        ChunkAssembly.objects.update_or_create(
+            media=media,
+            profile=profile,
+            defaults={"chunks_info": chunks_info, "total_chunks": len(chunks), "completed_chunks": 0, "dispatched": False},
+        )
+
         for chunk in chunks:
             encoding = Encoding(
                 media=media,
                 profile=profile,
                 chunk_file_path=chunk,
                 chunk=True,
-                chunks_info=json.dumps(chunks_dict),
+                chunks_info=chunks_info,
                 md5sum=chunks_dict[chunk],
             )
 
             encoding.save()
-            enc_url = settings.FRONTEND_URL + encoding.get_absolute_url()
             if profile.resolution in settings.MINIMUM_RESOLUTIONS_TO_ENCODE:
                 priority = 0
             else:
                 priority = 9
+            if settings.ENCODE_LADDER and profile.codec:
+                ladder.setdefault((chunk, profile.codec, priority), []).append([profile.id, encoding.id])
+                continue
+            enc_url = settings.FRONTEND_URL + encoding.get_absolute_url()
             encode_media.apply_async(
                 args=[friendly_token, profile.id, encoding.id, enc_url],
                 kwargs={"force": force, "chunk": True, "chunk_file_path": chunk},
                 priority=priority,
             )
 
+    # one process per chunk, codec and priority, see encode_media_ladder
+    for (chunk, codec, priority), encodings in ladder.items():
+        encode_media_ladder.apply_async(
+            args=[friendly_token, codec, encodings],
+            kwargs={"force": force, "chunk": True, "chunk_file_path": chunk},
+            priority=priority,
+        )
+
     logger.info(f"got {len(chunks)} chunks and will encode to {to_profiles} profiles")
     return True
 
@@ -220,16 +248,18 @@ class EncodingTask(Task):
     def on_failure(self, exc, task_id, args, kwargs, einfo):
         # mainly used to run some post failure steps
         # we get here if a task is revoked
-        try:
-            if hasattr(self, "encoding"):
-                self.encoding.status = "fail"
-                self.encoding.save(update_fields=["status"])
-                kill_ffmpeg_process(self.encoding.temp_file)
-                kill_ffmpeg_process(self.encoding.chunk_file_path)
-                if hasattr(self.encoding, "media"):
-                    self.encoding.media.post_encode_actions()
-        except BaseException:
-            pass
+        # encode_media binds a single encoding, encode_media_ladder all of its encodings
+        encodings = getattr(self, "encodings", None) or ([self.encoding] if hasattr(self, "encoding") else [])
+        for encoding in encodings:
+            try:
+                encoding.status = "fail"
+                encoding.save(update_fields=["status"])
+                kill_ffmpeg_process(encoding.temp_file)
+                kill_ffmpeg_process(encoding.chunk_file_path)
+                if hasattr(encoding, "media"):
+                    encoding.media.post_encode_actions()
+            except BaseException:
+                pass
         return False
 
 
@@ -317,12 +347,13 @@ def encode_media(
 
     if profile.extension == "gif":
         tf = create_temp_file(suffix=".gif")
-        # -ss 5 start from 5 second. -t 25 until 25 sec
+        # -ss 3 start from 3 second, or the keyframe before it. -t 25 until 25 sec
+        start = keyframe_before(media.media_file.path, 3)
         command = [
             settings.FFMPEG_COMMAND,
             "-y",
             "-ss",
-            "3",
+            str(start if start is not None else 3),
             "-i",
             media.media_file.path,
             "-hide_banner",
@@ -386,21 +417,23 @@ def encode_media(
             encoding_backend = FFmpegBackend()
             try:
                 encoding_command = encoding_backend.encode(ffmpeg_command)
-                duration, n_times = 0, 0
+                # chunks are at most VIDEO_CHUNKS_DURATION long
+                total_duration = min(media.duration, settings.VIDEO_CHUNKS_DURATION) if chunk else media.duration
+                last_published = 0
                 output = ""
                 while encoding_command:
                     try:
                         # TODO: understand an eternal loop
                         # eg h265 with mv4 file issue, and stop with error
                         output = next(encoding_command)
-                        duration = calculate_seconds(output)
-                        if duration:
-                            percent = duration * 100 / media.duration
-                            if n_times % 60 == 0:
-                                encoding.progress = percent
-                                encoding.save(update_fields=["progress", "update_date"])
-                                logger.info(f"Saved {round(percent, 2)}")
-                            n_times += 1
+                        if isinstance(output, float) and total_duration:
+                            # progress goes to the cache, throttled, the Encoding
+                            # row is only updated when the encoding finishes
+                            now = time.monotonic()
+                            if now - last_published >= settings.ENCODING_PROGRESS_INTERVAL:
+                                last_published = now
+                                if not encoding.publish_progress(output * 100 / total_duration):
+                                    raise DatabaseError("encoding was deleted")
                     except DatabaseError:
                         # primary reason for this is that the encoding has been deleted, because
                         # the media file was deleted, or also that there was a trim video request
@@ -426,7 +459,7 @@ def encode_media(
                 encoding.logs = output
                 encoding.status = "fail"
                 try:
-                    encoding.save(update_fields=["status", "logs"])
+                    encoding.save(update_fields=["status", "logs", "progress"])
                 except DatabaseError:
                     return False
                 raise_exception = True
@@ -445,7 +478,7 @@ def encode_media(
         success = False
         encoding.status = "fail"
         if os.path.exists(tf) and os.path.getsize(tf) != 0:
-            ret = media_file_info(tf)
+            ret = media_file_info(tf, checksum=False, use_cache=False)
             if ret.get("is_video") or ret.get("is_audio"):
                 encoding.status = "success"
                 success = True
@@ -466,6 +499,267 @@ def encode_media(
         return success
 
 
+@task(
+    name="encode_media_ladder",
+    base=EncodingTask,
+    bind=True,
+    queue="long_tasks",
+    soft_time_limit=settings.CELERY_SOFT_TIME_LIMIT,
+)
+def encode_media_ladder(
+    self,
+    friendly_token,
+    codec,
+    encodings,
+    force=True,
+    chunk=False,
+    chunk_file_path="",
+):
+    """Encode a media to all resolutions of a codec with a single ffmpeg
+    process, so the source (or chunk) is decoded once for the whole ladder
+
+    encodings is a list of [profile_id, encoding_id]. There is still one
+    Encoding per profile, so the rest of the pipeline works as with encode_media
+    """
+
+    logger.info(f"encode_media_ladder for {friendly_token}/{codec}/{encodings}/{force}/{chunk}")
+    encoding_ids = [encoding_id for profile_id, encoding_id in encodings]
+    try:
+        media = Media.objects.get(friendly_token=friendly_token)
+    except BaseException:
+        Encoding.objects.filter(id__in=encoding_ids).delete()
+        return False
+
+    task_id = self.request.id if self.request.id else None
+    rungs = {}
+    for encoding in Encoding.objects.filter(id__in=encoding_ids).select_related("profile"):
+        duplicates = Encoding.objects.filter(media=media, profile=encoding.profile, chunk=chunk, chunk_file_path=chunk_file_path).exclude(id=encoding.id)
+        if (duplicates.exists() and force is False) or encoding.profile.resolution in rungs:
+            encoding.delete()
+            continue
+        duplicates.delete()
+        rungs[encoding.profile.resolution] = encoding
+
+    if not rungs:
+        logger.info(f"Exiting for {friendly_token}/{codec}/{encodings} since no encodings are left")
+        return False
+
+    if chunk:
+        original_media_path = chunk_file_path
+    else:
+        original_media_path = media.media_file.path
+
+    with tempfile.TemporaryDirectory(dir=settings.TEMP_DIRECTORY) as temp_dir:
+        outputs = {}
+        for resolution, encoding in rungs.items():
+            outputs[resolution] = create_temp_file(suffix=f".{encoding.profile.extension}", dir=temp_dir)
+
+        ffmpeg_command, resolutions = produce_ffmpeg_ladder_command(
+            original_media_path,
+            media.media_info,
+            outputs=list(outputs.items()),
+            codec=codec,
+            chunk=chunk,
+        )
+        if not ffmpeg_command:
+            # eg twopass encoding, that can't share a single process
+            for encoding in rungs.values():
+                enc_url = settings.FRONTEND_URL + encoding.get_absolute_url()
+                encode_media.apply_async(
+                    args=[friendly_token, encoding.profile.id, encoding.id, enc_url],
+                    kwargs={"force": force, "chunk": chunk, "chunk_file_path": chunk_file_path},
+                )
+            return False
+
+        for resolution, encoding in list(rungs.items()):
+            if resolution not in resolutions:
+                # same as encode_media, when there is no command for the profile
+                encoding.status = "fail"
+                encoding.save(update_fields=["status"])
+                del rungs[resolution]
+                continue
+            encoding.status = "running"
+            if task_id:
+                encoding.task_id = task_id
+            encoding.worker = "localhost"
+            encoding.retries = self.request.retries
+            encoding.temp_file = outputs[resolution]
+            encoding.commands = str([ffmpeg_command])
+            encoding.save()
+
+        # binding these, so they are available on on_failure
+        self.encodings = list(rungs.values())
+        self.media = media
+
+        total_duration = min(media.duration, settings.VIDEO_CHUNKS_DURATION) if chunk else media.duration
+        last_published = 0
+        output = ""
+        ffmpeg_command = [str(s) for s in ffmpeg_command]
+        try:
+            for output in FFmpegBackend().encode(ffmpeg_command):
+                if isinstance(output, float) and total_duration:
+                    now = time.monotonic()
+                    if now - last_published >= settings.ENCODING_PROGRESS_INTERVAL:
+                        last_published = now
+                        deleted = [encoding for encoding in rungs.values() if not encoding.publish_progress(output * 100 / total_duration)]
+                        if deleted:
+                            # an encoding of the ladder got deleted, eg media was deleted or trimmed.
+                            # the other rungs are encoded on their own, encode_media exits
+                            # for those that are gone too
+                            kill_ffmpeg_process(deleted[0].temp_file)
+                            for encoding in rungs.values():
+                                if encoding in deleted:
+                                    continue
+                                Encoding.objects.filter(id=encoding.id).update(status="pending", progress=0)
+                                enc_url = settings.FRONTEND_URL + encoding.get_absolute_url()
+                                encode_media.apply_async(
+                                    args=[friendly_token, encoding.profile.id, encoding.id, enc_url],
+                                    kwargs={"force": force, "chunk": chunk, "chunk_file_path": chunk_file_path},
+                                )
+                            return False
+        except Exception as e:
+            output = str(getattr(e, "message", ""))
+            raise_exception = True
+            for encoding in rungs.values():
+                kill_ffmpeg_process(encoding.temp_file)
+                encoding.logs = output
+                encoding.status = "fail"
+                try:
+                    encoding.save(update_fields=["status", "logs", "progress"])
+                except DatabaseError:
+                    raise_exception = False
+            # if this is an ffmpeg's valid error
+            # no need for the task to be re-run
+            for error_msg in ERRORS_LIST:
+                if error_msg.lower() in output.lower():
+                    raise_exception = False
+            if raise_exception:
+                raise self.retry(exc=e, countdown=5, max_retries=1)
+            return False
+
+        success = False
+        for resolution, encoding in rungs.items():
+            tf = outputs[resolution]
+            encoding.logs = output
+            encoding.progress = 100
+            encoding.status = "fail"
+            if os.path.exists(tf) and os.path.getsize(tf) != 0:
+                ret = media_file_info(tf, checksum=False, use_cache=False)
+                if ret.get("is_video") or ret.get("is_audio"):
+                    encoding.status = "success"
+                    success = True
+
+                    with open(tf, "rb") as f:
+                        myfile = File(f)
+                        output_name = f"{get_file_name(original_media_path)}.{encoding.profile.extension}"
+                        encoding.media_file.save(content=myfile, name=output_name)
+                    encoding.total_run_time = (encoding.update_date - encoding.add_date).seconds
+
+            try:
+                encoding.save(update_fields=["status", "logs", "progress", "total_run_time"])
+            # the encoding is deleted when task is revoked
+            except BaseException:
+                pass
+
+        return success
+
+
+@task(name="assemble_chunks", queue="long_tasks", soft_time_limit=60 * 60)
+def assemble_chunks(assembly_id):
+    """Concatenate the encoded chunks of a media/profile into the final
+    Encoding, or record a failed Encoding if any of the chunks failed.
+    Started once per ChunkAssembly, by ChunkAssembly.register_chunk
+    """
+
+    assembly = ChunkAssembly.objects.select_related("media", "profile").filter(id=assembly_id).first()
+    if not assembly:
+        logger.info(f"ChunkAssembly {assembly_id} not found")
+        return False
+
+    media = assembly.media
+    profile = assembly.profile
+    orig_chunks = list(json.loads(assembly.chunks_info).keys())
+    chunks = list(Encoding.objects.filter(media=media, profile=profile, chunks_info=assembly.chunks_info, chunk=True))
+    if not chunks:
+        assembly.delete()
+        return False
+
+    # keep the order in which chunkize_media produced the segments
+    chunks.sort(key=lambda ch: orig_chunks.index(ch.chunk_file_path) if ch.chunk_file_path in orig_chunks else len(orig_chunks))
+
+    encoding = Encoding(media=media, profile=profile, progress=100)
+    workers = list(set([st.worker for st in chunks]))
+    encoding.worker = json.dumps({"workers": workers})
+    start_date = min([st.add_date for st in chunks])
+    end_date = max([st.update_date for st in chunks])
+    encoding.total_run_time = (end_date - start_date).seconds
+    all_logs = "\n".join([st.logs for st in chunks])
+
+    # as ChunkAssembly.register_chunk, distinct successful paths covering
+    # all segments; a retried chunk may have more than one success
+    successful = {}
+    for ch in chunks:
+        if ch.status == "success" and ch.media_file:
+            successful.setdefault(ch.chunk_file_path, ch)
+    complete = all(path in successful for path in orig_chunks)
+    if not complete:
+        chunks_paths = [f.media_file.path for f in chunks if f.media_file]
+        encoding.status = "fail"
+        encoding.logs = f"{chunks_paths}\n{all_logs}"
+        encoding.save()
+        Encoding.objects.filter(media=media, profile=profile).exclude(id=encoding.id).delete()
+        assembly.delete()
+        return False
+
+    chunks_paths = [successful[path].media_file.path for path in orig_chunks]
+    with tempfile.TemporaryDirectory(dir=settings.TEMP_DIRECTORY) as temp_dir:
+        seg_file = create_temp_file(suffix=".txt", dir=temp_dir)
+        tf = create_temp_file(suffix=f".{profile.extension}", dir=temp_dir)
+        with open(seg_file, "w") as ff:
+            for f in chunks_paths:
+                ff.write(f"file {f}\n")
+        cmd = [
+            settings.FFMPEG_COMMAND,
+            "-y",
+            "-f",
+            "concat",
+            "-safe",
+            "0",
+            "-i",
+            seg_file,
+            "-c",
+            "copy",
+            "-pix_fmt",
+            "yuv420p",
+            "-movflags",
+            "faststart",
+            tf,
+        ]
+        stdout = run_command(cmd)
+
+        encoding.status = "success"
+        encoding.logs = f"{chunks_paths}\n{stdout}\n{all_logs}"
+        encoding.save()
+
+        with open(tf, "rb") as f:
+            myfile = File(f)
+            output_name = f"{get_file_name(media.media_file.path)}.{profile.extension}"
+            encoding.media_file.save(content=myfile, name=output_name)
+
+    # encoding is saved, deleting chunks
+    # and any other encoding that might exist
+    Encoding.objects.filter(media=media, profile=profile).exclude(id=encoding.id).delete()
+    if not Encoding.objects.filter(chunks_info=assembly.chunks_info).exists():
+        # source chunks are shared between profiles, remove them
+        # once the last profile is assembled
+        # TODO: in case of remote workers, files should be deleted
+        for chunk in orig_chunks:
+            rm_file(chunk)
+    assembly.delete()
+    media.post_encode_actions()
+    return True
+
+
 @task(name="whisper_transcribe", queue="long_tasks", soft_time_limit=60 * 60 * 2)
 def whisper_transcribe(friendly_token, translate_to_english=False):
     try:
@@ -548,26 +842,32 @@ def produce_sprite_from_video(friendly_token):
         logger.info(f"failed to get media with friendly_token {friendly_token}")
         return False
 
+    if not media.duration:
+        return False
+
     with tempfile.TemporaryDirectory(dir=settings.TEMP_DIRECTORY) as tmpdirname:
         try:
-            tmpdir_image_files = tmpdirname + "/img%03d.jpg"
-            output_name = tmpdirname + "/sprites.jpg"
-
-            fps = getattr(settings, 'SPRITE_NUM_SECS', 10)
-            ffmpeg_cmd = [settings.FFMPEG_COMMAND, "-i", media.media_file.path, "-f", "image2", "-vf", f"fps=1/{fps}, scale=160:90", tmpdir_image_files]  # noqa
-            run_command(ffmpeg_cmd)
-            image_files = [f for f in os.listdir(tmpdirname) if f.startswith("img") and f.endswith(".jpg")]
-            image_files = sorted(image_files, key=lambda x: int(re.search(r'\d+', x).group()))
-            image_files = [os.path.join(tmpdirname, f) for f in image_files]
-            cmd_convert = ["convert", *image_files, "-append", output_name]  # image files, unpacked into the list
-            ret = run_command(cmd_convert)  # noqa
-
-            if os.path.exists(output_name) and get_file_type(output_name) == "image":
-                with open(output_name, "rb") as f:
-                    myfile = File(f)
-                    # SOS: avoid race condition, since this runs for a long time and will replace any other media changes on the meanwhile!!!
-                    media.sprites.save(content=myfile, name=get_file_name(media.media_file.path) + "sprites.jpg", save=False)
-                    media.save(update_fields=["sprites"])
+            interval = getattr(settings, 'SPRITE_NUM_SECS', 10)
+            pages = produce_sprites(media.media_file.path, tmpdirname, media.duration, interval=interval)
+            output_name = os.path.join(tmpdirname, "sprites.jpg")
+
+            if pages:
+                old_sprites_dir = media.sprites_dir
+                # without a single column the sprites file is left as is,
+                # players get the pages and track only
+                if os.path.exists(output_name) and get_file_type(output_name) == "image":
+                    with open(output_name, "rb") as f:
+                        myfile = File(f)
+                        # SOS: avoid race condition, since this runs for a long time and will replace any other media changes on the meanwhile!!!
+                        media.sprites.save(content=myfile, name=get_file_name(media.media_file.path) + "sprites.jpg", save=False)
+                        media.save(update_fields=["sprites"])
+
+                # sprite sheet pages and thumbnails track, next to the sprites file
+                if old_sprites_dir:
+                    rm_dir(old_sprites_dir)
+                os.makedirs(media.sprites_dir, exist_ok=True)
+                for page in pages + [os.path.join(tmpdirname, "sprites.vtt")]:
+                    shutil.move(page, media.sprites_dir)
 
         except Exception as e:
             print(e)
@@ -575,8 +875,14 @@ def produce_sprite_from_video(friendly_token):
 
 
 @task(name="create_hls", queue="long_tasks")
-def create_hls(friendly_token):
-    """Creates HLS file for media, uses Bento4 mp4hls command"""
+def create_hls(friendly_token, rerun=False):
+    """Creates HLS file for media, uses Bento4 mp4hls command
+
+    Each h264 encoding is packaged on its own, once, and the master
+    playlist is rewritten to include all of them. Runs for the same
+    media do not overlap, a run that finds another one running is
+    scheduled again for after it
+    """
 
     if not hasattr(settings, "MP4HLS_COMMAND"):
         logger.info("Bento4 mp4hls command is missing from configuration")
@@ -592,35 +898,67 @@ def create_hls(friendly_token):
         logger.info(f"failed to get media with friendly_token {friendly_token}")
         return False
 
-    p = media.uid.hex
-    output_dir = os.path.join(settings.HLS_DIR, p)
-    encodings = media.encodings.filter(profile__extension="mp4", status="success", chunk=False, profile__codec="h264")
+    lock_key = f"create_hls_lock:{media.id}"
+    rerun_key = f"create_hls_rerun:{media.id}"
+    if rerun:
+        cache.delete(rerun_key)
+    if not cache.add(lock_key, 1, HLS_LOCK_TIMEOUT):
+        # renditions completed meanwhile are packaged by a single later run
+        if cache.add(rerun_key, 1, HLS_LOCK_TIMEOUT):
+            create_hls.apply_async(args=[friendly_token], kwargs={"rerun": True}, countdown=30)
+        return False
 
-    if encodings:
-        existing_output_dir = None
-        if os.path.exists(output_dir):
-            existing_output_dir = output_dir
-            output_dir = os.path.join(settings.HLS_DIR, p + produce_friendly_token())
-        files = [f.media_file.path for f in encodings if f.media_file]
-        cmd = [settings.MP4HLS_COMMAND, '--segment-duration=4', f'--output-dir={output_dir}', *files]
-        run_command(cmd)
-
-        if existing_output_dir:
-            # override content with -T !
-            cmd = ["cp", "-rT", output_dir, existing_output_dir]
-            run_command(cmd)
+    try:
+        return _create_hls(media)
+    finally:
+        cache.delete(lock_key)
 
-            try:
-                shutil.rmtree(output_dir)
-            except:  # noqa
-                # this was breaking in some cases where it was already deleted
-                # because create_hls was running multiple times
-                pass
-            output_dir = existing_output_dir
-        pp = os.path.join(output_dir, "master.m3u8")
-        if os.path.exists(pp):
-            if media.hls_file != pp:
-                Media.objects.filter(pk=media.pk).update(hls_file=pp)
+
+def _create_hls(media):
+    output_dir = os.path.join(settings.HLS_DIR, media.uid.hex)
+    encodings = media.encodings.filter(profile__extension="mp4", status="success", chunk=False, profile__codec="h264").select_related("profile").order_by("profile__resolution")
+    encodings = [e for e in encodings if e.media_file and os.path.exists(e.media_file.path)]
+    if not encodings:
+        return True
+
+    os.makedirs(output_dir, exist_ok=True)
+    state_file = os.path.join(output_dir, "renditions.json")
+    try:
+        with open(state_file) as f:
+            packaged = json.load(f)
+    except (OSError, ValueError):
+        packaged = {}
+
+    renditions = {}
+    changed = False
+    for encoding in encodings:
+        rendition = f"profile-{encoding.profile.id}"
+        signature = file_signature(encoding.media_file.path)
+        if packaged.get(rendition) != signature or not os.path.exists(os.path.join(output_dir, rendition, "master.m3u8")):
+            if not package_hls_rendition(encoding.media_file.path, os.path.join(output_dir, rendition)):
+                logger.info(f"failed to package encoding {encoding.id} to HLS")
+                continue
+            changed = True
+        renditions[rendition] = signature
+
+    if not renditions:
+        return False
+
+    master_file = os.path.join(output_dir, "master.m3u8")
+    if changed or set(renditions) != set(packaged) or not os.path.exists(master_file):
+        changed = True
+        write_hls_master(output_dir, list(renditions))
+        with open(state_file, "w") as f:
+            json.dump(renditions, f)
+        # renditions of deleted encodings, or a layout packaged all at once
+        for name in os.listdir(output_dir):
+            if name not in renditions and name not in ("master.m3u8", "renditions.json"):
+                path = os.path.join(output_dir, name)
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+
+    if changed or media.hls_file != master_file or media.hls_renditions is None:
+        Media.objects.filter(pk=media.pk).update(hls_file=master_file, hls_renditions=media.parse_hls_info(master_file))
     return True
 
 
@@ -779,12 +1117,10 @@ def save_user_action(user_or_session, friendly_token=None, action="watch", extra
             remote_ip=remote_ip,
         ):
             return False
+        if action == "watch" and not counters.allow_watch(media, user.id if user else None, session_key, remote_ip):
+            # watched recently, but not flushed to the database yet
+            return False
 
-    if action == "watch":
-        if user:
-            MediaAction.objects.filter(user=user, media=media, action="watch").delete()
-        else:
-            MediaAction.objects.filter(session_key=session_key, media=media, action="watch").delete()
     if action == "rate":
         try:
             score = extra_info.get("score")
@@ -817,16 +1153,15 @@ def save_user_action(user_or_session, friendly_token=None, action="watch", extra
         extra_info=extra_info,
         remote_ip=remote_ip,
     )
-    ma.save()
-
-    if action == "watch":
-        media.views += 1
-        Media.objects.filter(friendly_token=friendly_token).update(views=media.views)
+    if action in counters.COUNTER_FIELDS:
+        # views/likes/dislikes are updated without calling save, to avoid
+        # post_save signals being triggered, and written behind in batches
+        counters.record_action(ma)
+        return True
 
-        # update field without calling save, to avoid post_save signals being triggered
-        # same in other actions
+    ma.save()
 
-    elif action == "report":
+    if action == "report":
         media.reported_times += 1
 
         if media.reported_times >= settings.REPORTED_TIMES_THRESHOLD:
@@ -838,16 +1173,46 @@ def save_user_action(user_or_session, friendly_token=None, action="watch", extra
             action="media_reported",
             extra=extra_info,
         )
-    elif action == "like":
-        media.likes += 1
-        Media.objects.filter(friendly_token=friendly_token).update(likes=media.likes)
-    elif action == "dislike":
-        media.dislikes += 1
-        Media.objects.filter(friendly_token=friendly_token).update(dislikes=media.dislikes)
 
     return True
 
 
+@task(name="flush_media_counters", queue="short_tasks")
+def flush_media_counters():
+    """Write the views/likes/dislikes counters and watch actions
+    kept by apps.files.counters to the database
+    """
+
+    flushed = counters.flush()
+    if flushed:
+        logger.info(f"flushed counters of {flushed} media")
+    return True
+
+
+@task(name="rebuild_media_title_index", queue="long_tasks")
+def rebuild_media_title_index():
+    """Index the titles of all listable media for search suggestions,
+    the index is also updated as media are saved/deleted
+    """
+
+    indexed = suggestions.rebuild()
+    logger.info(f"indexed titles of {indexed} media")
+    return True
+
+
+@task(name="update_media_related", queue="short_tasks")
+def update_media_related(media_id):
+    """Update user/category/tag media counts and the search vector
+    of a media, scheduled by Media.schedule_update_related
+    """
+
+    media = Media.objects.filter(id=media_id).first()
+    if not media:
+        return False
+    media.update_related()
+    return True
+
+
 @task(name="get_list_of_popular_media", queue="long_tasks")
 def get_list_of_popular_media():
     """Experimental task for preparing media listing
@@ -857,28 +1222,24 @@ def get_list_of_popular_media():
     Y = the most recent 25 videos that have been liked over the last 6 months
     """
 
-    valid_media_x = {}
-    valid_media_y = {}
-    basic_query = Q(listable=True)
-    media_x = Media.objects.filter(basic_query).values("friendly_token")
-
     period_x = datetime.now() - timedelta(days=7)
     period_y = datetime.now() - timedelta(days=30 * 6)
 
-    for media in media_x:
-        ft = media["friendly_token"]
-        num = MediaAction.objects.filter(action_date__gte=period_x, action="watch", media__friendly_token=ft).count()
-        if num:
-            valid_media_x[ft] = num
-        num = MediaAction.objects.filter(action_date__gte=period_y, action="like", media__friendly_token=ft).count()
-        if num:
-            valid_media_y[ft] = num
+    # a single GROUP BY media query per rule, instead of two count
+    # queries per listable media
+    def top_media(action, since, limit=25):
+        return (
+            MediaAction.objects.filter(action=action, action_date__gte=since, media__listable=True)
+            .values("media__friendly_token")
+            .annotate(num=Count("id"))
+            .order_by("-num")[:limit]
+        )
 
-    x = sorted(valid_media_x.items(), key=lambda kv: kv[1], reverse=True)[:25]
-    y = sorted(valid_media_y.items(), key=lambda kv: kv[1], reverse=True)[:25]
+    x = top_media("watch", period_x)
+    y = top_media("like", period_y)
 
-    media_ids = [a[0] for a in x]
-    media_ids.extend([a[0] for a in y])
+    media_ids = [a["media__friendly_token"] for a in x]
+    media_ids.extend([a["media__friendly_token"] for a in y])
     media_ids = list(set(media_ids))
     cache.set("popular_media_ids", media_ids, 60 * 60 * 12)
     logger.info("saved popular media ids")
@@ -1032,49 +1393,43 @@ def video_trim_task(self, trim_request_id):
 
     if proceed_with_single_file:
         if trim_request.video_action == "save_new" or trim_request.video_action == "create_segments" and len(timestamps_encodings) == 1:
-            new_media = copy_video(original_media, copy_encodings=True)
+            # the files of the new media are trimmed straight from the original ones
+            new_media = copy_video(original_media, copy_encodings=True, timestamps_original=timestamps_original, timestamps_encodings=timestamps_encodings)
 
             target_media = new_media
             trim_request.media = new_media
             trim_request.save(update_fields=["media"])
 
-        # processing timestamps differently on encodings and original file, in case we do accuracy trimming (currently not)
-        # these have different I-frames and the cut is made based on the I-frames
+            deleted_encodings = handle_pending_running_encodings(target_media)
+        else:
+            # processing timestamps differently on encodings and original file, in case we do accuracy trimming (currently not)
+            # these have different I-frames and the cut is made based on the I-frames
 
-        original_trim_result = trim_video_method(target_media.media_file.path, timestamps_original)
-        if not original_trim_result:
-            logger.info(f"Failed to trim original file for media {target_media.friendly_token}")
+            original_trim_result = trim_video_method(target_media.media_file.path, timestamps_original)
+            if not original_trim_result:
+                logger.info(f"Failed to trim original file for media {target_media.friendly_token}")
 
-        deleted_encodings = handle_pending_running_encodings(target_media)
-        # the following could be un-necessary, read commend in pre_trim_video_actions to see why
-        encodings = target_media.encodings.filter(status="success", profile__extension='mp4', chunk=False)
-        for encoding in encodings:
-            trim_result = trim_video_method(encoding.media_file.path, timestamps_encodings)
-            if not trim_result:
-                logger.info(f"Failed to trim encoding {encoding.id} for media {target_media.friendly_token}")
-                encoding.delete()
+            deleted_encodings = handle_pending_running_encodings(target_media)
+            # the following could be un-necessary, read commend in pre_trim_video_actions to see why
+            encodings = target_media.encodings.filter(status="success", profile__extension='mp4', chunk=False)
+            for encoding in encodings:
+                trim_result = trim_video_method(encoding.media_file.path, timestamps_encodings)
+                if not trim_result:
+                    logger.info(f"Failed to trim encoding {encoding.id} for media {target_media.friendly_token}")
+                    encoding.delete()
 
         pre_trim_video_actions(target_media)
         post_trim_action.delay(target_media.friendly_token)
 
     else:
         for i, timestamp in enumerate(timestamps_encodings, start=1):
-            # copy the original file for each of the segments. This could be optimized to avoid the overhead but
-            # for now is necessary because the ffmpeg trim command will be run towards the original
-            # file on different times.
-            target_media = copy_video(original_media, title_suffix=f"(Trimmed) {i}", copy_encodings=True)
+            # each segment is written straight from the original files, so the cost
+            # depends on the segment length and not on the size of the original
+            target_media = copy_video(original_media, title_suffix=f"(Trimmed) {i}", copy_encodings=True, timestamps_original=[timestamp], timestamps_encodings=[timestamp])
 
             video_trim_request = VideoTrimRequest.objects.create(media=target_media, status="running", video_action="create_segments", media_trim_style='no_encoding', timestamps=[timestamp])  # noqa
 
-            original_trim_result = trim_video_method(target_media.media_file.path, [timestamp])
             deleted_encodings = handle_pending_running_encodings(target_media)  # noqa
-            # the following could be un-necessary, read commend in pre_trim_video_actions to see why
-            encodings = target_media.encodings.filter(status="success", profile__extension='mp4', chunk=False)
-            for encoding in encodings:
-                trim_result = trim_video_method(encoding.media_file.path, [timestamp])
-                if not trim_result:
-                    logger.info(f"Failed to trim encoding {encoding.id} for media {target_media.friendly_token}")
-                    encoding.delete()
 
             pre_trim_video_actions(target_media)
             post_trim_action.delay(target_media.friendly_token)
@@ -23,6 +23,26 @@ class EncodingDetail(APIView):
     permission_classes = (permissions.IsAdminUser,)
     parser_classes = (JSONParser, MultiPartParser, FormParser, FileUploadParser)
 
+    @swagger_auto_schema(auto_schema=None)
+    def get(self, request, encoding_id):
+        """Status and live progress of an encoding
+        Progress of running encodings is read from the cache
+        """
+        encoding = Encoding.objects.filter(id=encoding_id).first()
+        if not encoding:
+            return Response(
+                {"detail": "encoding does not exist"},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+        ret = {
+            "encoding_id": encoding.id,
+            "status": encoding.status,
+            "progress": encoding.live_progress,
+            "chunk": encoding.chunk,
+            "size": encoding.size,
+        }
+        return Response(ret)
+
     @swagger_auto_schema(auto_schema=None)
     def post(self, request, encoding_id):
         ret = {}
@@ -1,8 +1,10 @@
 from datetime import datetime, timedelta
 
 from django.conf import settings
-from django.contrib.postgres.search import SearchQuery
-from django.db.models import Count, Q
+from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramWordSimilarity
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, F, Q
 from django.shortcuts import get_object_or_404
 from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
@@ -19,14 +21,18 @@ from rest_framework.settings import api_settings
 from rest_framework.views import APIView
 
 # from apps.actions.models import MediaAction
-from config.custom_pagination import FastPaginationWithoutCount
+from config.custom_pagination import FastPaginationWithoutCount, MediaCursorPagination
 from config.permissions import IsAuthorizedToAdd, IsUserOrEditor
 from apps.users.models import User, MediaAction
 
 from .. import helpers
 from ..methods import (
+    bump_media_access_version,
+    bump_media_list_version,
     change_media_owner,
     copy_media,
+    get_media_list_cache_key,
+    get_shared_media_filter,
     get_user_or_session,
     is_mediacms_editor,
     show_recommended_media,
@@ -43,7 +49,9 @@ from ..models import (
     Tag,
 )
 from ..serializers import MediaSearchSerializer, MediaSerializer, SingleMediaSerializer
+from ..models.media import schedule_update_related
 from ..stop_words import STOP_WORDS
+from ..suggestions import suggest_titles
 from ..tasks import save_user_action
 
 
@@ -53,17 +61,6 @@ class MediaList(APIView):
     permission_classes = (IsAuthorizedToAdd,)
     parser_classes = (MultiPartParser, FormParser, FileUploadParser)
 
-    @swagger_auto_schema(
-        manual_parameters=[
-            openapi.Parameter(name='page', type=openapi.TYPE_INTEGER, in_=openapi.IN_QUERY, description='Page number'),
-            openapi.Parameter(name='author', type=openapi.TYPE_STRING, in_=openapi.IN_QUERY, description='username'),
-            openapi.Parameter(name='show', type=openapi.TYPE_STRING, in_=openapi.IN_QUERY, description='show', enum=['recommended', 'featured', 'latest']),
-        ],
-        tags=['Media'],
-        operation_summary='List Media',
-        operation_description='Lists all media',
-        responses={200: MediaSerializer(many=True)},
-    )
     def _get_media_queryset(self, request, user=None):
         base_filters = Q(listable=True)
         if user:
@@ -74,27 +71,24 @@ class MediaList(APIView):
         if not request.user.is_authenticated:
             return base_queryset.filter(base_filters)
 
-        conditions = base_filters
-
-        permission_filter = {'user': request.user}
+        # media shared with the user, through permissions or RBAC categories
+        shared_conditions = get_shared_media_filter(request.user)
         if user:
-            permission_filter['owner_user'] = user
-
-        if MediaPermission.objects.filter(**permission_filter).exists():
-            perm_conditions = Q(permissions__user=request.user)
-            if user:
-                perm_conditions &= Q(user=user)
-            conditions |= perm_conditions
-
-        if getattr(settings, 'USE_RBAC', False):
-            rbac_categories = request.user.get_rbac_categories_as_member()
-            rbac_conditions = Q(category__in=rbac_categories)
-            if user:
-                rbac_conditions &= Q(user=user)
-            conditions |= rbac_conditions
-
-        return base_queryset.filter(conditions).distinct()
+            shared_conditions &= Q(user=user)
+        return base_queryset.filter(base_filters | shared_conditions)
 
+    @swagger_auto_schema(
+        manual_parameters=[
+            openapi.Parameter(name='page', type=openapi.TYPE_INTEGER, in_=openapi.IN_QUERY, description='Page number'),
+            openapi.Parameter(name='author', type=openapi.TYPE_STRING, in_=openapi.IN_QUERY, description='username'),
+            openapi.Parameter(name='show', type=openapi.TYPE_STRING, in_=openapi.IN_QUERY, description='show', enum=['recommended', 'featured', 'latest']),
+            openapi.Parameter(name='pagination', type=openapi.TYPE_STRING, in_=openapi.IN_QUERY, description='cursor, for keyset pagination through cursor links', enum=['cursor']),
+        ],
+        tags=['Media'],
+        operation_summary='List Media',
+        operation_description='Lists all media',
+        responses={200: MediaSerializer(many=True)},
+    )
     def get(self, request, format=None):
         # authenticated users can see:
 
@@ -104,6 +98,16 @@ class MediaList(APIView):
 
         params = self.request.query_params
         show_param = params.get("show", "")
+
+        # listings are the same for all anonymous users,
+        # except recommended which is shuffled
+        cache_key = None
+        if request.user.is_anonymous and show_param != "recommended":
+            cache_key = get_media_list_cache_key(request)
+            data = cache.get(cache_key)
+            if data is not None:
+                return Response(data)
+
         author_param = params.get("author", "").strip()
         tag = params.get("t", "").strip()
         ordering = params.get("ordering", "").strip()
@@ -169,16 +173,7 @@ class MediaList(APIView):
             if not self.request.user.is_authenticated:
                 media = Media.objects.none()
             else:
-                base_queryset = Media.objects.prefetch_related("user", "tags")
-
-                # Build OR conditions similar to _get_media_queryset
-                conditions = Q(permissions__user=request.user)
-
-                if getattr(settings, 'USE_RBAC', False):
-                    rbac_categories = request.user.get_rbac_categories_as_member()
-                    conditions |= Q(category__in=rbac_categories)
-
-                media = base_queryset.filter(conditions).distinct()
+                media = Media.objects.filter(get_shared_media_filter(request.user)).prefetch_related("user", "tags")
         elif author_param:
             user_queryset = User.objects.all()
             user = get_object_or_404(user_queryset, username=author_param)
@@ -229,12 +224,16 @@ class MediaList(APIView):
         if publish_state and publish_state in ['private', 'public', 'unlisted']:
             media = media.filter(state=publish_state)
 
-        if not already_sorted:
-            media = media.order_by(f"{ordering}{sort_by}")
+        if params.get("pagination") == "cursor" and show_param != "recommended":
+            # keyset pagination orders the queryset itself, and is not limited to 1000 results
+            paginator = MediaCursorPagination(sort_by, ordering)
+        else:
+            if not already_sorted:
+                media = media.order_by(f"{ordering}{sort_by}")
 
-        media = media[:1000]
+            media = media[:1000]
 
-        paginator = pagination_class()
+            paginator = pagination_class()
 
         page = paginator.paginate_queryset(media, request)
 
@@ -248,6 +247,8 @@ class MediaList(APIView):
 
         response = paginator.get_paginated_response(serializer.data)
         response.data['tags'] = tags
+        if cache_key:
+            cache.set(cache_key, response.data, settings.MEDIA_LIST_CACHE_TIMEOUT)
         return response
 
     @swagger_auto_schema(
@@ -278,6 +279,36 @@ class MediaBulkUserActions(APIView):
     permission_classes = (permissions.IsAuthenticated,)
     parser_classes = (JSONParser,)
 
+    def _add_relations(self, through, field, media_ids, objects):
+        """Add objects (categories, tags) to media with one insert,
+        returns the number of relations added
+        """
+
+        pairs = {(media_id, obj.id) for media_id in media_ids for obj in objects}
+        pairs -= set(through.objects.filter(media_id__in=media_ids, **{f"{field}__in": [obj.id for obj in objects]}).values_list("media_id", field))
+        through.objects.bulk_create([through(media_id=media_id, **{field: obj_id}) for media_id, obj_id in pairs], ignore_conflicts=True)
+        return len(pairs)
+
+    def _media_changed(self, media_ids, categories=(), tags=(), users=()):
+        """Media signals are not sent by set based changes, so counts,
+        caches and search vectors are refreshed here, once, after commit
+        """
+
+        def refresh():
+            bump_media_list_version()
+            if any(category.is_rbac_category for category in categories):
+                bump_media_access_version()
+            for category in categories:
+                category.update_category_media()
+            for tag in tags:
+                tag.update_tag_media()
+            for user in users:
+                user.update_user_media()
+
+        transaction.on_commit(refresh)
+        # update_related also recounts the media of the (new) owner
+        schedule_update_related(media_ids)
+
     @swagger_auto_schema(
         request_body=openapi.Schema(
             type=openapi.TYPE_OBJECT,
@@ -348,6 +379,7 @@ class MediaBulkUserActions(APIView):
             401: 'Not authenticated',
         },
     )
+    @transaction.atomic
     def post(self, request, format=None):
         if not request.user.is_authenticated:
             return Response({"detail": "Authentication required"}, status=status.HTTP_401_UNAUTHORIZED)
@@ -361,9 +393,11 @@ class MediaBulkUserActions(APIView):
         if not action:
             return Response({"detail": "action is required"}, status=status.HTTP_400_BAD_REQUEST)
 
-        media = Media.objects.filter(user=request.user, friendly_token__in=media_ids)
+        # by id, so that the selection stays the same after changing the owner
+        media_ids = list(Media.objects.filter(user=request.user, friendly_token__in=media_ids).values_list("id", flat=True))
+        media = Media.objects.filter(id__in=media_ids)
 
-        if not media:
+        if not media_ids:
             return Response({"detail": "No matching media found"}, status=status.HTTP_400_BAD_REQUEST)
 
         if action == "enable_comments":
@@ -397,17 +431,17 @@ class MediaBulkUserActions(APIView):
                 return Response({"detail": "No matching playlists found"}, status=status.HTTP_400_BAD_REQUEST)
 
             added_count = 0
-            for playlist in playlists:
-                for m in media:
-                    media_in_playlist = PlaylistMedia.objects.filter(playlist=playlist).count()
-                    if media_in_playlist < settings.MAX_MEDIA_PER_PLAYLIST:
-                        obj, created = PlaylistMedia.objects.get_or_create(
-                            playlist=playlist,
-                            media=m,
-                            ordering=media_in_playlist + 1,
-                        )
-                        if created:
-                            added_count += 1
+            # locked, so concurrent additions don't exceed the limit or repeat orderings
+            for playlist in playlists.select_for_update():
+                media_in_playlist = PlaylistMedia.objects.filter(playlist=playlist).count()
+                existing = set(PlaylistMedia.objects.filter(playlist=playlist, media_id__in=media_ids).values_list("media_id", flat=True))
+                new_media_ids = [media_id for media_id in media_ids if media_id not in existing]
+                new_media_ids = new_media_ids[: max(0, settings.MAX_MEDIA_PER_PLAYLIST - media_in_playlist)]
+                PlaylistMedia.objects.bulk_create(
+                    [PlaylistMedia(playlist=playlist, media_id=media_id, ordering=media_in_playlist + i + 1) for i, media_id in enumerate(new_media_ids)],
+                    ignore_conflicts=True,
+                )
+                added_count += len(new_media_ids)
 
             return Response({"detail": f"Added {added_count} media items to {playlists.count()} playlists"})
 
@@ -440,16 +474,13 @@ class MediaBulkUserActions(APIView):
                 if state == "public":
                     return Response({"detail": "You are not allowed to set media to public state"}, status=status.HTTP_400_BAD_REQUEST)
 
-            for m in media:
-                m.state = state
-                if m.state == "public" and m.encoding_status == "success" and m.is_reviewed is True:
-                    m.listable = True
-                else:
-                    m.listable = False
-
-                m.save(update_fields=["state", "listable"])
+            # same listable condition as Media.save
+            media.update(state=state, listable=False)
+            if state == "public":
+                media.filter(encoding_status="success", is_reviewed=True).update(listable=True)
+            self._media_changed(media_ids, users=[request.user])
 
-            return Response({"detail": f"State updated to {state} for {media.count()} media items"})
+            return Response({"detail": f"State updated to {state} for {len(media_ids)} media items"})
 
         elif action == "change_owner":
             owner = request.data.get('owner')
@@ -460,11 +491,8 @@ class MediaBulkUserActions(APIView):
             if not new_user:
                 return Response({"detail": "User not found"}, status=status.HTTP_400_BAD_REQUEST)
 
-            changed_count = 0
-            for m in media:
-                result = change_media_owner(m.id, new_user)
-                if result:
-                    changed_count += 1
+            changed_count = change_media_owner(media_ids, new_user)
+            self._media_changed(media_ids, users=[request.user])
 
             return Response({"detail": f"Owner changed for {changed_count} media items"})
 
@@ -513,10 +541,15 @@ class MediaBulkUserActions(APIView):
             if not users.exists():
                 return Response({"detail": "No valid users found"}, status=status.HTTP_400_BAD_REQUEST)
 
-            for m in media:
-                for user in users:
-                    # Create or update MediaPermission
-                    MediaPermission.objects.update_or_create(user=user, media=m, defaults={'owner_user': request.user, 'permission': ownership_type})
+            # Create or update MediaPermission
+            MediaPermission.objects.bulk_create(
+                [MediaPermission(user=user, media_id=media_id, owner_user=request.user, permission=ownership_type) for media_id in media_ids for user in users],
+                update_conflicts=True,
+                unique_fields=["user", "media"],
+                update_fields=["owner_user", "permission"],
+            )
+            for user in users:
+                bump_media_access_version(user)
 
             return Response({"detail": "Action succeeded"})
 
@@ -576,12 +609,8 @@ class MediaBulkUserActions(APIView):
             if not categories:
                 return Response({"detail": "No matching categories found"}, status=status.HTTP_400_BAD_REQUEST)
 
-            added_count = 0
-            for category in categories:
-                for m in media:
-                    if not m.category.filter(uid=category.uid).exists():
-                        m.category.add(category)
-                        added_count += 1
+            added_count = self._add_relations(Media.category.through, "category_id", media_ids, categories)
+            self._media_changed(media_ids, categories=categories)
 
             return Response({"detail": f"Added {added_count} media items to {categories.count()} categories"})
 
@@ -594,12 +623,8 @@ class MediaBulkUserActions(APIView):
             if not categories:
                 return Response({"detail": "No matching categories found"}, status=status.HTTP_400_BAD_REQUEST)
 
-            removed_count = 0
-            for category in categories:
-                for m in media:
-                    if m.category.filter(uid=category.uid).exists():
-                        m.category.remove(category)
-                        removed_count += 1
+            removed_count = Media.category.through.objects.filter(media_id__in=media_ids, category__in=categories).delete()[0]
+            self._media_changed(media_ids, categories=categories)
 
             return Response({"detail": f"Removed {removed_count} media items from {categories.count()} categories"})
 
@@ -612,12 +637,8 @@ class MediaBulkUserActions(APIView):
             if not tags:
                 return Response({"detail": "No matching tags found"}, status=status.HTTP_400_BAD_REQUEST)
 
-            added_count = 0
-            for tag in tags:
-                for m in media:
-                    if not m.tags.filter(title=tag.title).exists():
-                        m.tags.add(tag)
-                        added_count += 1
+            added_count = self._add_relations(Media.tags.through, "tag_id", media_ids, tags)
+            self._media_changed(media_ids, tags=tags)
 
             return Response({"detail": f"Added {added_count} media items to {tags.count()} tags"})
 
@@ -630,12 +651,8 @@ class MediaBulkUserActions(APIView):
             if not tags:
                 return Response({"detail": "No matching tags found"}, status=status.HTTP_400_BAD_REQUEST)
 
-            removed_count = 0
-            for tag in tags:
-                for m in media:
-                    if m.tags.filter(title=tag.title).exists():
-                        m.tags.remove(tag)
-                        removed_count += 1
+            removed_count = Media.tags.through.objects.filter(media_id__in=media_ids, tag__in=tags).delete()[0]
+            self._media_changed(media_ids, tags=tags)
 
             return Response({"detail": f"Removed {removed_count} media items from {tags.count()} tags"})
 
@@ -946,6 +963,18 @@ class MediaSearch(APIView):
 
     parser_classes = (JSONParser,)
 
+    def _sees_listable_only(self, request):
+        """Whether search results for the user are the listable media,
+        as for anonymous users
+        """
+
+        user = request.user
+        if not user.is_authenticated:
+            return True
+        if is_mediacms_editor(user):
+            return False
+        return not Media.objects.filter(Q(user=user) | get_shared_media_filter(user), listable=False).exists()
+
     @swagger_auto_schema(
         manual_parameters=[],
         tags=['Search'],
@@ -993,25 +1022,28 @@ class MediaSearch(APIView):
             ret = {}
             return Response(ret, status=status.HTTP_200_OK)
 
+        if params.get("show", "").strip() == "titles" and query and not (category or tag or media_type or author or upload_date) and self._sees_listable_only(request):
+            titles = suggest_titles(query)
+            if titles is not None:
+                return Response(titles, status=status.HTTP_200_OK)
+
         if request.user.is_authenticated:
             if is_mediacms_editor(self.request.user):
                 media = Media.objects.prefetch_related("user", "tags")
                 basic_query = Q()
             else:
-                basic_query = Q(listable=True) | Q(permissions__user=request.user) | Q(user=request.user)
-
-                if getattr(settings, 'USE_RBAC', False):
-                    rbac_categories = request.user.get_rbac_categories_as_member()
-                    basic_query |= Q(category__in=rbac_categories)
+                basic_query = Q(listable=True) | Q(user=request.user) | get_shared_media_filter(request.user)
 
         else:
             basic_query = Q(listable=True)
 
-        media = Media.objects.filter(basic_query).distinct()
+        media = Media.objects.filter(basic_query)
 
+        title_query = ""
         if query:
             # move this processing to a prepare_query function
             query = helpers.clean_query(query)
+            title_query = query
             q_parts = [q_part.rstrip("y") for q_part in query.split() if q_part not in STOP_WORDS]
             if q_parts:
                 query = SearchQuery(q_parts[0] + ":*", search_type="raw")
@@ -1019,14 +1051,13 @@ class MediaSearch(APIView):
                     query &= SearchQuery(part + ":*", search_type="raw")
             else:
                 query = None
-        if query:
-            media = media.filter(search=query)
 
         if tag:
             media = media.filter(tags__title=tag)
 
         if category:
-            media = media.filter(category__title__contains=category)
+            # a media can be in more than one matching category
+            media = media.filter(category__title__contains=category).distinct()
 
         if media_type:
             media = media.filter(media_type=media_type)
@@ -1050,12 +1081,43 @@ class MediaSearch(APIView):
             if gte:
                 media = media.filter(add_date__gte=gte)
 
-        media = media.order_by(f"{ordering}{sort_by}")
+        # the media that pass all filters but the search query,
+        # for the typo tolerant titles fallback
+        filtered_media = media
+        # results are ordered by relevance, unless a sort is requested
+        by_relevance = bool(query) and not params.get("sort_by", "").strip()
+        if query:
+            media = media.filter(search=query)
+            if by_relevance:
+                media = media.annotate(rank=SearchRank(F("search"), query))
 
         if self.request.query_params.get("show", "").strip() == "titles":
-            media = media.values("title")[:40]
-            return Response(media, status=status.HTTP_200_OK)
+            if by_relevance:
+                titles = list(media.order_by("-rank", "-add_date").values("title")[:40])
+            else:
+                titles = list(media.order_by(f"{ordering}{sort_by}").values("title")[:40])
+            if not titles and title_query:
+                # no prefix matches, probably a typo
+                titles = list(
+                    filtered_media.filter(title__trigram_word_similar=title_query)
+                    .annotate(similarity=TrigramWordSimilarity(title_query, "title"))
+                    .order_by("-similarity")
+                    .values("title")[:40]
+                )
+            return Response(titles, status=status.HTTP_200_OK)
+        elif params.get("pagination") == "cursor":
+            if by_relevance:
+                # a relevance rank is no stable key to continue from
+                return Response({"detail": "pagination=cursor requires sort_by when searching with q"}, status=status.HTTP_400_BAD_REQUEST)
+            paginator = MediaCursorPagination(sort_by, ordering)
+            page = paginator.paginate_queryset(media.prefetch_related("user"), request)
+            serializer = MediaSearchSerializer(page, many=True, context={"request": request})
+            return paginator.get_paginated_response(serializer.data)
         else:
+            if by_relevance:
+                media = media.order_by("-rank", "-add_date")
+            else:
+                media = media.order_by(f"{ordering}{sort_by}")
             media = media.prefetch_related("user")[:1000]  # limit to 1000 results
 
             if category or tag:
@@ -6,3 +6,5 @@ class UsersConfig(AppConfig):
 
     def ready(self):
         from . import signals  # Ensure signals are registered
+
+        signals.connect_rbac_signals()
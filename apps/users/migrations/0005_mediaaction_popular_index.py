@@ -0,0 +1,17 @@
+# Generated by Django 5.2.8 on 2026-10-18 12:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0004_mediaaction'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='mediaaction',
+            index=models.Index(fields=['action', 'action_date', 'media'], name='users_media_action_790c14_idx'),
+        ),
+    ]
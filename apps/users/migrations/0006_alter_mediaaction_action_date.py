@@ -0,0 +1,19 @@
+# Generated by Django 5.2.8 on 2026-10-18 18:10
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0005_mediaaction_popular_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='mediaaction',
+            name='action_date',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
@@ -1,8 +1,10 @@
 from django.conf import settings
+from django.core.cache import cache
 from django.contrib.auth.models import AbstractUser
 from django.db import models
 from django.urls import reverse
 from django.utils import timezone
+from django.utils.functional import cached_property
 from django.utils.html import strip_tags
 from imagekit.models import ProcessedImageField
 from imagekit.processors import ResizeToFill
@@ -113,91 +115,55 @@ class User(AbstractUser):
 
     def get_user_rbac_groups(self):
         """Get all RBAC groups the user belongs to"""
+        RBACGroup = helpers.get_rbac_model("RBACGroup")
+        if RBACGroup is None:
+            return []
         return RBACGroup.objects.filter(memberships__user=self)
 
     def get_rbac_categories_as_member(self):
         """
         Get all categories related to RBAC groups the user belongs to
         """
+        RBACGroup = helpers.get_rbac_model("RBACGroup")
+        if RBACGroup is None:
+            return Category.objects.none()
         rbac_groups = RBACGroup.objects.filter(memberships__user=self,
                                                memberships__role__in=["member", "contributor", "manager"])
         categories = Category.objects.prefetch_related("user").filter(rbac_groups__in=rbac_groups).distinct()
         return categories
 
     def has_member_access_to_category(self, category):
+        RBACGroup = helpers.get_rbac_model("RBACGroup")
+        if RBACGroup is None:
+            return False
         rbac_groups = RBACGroup.objects.filter(memberships__user=self,
                                                memberships__role__in=["member", "contributor", "manager"],
                                                categories=category)
         return rbac_groups.exists()
 
-    def has_member_access_to_media(self, media):
-        # First check if user is the owner
-        if media.user == self:
-            return True
-
-        # Then check RBAC permissions
-        if getattr(settings, 'USE_RBAC', False):
-            rbac_groups = RBACGroup.objects.filter(memberships__user=self,
-                                                   memberships__role__in=["member", "contributor", "manager"],
-                                                   categories__in=media.category.all()).distinct()
-            if rbac_groups.exists():
-                return True
-
-        # Then check MediaShare permissions for any access
-        media_permission_exists = MediaPermission.objects.filter(
-            user=self,
-            media=media,
-        ).exists()
+    @cached_property
+    def media_access(self):
+        """MediaAccess of the user, loaded once per User instance
+        (request.user lives for a request)
+        """
+        return MediaAccess(self)
 
-        return media_permission_exists
+    def has_member_access_to_media(self, media):
+        return self.media_access.has_access(media, "member")
 
     def has_contributor_access_to_media(self, media):
-        # First check if user is the owner
-        if media.user == self:
-            return True
-
-        # Then check RBAC permissions
-        if getattr(settings, 'USE_RBAC', False):
-            rbac_groups = RBACGroup.objects.filter(memberships__user=self,
-                                                   memberships__role__in=["contributor", "manager"],
-                                                   categories__in=media.category.all()).distinct()
-            if rbac_groups.exists():
-                return True
-
-        # Then check MediaShare permissions for editor or owner access
-        media_permission_exists = MediaPermission.objects.filter(
-            user=self,
-            media=media,
-            permission__in=["editor", "owner"],
-        ).exists()
-
-        return media_permission_exists
+        return self.media_access.has_access(media, "contributor")
 
     def has_owner_access_to_media(self, media):
-        # First check if user is the owner
-        if media.user == self:
-            return True
-
-        # Then check RBAC permissions
-        if getattr(settings, 'USE_RBAC', False):
-            rbac_groups = RBACGroup.objects.filter(memberships__user=self, memberships__role__in=["manager"],
-                                                   categories__in=media.category.all()).distinct()
-            if rbac_groups.exists():
-                return True
-
-        # Then check MediaShare permissions for owner access
-        media_permission_exists = MediaPermission.objects.filter(
-            user=self,
-            media=media,
-            permission="owner",
-        ).exists()
-
-        return media_permission_exists
+        return self.media_access.has_access(media, "owner")
 
     def get_rbac_categories_as_contributor(self):
         """
         Get all categories related to RBAC groups the user belongs to
         """
+        RBACGroup = helpers.get_rbac_model("RBACGroup")
+        if RBACGroup is None:
+            return Category.objects.none()
         rbac_groups = RBACGroup.objects.filter(memberships__user=self, memberships__role__in=["contributor", "manager"])
         categories = Category.objects.filter(rbac_groups__in=rbac_groups).distinct()
         return categories
@@ -240,6 +206,84 @@ class User(AbstractUser):
         return True
 
 
+class MediaAccess:
+    """Answers member/contributor/owner access of a user to media from memory
+
+    Owners are answered without queries. The RBAC categories of the user
+    and its MediaPermissions are loaded on first need, and cached for
+    MEDIA_ACCESS_CACHE_TIMEOUT under the user's media access version, which
+    is bumped when shares or memberships change
+    """
+
+    # RBAC roles and MediaPermission permissions that grant each level
+    RBAC_ROLES = {
+        "member": ("member", "contributor", "manager"),
+        "contributor": ("contributor", "manager"),
+        "owner": ("manager",),
+    }
+    PERMISSIONS = {
+        "member": ("viewer", "editor", "owner"),
+        "contributor": ("editor", "owner"),
+        "owner": ("owner",),
+    }
+
+    def __init__(self, user):
+        self.user = user
+
+    @cached_property
+    def _data(self):
+        from apps.files.methods import get_media_access_version
+
+        key = f"media_access:{self.user.id}:{get_media_access_version(self.user)}"
+        data = cache.get(key)
+        if data is None:
+            categories = {}
+            # no RBAC when it is disabled or the rbac app is not installed
+            if helpers.get_rbac_model("RBACGroup") is not None:
+                for level, roles in self.RBAC_ROLES.items():
+                    rbac_categories = Category.objects.filter(rbac_groups__memberships__user=self.user, rbac_groups__memberships__role__in=roles)
+                    categories[level] = set(rbac_categories.values_list("id", flat=True))
+            permissions = dict(MediaPermission.objects.filter(user=self.user).values_list("media_id", "permission"))
+            data = (categories, permissions)
+            cache.set(key, data, settings.MEDIA_ACCESS_CACHE_TIMEOUT)
+        return data
+
+    @property
+    def categories(self):
+        return self._data[0]
+
+    @property
+    def permissions(self):
+        return self._data[1]
+
+    def _category_ids(self, media):
+        # uses the prefetched categories, if any
+        return {category.id for category in media.category.all()}
+
+    def has_access(self, media, level, category_ids=None):
+        """Whether the user has `level` (member, contributor or owner) access to media"""
+
+        if media.user_id == self.user.id:
+            return True
+        if self.permissions.get(media.id) in self.PERMISSIONS[level]:
+            return True
+        rbac_categories = self.categories.get(level)
+        if not rbac_categories:
+            return False
+        if category_ids is None:
+            category_ids = self._category_ids(media)
+        return not rbac_categories.isdisjoint(category_ids)
+
+    def has_access_bulk(self, media_list, level):
+        """Return {media id: access} for a list of media, with one query for their categories"""
+
+        category_ids = {media.id: set() for media in media_list if media.user_id != self.user.id}
+        if category_ids and self.categories.get(level):
+            for media_id, category_id in Media.category.through.objects.filter(media_id__in=list(category_ids)).values_list("media_id", "category_id"):
+                category_ids[media_id].add(category_id)
+        return {media.id: self.has_access(media, level, category_ids.get(media.id)) for media in media_list}
+
+
 class Channel(models.Model):
     title = models.CharField(max_length=90, db_index=True)
     description = models.TextField(blank=True, help_text="description")
@@ -335,7 +379,9 @@ class MediaAction(models.Model):
     extra_info = models.TextField(blank=True, null=True)
 
     media = models.ForeignKey(Media, on_delete=models.CASCADE, related_name="mediaactions")
-    action_date = models.DateTimeField(auto_now_add=True)
+    # not auto_now_add, so that watch actions saved in batches keep
+    # the time they happened, see apps.files.counters
+    action_date = models.DateTimeField(default=timezone.now, editable=False)
     remote_ip = models.CharField(max_length=40, blank=True, null=True)
 
     def save(self, *args, **kwargs):
@@ -348,4 +394,6 @@ class MediaAction(models.Model):
         indexes = [
             models.Index(fields=["user", "action", "-action_date"]),
             models.Index(fields=["session_key", "action"]),
+            # popular media aggregation, per action over a period
+            models.Index(fields=["action", "action_date", "media"]),
         ]
@@ -1,7 +1,9 @@
 from django.conf import settings
 from django.core.mail import EmailMessage
-from django.db.models.signals import post_save, post_delete
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.dispatch import receiver
+from apps.files import helpers
+from apps.files.methods import bump_media_access_version
 from apps.files.models import Category, Media, MediaPermission, Tag
 
 # Import your Channel and User models
@@ -35,3 +37,28 @@ def delete_content(sender, instance, **kwargs):
     Media.objects.filter(user=instance).delete()
     Tag.objects.filter(user=instance).delete()
     Category.objects.filter(user=instance).delete()
+
+
+def rbac_membership_change(sender, instance, **kwargs):
+    """Memberships change the media a user has access to"""
+
+    bump_media_access_version(instance.user)
+
+
+def rbac_group_categories_change(sender, instance, action, **kwargs):
+    """Categories of a group change the media of all its members"""
+
+    if action in ("post_add", "post_remove", "post_clear"):
+        bump_media_access_version()
+
+
+def connect_rbac_signals():
+    """Connected on ready, when the rbac app is installed"""
+
+    RBACMembership = helpers.get_rbac_model("RBACMembership")
+    if RBACMembership is not None:
+        post_save.connect(rbac_membership_change, sender=RBACMembership, dispatch_uid="rbac_membership_save")
+        post_delete.connect(rbac_membership_change, sender=RBACMembership, dispatch_uid="rbac_membership_delete")
+    RBACGroup = helpers.get_rbac_model("RBACGroup")
+    if RBACGroup is not None:
+        m2m_changed.connect(rbac_group_categories_change, sender=RBACGroup.categories.through, dispatch_uid="rbac_group_categories")
@@ -61,6 +61,8 @@ VIDEO_REQUEST_TIMEOUT = float(e('VIDEO_REQUEST_TIMEOUT', 1))
 
 # Processing segment duration
 VIDEO_CHUNK_DURATION = int(e('VIDEO_CHUNK_DURATION', 60))
+# Number of segments transcoded at the same time
+VIDEO_SEGMENT_WORKERS = int(e('VIDEO_SEGMENT_WORKERS', 1))
 
 VIDEO_MODEL = 'video_transcoding.Video'
 
@@ -1,8 +1,9 @@
 import abc
 import json
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import replace, asdict
 from types import TracebackType
-from typing import Type, List, Optional
+from typing import Type, List, Optional, Iterator
 
 from apps.video_transcoding_off import defaults
 from apps.video_transcoding_off.transcoding import (
@@ -94,8 +95,8 @@ class ResumableStrategy(Strategy):
     Transcoding strategy implementation with resume support.
 
     Source file is downloaded to temporary shared webdav directory,
-    split to chunks. Chunks are transcoded on by one and merged to a
-    single file at the end. Resulting file is segmented to HLS on
+    split to chunks. Chunks are transcoded in parallel (see
+    VIDEO_SEGMENT_WORKERS) and merged to a single file at the end. Resulting file is segmented to HLS on
     a result storage.
     """
 
@@ -208,8 +209,7 @@ class ResumableStrategy(Strategy):
         segments = self.get_segment_list()
 
         result_meta: Optional[metadata.Metadata] = None
-        for fn in segments:
-            segment_meta = self.process_segment(fn)
+        for segment_meta in self.process_segments(segments):
             result_meta = self.merge_metadata(result_meta, segment_meta)
         if result_meta is None:  # pragma: no cover
             raise RuntimeError("no segments")
@@ -361,6 +361,24 @@ class ResumableStrategy(Strategy):
             segments.append(line)
         return segments
 
+    def process_segments(self, segments: List[str]) -> Iterator[metadata.Metadata]:
+        """
+        Transcodes source chunks, up to VIDEO_SEGMENT_WORKERS at a time.
+
+        Each chunk is transcoded by its own ffmpeg process, so segments
+        are handled by threads. Already transcoded chunks are skipped by
+        process_segment, so an interrupted run resumes where it stopped.
+        :param segments: list of chunk filenames.
+        :return: resulting chunks metadata, in segment order.
+        """
+        workers = min(defaults.VIDEO_SEGMENT_WORKERS, len(segments))
+        if workers <= 1:
+            for fn in segments:
+                yield self.process_segment(fn)
+            return
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            yield from executor.map(self.process_segment, segments)
+
     def process_segment(self, filename: str) -> metadata.Metadata:
         """
         Transcodes source chunk to a resulting chunk if not yed transcoded.
@@ -133,6 +133,23 @@ class ResumableStrategyTestCase(base.ProfileMixin, base.MetadataMixin, TestCase)
         merge.assert_called_once_with(["s1", "s2"], meta=mock.sentinel.m2_rv)
         self.assertEqual(result, mock.sentinel.merge_rv)
 
+    def test_process_segments_parallel(self):
+        segments = [f"s{i}" for i in range(5)]
+        with (
+            mock.patch.object(defaults, "VIDEO_SEGMENT_WORKERS", 3),
+            mock.patch.object(
+                self.strategy,
+                "process_segment",
+                side_effect=lambda fn: getattr(mock.sentinel, fn),
+            ) as process_segment,
+        ):
+            result = list(self.strategy.process_segments(segments))
+
+        self.assertEqual(result, [getattr(mock.sentinel, fn) for fn in segments])
+        self.assertEqual(
+            sorted(c.args[0] for c in process_segment.call_args_list), segments
+        )
+
     def test_merge_metadata(self):
         result_meta = None
         segment_meta = self.make_meta(600.0)
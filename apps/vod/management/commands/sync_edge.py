@@ -1,75 +1,113 @@
-import requests
-from django.core.management.base import BaseCommand
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max
+from django.utils import timezone
 from django.utils.dateparse import parse_datetime
 from django.db import transaction
 
 from vidra_kit.backends.api import EdgewareApi
-from ...models import Edge, Stream, Provider
+from ...models import Edge, Stream
+
+EDGE_FIELDS = ["title", "status", "playable", "content_duration_ms", "creation_time", "modification_time"]
+STREAM_PROTOCOLS = ["hls", "dash", "mss"]
 
 
 class Command(BaseCommand):
-    help = "Sync a single Edge + its Streams from API JSON"
-    edge_rows = []
-    stream_rows = []
+    help = "Sync Edges + their Streams from the Edgeware API"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--offset", type=int, default=None, help="API offset to start from, defaults to the number of synced edges")
+        parser.add_argument("--prefetch", action="store_true", help="fetch the next API page while the current one is written")
+        parser.add_argument("--workers", type=int, default=1, help="fetch API pages concurrently, starting from offset 0")
+        parser.add_argument("--since", default=None, help="only sync content modified after this ISO datetime")
+        parser.add_argument("--incremental", action="store_true", help="only sync content modified after the latest synced edge")
 
     def handle(self, *args, **options):
-        offset = Edge.objects.all().count()
+        since = None
+        if options["since"]:
+            since = parse_datetime(options["since"])
+            if since is None:
+                raise CommandError(f"Invalid datetime: {options['since']}")
+            if timezone.is_naive(since):
+                since = timezone.make_aware(since)
+        elif options["incremental"]:
+            since = Edge.objects.aggregate(since=Max("modification_time"))["since"]
+
+        if options["workers"] > 1 or since is not None:
+            # a count of synced edges is no offset into a filtered or
+            # concurrently fetched catalogue
+            edgeware = EdgewareApi(options["offset"] or 0)
+            self.stdout.write(self.style.WARNING(f"Crawling from: {edgeware.OFFSET}, modified since: {since}"))
+            for data in edgeware.crawl(workers=options["workers"], modified_since=since):
+                self.sync_page(data)
+            return
+
+        offset = options["offset"]
+        if offset is None:
+            offset = Edge.objects.all().count()
         edgeware = EdgewareApi(offset)
 
-        while edgeware.has_next_page:
+        if not options["prefetch"]:
+            while edgeware.has_next_page:
+                self.stdout.write(self.style.WARNING(f"Fetching: {edgeware.OFFSET}"))
+                self.sync_page(edgeware.next_page())
+            return
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
             self.stdout.write(self.style.WARNING(f"Fetching: {edgeware.OFFSET}"))
+            page = executor.submit(edgeware.next_page)
+            while page is not None:
+                data = page.result()
+                page = None
+                if edgeware.has_next_page:
+                    self.stdout.write(self.style.WARNING(f"Fetching: {edgeware.OFFSET}"))
+                    page = executor.submit(edgeware.next_page)
+                self.sync_page(data)
+
+    def sync_page(self, data):
+        """Upsert the edges of an API page and their streams"""
 
-            data = edgeware.next_page()
-            for row in data:
-                self.add_row(row)
-
-            Edge.objects.bulk_create(
-                self.edge_rows,
-            )
-            Stream.objects.bulk_create(
-                self.stream_rows,
-            )
-            self.edge_rows.clear()
-            self.stream_rows.clear()
-
-    def add_row(self, raw):
-
-        # ---------------------------
-        # MAP API → Edge model fields
-        # ---------------------------
-        edge_data = {
-            "content_id": raw["content_id"],
+        rows = {raw["content_id"]: raw for raw in data if raw.get("content_id")}
+        # one query for the whole page, unchanged edges are not written again
+        existing = dict(Edge.objects.filter(content_id__in=list(rows)).values_list("content_id", "modification_time"))
+
+        edges = []
+        streams = []
+        for content_id, raw in rows.items():
+            edge = Edge(content_id=content_id, **self.edge_data(raw))
+            # without a modification time there is no telling, it is synced
+            if edge.modification_time is not None and content_id in existing and existing[content_id] == edge.modification_time:
+                continue
+            edges.append(edge)
+            for protocol, uri in raw.get("delivery_uris", {}).items():
+                if protocol not in STREAM_PROTOCOLS:
+                    continue  # ignore unrecognized protocols
+                streams.append(Stream(edge=edge, stream_protocol=protocol, uri=uri))
+
+        if not edges:
+            self.stdout.write(self.style.WARNING(f"Skipping: {len(rows)} unchanged"))
+            return 0
+
+        with transaction.atomic():
+            # pks are set on the edges (also for updated ones), so the
+            # streams can reference them
+            Edge.objects.bulk_create(edges, update_conflicts=True, unique_fields=["content_id"], update_fields=EDGE_FIELDS)
+            Stream.objects.bulk_create(streams, update_conflicts=True, unique_fields=["edge", "stream_protocol"], update_fields=["uri"])
+        self.stdout.write(self.style.SUCCESS(f"Synced: {len(edges)} edges, {len(streams)} streams"))
+        return len(edges)
+
+    def edge_data(self, raw):
+        """Map API → Edge model fields"""
+
+        return {
             "title": raw.get("title"),
             "status": raw.get("state"),  # maps to Edge.Status
             "playable": raw.get("playable", False),
             "content_duration_ms": self._get_duration(raw),
-            "creation_time": parse_datetime(raw.get("creation_time")),
-            "modification_time": parse_datetime(raw.get("modification_time")),
+            "creation_time": parse_datetime(raw.get("creation_time") or ""),
+            "modification_time": parse_datetime(raw.get("modification_time") or ""),
         }
-        content = raw.get("content_id")
-        if Edge.objects.filter(content_id=content).exists():
-            self.stdout.write(self.style.WARNING(f"Skipping: {content}"))
-            return
-
-        # ---------------------------
-        # UPSERT Edge
-        # ---------------------------
-        edge = Edge(
-            **edge_data,
-        )
-        self.edge_rows.append(edge)
-
-        # ---------------------------
-        # UPSERT Stream children
-        # ---------------------------
-        delivery = raw.get("delivery_uris", {})
-
-        for protocol, uri in delivery.items():
-            if protocol not in ["hls", "dash", "mss"]:
-                continue  # ignore unrecognized protocols
-
-            stream = Stream(edge=edge, stream_protocol=protocol, uri=uri)
-            self.stream_rows.append(stream)
 
     def _get_duration(self, raw) -> int | None:
         try:
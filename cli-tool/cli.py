@@ -1,10 +1,18 @@
+import hashlib
 import json
 import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
 from typing import Optional
 
 import requests
 import typer
 from decouple import config
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from rich import print
 from rich.console import Console
 from rich.table import Table
@@ -17,6 +25,16 @@ print("Welcome to the CLI Tool of [bold blue]MediaCMS![/bold blue]", ":thumbs_up
 
 # Global Configuration
 BASE_URL = 'https://demo.mediacms.io/api/v1'
+# chunked uploads, same protocol as the web uploader
+UPLOAD_URL = f"{BASE_URL.rsplit('/api/', 1)[0]}/dashboard/api/upload/"
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_STATE_FILE = '.upload_state.json'
+UPLOAD_POLL_INTERVAL = 5
+# longest wait for the server to combine the parts of an upload
+UPLOAD_COMBINE_TIMEOUT = 2 * 60 * 60
+# checksum of the combined upload, when the server doesn't say
+UPLOAD_CHECKSUM_ALGORITHM = 'md5'
+HASH_BLOCK_SIZE = 1024 * 1024
 AUTH_KEY: str = ''
 USERNAME: str = ''
 EMAIL: str = ''
@@ -93,42 +111,190 @@ def login():
             print(f"An error occurred during login: {e}")
 
 
+def get_session(pool_size: int = 10) -> requests.Session:
+    """Session reusing connections, retrying requests that failed to connect."""
+    session = requests.Session()
+    retry = Retry(total=5, connect=5, read=2, status=5, backoff_factor=1, status_forcelist=(502, 503, 504), allowed_methods=None)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['authorization'] = f'Token {AUTH_KEY}'
+    return session
+
+
+def post_once(session: requests.Session, **kwargs) -> requests.Response:
+    """POST with the session headers but without retries, for requests the server must not see twice."""
+    return requests.post(headers=session.headers, **kwargs)
+
+
+def file_checksum(file_path: str, algorithm: str) -> Optional[str]:
+    """Checksum of a file with a hashlib (or xxhash) algorithm, None if the algorithm is not available here."""
+    if algorithm in hashlib.algorithms_available:
+        hasher = hashlib.new(algorithm)
+    else:
+        try:
+            import xxhash
+
+            hasher = getattr(xxhash, algorithm)()
+        except (ImportError, AttributeError):
+            return None
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+class UploadState:
+    """Parts already uploaded per file, kept in a local json file so an interrupted upload resumes."""
+
+    def __init__(self, path: str = UPLOAD_STATE_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = {}
+        if os.path.exists(path):
+            with open(path, 'r') as file:
+                self.data = json.load(file)
+
+    @staticmethod
+    def key(file_path: str, chunk_size: int) -> str:
+        # a file that changed since the last attempt is uploaded again
+        stat = os.stat(file_path)
+        return f'{file_path}:{stat.st_size}:{stat.st_mtime_ns}:{chunk_size}'
+
+    def get(self, key: str) -> dict:
+        with self.lock:
+            return self.data.setdefault(key, {'uuid': str(uuid.uuid4()), 'parts': []})
+
+    def part_done(self, key: str, part_index: int):
+        with self.lock:
+            self.data[key]['parts'].append(part_index)
+            self._save()
+
+    def remove(self, key: str):
+        with self.lock:
+            self.data.pop(key, None)
+            self._save()
+
+    def _save(self):
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(self.data, file)
+        os.replace(tmp_path, self.path)
+
+
+def upload_file(session: requests.Session, state: UploadState, file_path: str, chunk_size: int, parallel: int) -> Optional[str]:
+    """Upload a file with the chunked upload protocol, returns the media url."""
+    filename = os.path.basename(file_path)
+    total_size = os.path.getsize(file_path)
+    total_parts = max(1, -(-total_size // chunk_size))
+    key = state.key(file_path, chunk_size)
+    upload = state.get(key)
+    fields = {'qquuid': upload['uuid'], 'qqfilename': filename, 'qqtotalparts': total_parts, 'qqtotalfilesize': total_size}
+
+    def upload_part(part_index: int, retry: bool = True):
+        offset = part_index * chunk_size
+        with open(file_path, 'rb') as f:
+            f.seek(offset)
+            chunk = f.read(chunk_size)
+        data = {**fields, 'qqpartindex': part_index, 'qqchunksize': len(chunk), 'qqpartbyteoffset': offset}
+        post = session.post if retry else partial(post_once, session)
+        response = post(url=UPLOAD_URL, data=data, files={'qqfile': (filename, chunk)})
+        response.raise_for_status()
+        return response
+
+    # requests creating the media are not retried, a replay would create it twice
+    if total_parts == 1:
+        # small files are created on the server with their only part
+        response = upload_part(0, retry=False)
+    else:
+        pending = sorted(set(range(total_parts)) - set(upload['parts']))
+        if len(pending) < total_parts:
+            print(f'Resuming [bold blue]{filename}[/bold blue], {total_parts - len(pending)}/{total_parts} parts already uploaded')
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            futures = {executor.submit(upload_part, part_index): part_index for part_index in pending}
+            for future in as_completed(futures):
+                future.result()
+                state.part_done(key, futures[future])
+        response = post_once(session, url=UPLOAD_URL, params={'done': ''}, data=fields)
+        response.raise_for_status()
+
+    result = response.json()
+    if response.status_code == 202:
+        # the server combines the parts in the background
+        status_url = f'{UPLOAD_URL}status/{upload["uuid"]}/'
+        deadline = time.monotonic() + UPLOAD_COMBINE_TIMEOUT
+        result = {'success': True, 'state': 'pending'}
+        # an expired or unknown status has no state, and ends the wait as failed states do
+        while result.get('success') and result.get('state') in ('pending', 'combining'):
+            if time.monotonic() > deadline:
+                raise requests.exceptions.Timeout(f'Upload not combined after {UPLOAD_COMBINE_TIMEOUT} seconds')
+            time.sleep(UPLOAD_POLL_INTERVAL)
+            response = session.get(url=status_url)
+            response.raise_for_status()
+            result = response.json()
+        if result.get('state') != 'done':
+            result = {'success': False, 'error': result.get('error', 'Upload failed')}
+    if not result.get('success'):
+        raise requests.exceptions.RequestException(result.get('error', 'Upload failed'))
+    if result.get('checksum'):
+        algorithm = result.get('checksum_algorithm') or UPLOAD_CHECKSUM_ALGORITHM
+        checksum = file_checksum(file_path, algorithm)
+        if checksum is None:
+            print(f'[bold yellow]Warning:[/bold yellow] cannot verify {filename}, {algorithm} is not available')
+        elif checksum != result['checksum']:
+            # the upload state is kept, the parts were uploaded but not intact
+            raise requests.exceptions.RequestException(f'Checksum mismatch for {filename}: {result["checksum"]} on the server, {checksum} here')
+    state.remove(key)
+    return result.get('media_url')
+
+
 @app.command()
 def upload_media(
-    path: str = typer.Argument(..., help="The path to the file or directory containing files to upload.")
+    path: str = typer.Argument(..., help="The path to the file or directory containing files to upload."),
+    chunk_size: int = typer.Option(UPLOAD_CHUNK_SIZE, help="Size of each uploaded part, in bytes."),
+    parallel: int = typer.Option(4, help="Parts of a file uploaded concurrently."),
+    jobs: int = typer.Option(2, help="Files uploaded concurrently in directory mode."),
 ):
     """⬆️ Upload media to the server."""
     if not AUTH_KEY:
         print("[bold red]Error:[/bold red] You must be logged in. Run 'login' first.")
         raise typer.Exit(code=1)
 
-    headers = {'authorization': f'Token {AUTH_KEY}'}
+    session = get_session(pool_size=parallel * jobs)
+    state = UploadState()
 
     def process_upload(file_path, filename):
         """Helper function to perform the actual file upload."""
         try:
-            with open(file_path, 'rb') as f:
-                files = {'media_file': f}
-                response = requests.post(url=f'{BASE_URL}/media', headers=headers, files=files)
-                response.raise_for_status()
-
-            print(f"[bold blue]{filename}[/bold blue] successfully uploaded!")
+            media_url = upload_file(session, state, file_path, chunk_size, parallel)
+            print(f"[bold blue]{filename}[/bold blue] successfully uploaded! {media_url or ''}")
         except FileNotFoundError:
             print(f"[bold red]Error:[/bold red] File not found at {file_path}")
         except requests.exceptions.RequestException as e:
-            print(f'[bold red]Error uploading {filename}:[/bold red] {response.text if "response" in locals() else e}')
+            response = getattr(e, 'response', None)
+            print(f'[bold red]Error uploading {filename}:[/bold red] {response.text if response is not None else e}')
 
     abs_path = os.path.abspath(path)
 
     if os.path.isdir(abs_path):
         # Handle directory upload
         print(f"Uploading files from directory: [bold yellow]{abs_path}[/bold yellow]")
-        for filename in os.listdir(abs_path):
-            file_path = os.path.join(abs_path, filename)
-            if os.path.isfile(file_path):
-                process_upload(file_path, filename)
-            else:
-                print(f"Skipping directory/non-file: {filename}")
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {}
+            for filename in sorted(os.listdir(abs_path)):
+                file_path = os.path.join(abs_path, filename)
+                if os.path.isfile(file_path):
+                    futures[executor.submit(process_upload, file_path, filename)] = filename
+                else:
+                    print(f"Skipping directory/non-file: {filename}")
+            failed = 0
+            for future in as_completed(futures):
+                error = future.exception()
+                if error is not None:
+                    failed += 1
+                    print(f'[bold red]Error uploading {futures[future]}:[/bold red] {error!r}')
+        if failed:
+            raise typer.Exit(code=1)
     elif os.path.isfile(abs_path):
         # Handle single file upload
         filename = os.path.basename(abs_path)
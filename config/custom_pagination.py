@@ -1,9 +1,15 @@
+import json
+from base64 import b64decode, b64encode
 from collections import OrderedDict  # requires Python 2.7 or later
 
 from django.core.paginator import Paginator
+from django.db.models import F, Q
 from django.utils.functional import cached_property
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
 
 
 class FasterDjangoPaginator(Paginator):
@@ -27,3 +33,105 @@ class FastPaginationWithoutCount(PageNumberPagination):
                 ]
             )
         )
+
+
+class MediaCursorPagination(BasePagination):
+    """Keyset pagination on the sort field plus id, for infinite
+    scroll clients. No SELECT COUNT, and any page costs the same
+
+    The cursor holds the sort value and id of the last (or, going back,
+    first) media of a page, and the next page starts right after that
+    (sort, id) pair, so ties on the sort field page correctly. Media
+    without a sort value (add_date is nullable) come last either way.
+    """
+
+    cursor_query_param = "cursor"
+    invalid_cursor_message = "Invalid cursor"
+
+    def __init__(self, sort_by="add_date", ordering="-"):
+        self.sort_by = sort_by
+        self.descending = ordering == "-"
+        self.page_size = api_settings.PAGE_SIZE
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.base_url = request.build_absolute_uri()
+        cursor = self.decode_cursor(request)
+        reverse = bool(cursor and cursor["reverse"])
+
+        queryset = queryset.order_by(*self.get_ordering(reverse))
+        if cursor is not None:
+            queryset = queryset.filter(self.get_seek_filter(cursor["value"], cursor["id"], reverse))
+
+        results = list(queryset[: self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[: self.page_size]
+        if reverse:
+            results.reverse()
+
+        # a page reached through a cursor has media on the side it came from
+        self.has_next = has_more if not reverse else True
+        self.has_previous = has_more if reverse else cursor is not None
+        self.page = results
+        return results
+
+    def get_ordering(self, reverse):
+        # nulls stay last going forward, so they come first going back
+        descending = self.descending != reverse
+        field = F(self.sort_by).desc(nulls_last=not reverse) if descending else F(self.sort_by).asc(nulls_first=reverse)
+        return (field, "-id" if descending else "id")
+
+    def get_seek_filter(self, value, media_id, reverse):
+        """Media after (value, media_id) in the order of the page"""
+
+        lookup = "lt" if self.descending != reverse else "gt"
+        after_id = Q(**{f"id__{lookup}": media_id})
+        if value is None:
+            if reverse:
+                return Q(**{f"{self.sort_by}__isnull": False}) | Q(after_id, **{f"{self.sort_by}__isnull": True})
+            return Q(after_id, **{f"{self.sort_by}__isnull": True})
+
+        seek = Q(**{f"{self.sort_by}__{lookup}": value}) | Q(after_id, **{self.sort_by: value})
+        if not reverse:
+            seek |= Q(**{f"{self.sort_by}__isnull": True})
+        return seek
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def encode_cursor(self, media, reverse):
+        value = getattr(media, self.sort_by)
+        if hasattr(value, "isoformat"):
+            value = value.isoformat()
+        data = {"v": value, "id": media.id}
+        if reverse:
+            data["r"] = 1
+        encoded = b64encode(json.dumps(data).encode("utf-8")).decode("ascii")
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            data = json.loads(b64decode(encoded.encode("ascii")).decode("utf-8"))
+            return {"value": data["v"], "id": int(data["id"]), "reverse": bool(data.get("r"))}
+        except (TypeError, ValueError, KeyError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def get_paginated_response(self, data):
+        return Response(
+            OrderedDict(
+                [
+                    ("next", self.get_next_link()),
+                    ("previous", self.get_previous_link()),
+                    ("results", data),
+                ]
+            )
+        )
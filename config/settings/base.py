@@ -41,6 +41,7 @@ INSTALLED_APPS = [
     "django.contrib.messages",
     "django.contrib.staticfiles",
     "django.contrib.humanize",
+    "django.contrib.postgres",
     # "jazzmin",
     "django.contrib.admin",
     "django.contrib.sites",
@@ -248,7 +249,15 @@ CELERY_BEAT_SCHEDULE = {
     },
     "get_list_of_popular_media": {
         "task": "get_list_of_popular_media",
-        "schedule": crontab(minute=1, hour="*/10"),
+        "schedule": crontab(minute=1),
+    },
+    "flush_media_counters": {
+        "task": "flush_media_counters",
+        "schedule": crontab(minute="*"),
+    },
+    "rebuild_media_title_index": {
+        "task": "rebuild_media_title_index",
+        "schedule": crontab(hour=3, minute=5),
     },
     "update_listings_thumbnails": {
         "task": "update_listings_thumbnails",
@@ -366,6 +375,30 @@ MINIMUM_RESOLUTIONS_TO_ENCODE = [360, 480]
 CHUNKIZE_VIDEO_DURATION = 60 * 5
 VIDEO_CHUNKS_DURATION = 60 * 4
 RUNNING_STATE_STALE = 60 * 60 * 2
+# checksum for originals and chunks: "md5" or "xxhash" (needs the xxhash package,
+# remote workers verifying original_media_md5sum must use the same algorithm)
+CHECKSUM_ALGORITHM = "md5"
+CHECKSUM_WORKERS = 4
+# keep media views/likes/dislikes in redis and flush them every minute,
+# instead of a database write per action
+MEDIA_COUNTERS_WRITE_BEHIND = True
+# answer search title suggestions from a redis prefix index of listable
+# media titles (apps.files.suggestions), rebuilt daily
+MEDIA_TITLE_INDEX = True
+# seconds to wait for more saves of a media, before updating the media
+# counts of its user/categories/tags and its search vector
+MEDIA_SAVE_DEBOUNCE = 10
+# seconds that media listings are cached for anonymous users, cached
+# listings are also invalidated when listable media change
+MEDIA_LIST_CACHE_TIMEOUT = 60 * 5
+# seconds that the media shared with a user (permissions, RBAC categories)
+# are cached, they are also invalidated when shares or categories change
+MEDIA_ACCESS_CACHE_TIMEOUT = 60 * 10
+# encode all resolutions of a codec with a single ffmpeg process (crf only),
+# instead of a process per EncodeProfile
+ENCODE_LADDER = False
+# seconds between encoding progress updates, published to the cache
+ENCODING_PROGRESS_INTERVAL = 5
 FRIENDLY_TOKEN_LEN = 9
 
 UPLOAD_DIR = "uploads/"
@@ -373,6 +406,9 @@ CHUNKS_DIR = "chunks/"
 UPLOAD_MAX_FILES_NUMBER = 100
 CONCURRENT_UPLOADS = True
 FILE_STORAGE = "django.core.files.storage.FileSystemStorage"
+# combine the chunks of large uploads in a celery task, the client polls
+# dashboard:upload_status until the media is created
+UPLOAD_COMBINE_IN_BACKGROUND = False
 
 # =============================================================================
 # THIRD-PARTY CONFIG
@@ -0,0 +1,72 @@
+from django.core.cache import cache
+from django.core.files import File
+from django.test import Client, TestCase
+
+from apps.files.methods import MEDIA_LIST_VERSION_KEY
+from apps.files.models import Category, Media, Playlist, PlaylistMedia, Tag
+from apps.users.models import User
+
+
+class TestMediaBulkActions(TestCase):
+    fixtures = ["fixtures/categories.json", "fixtures/encoding_profiles.json"]
+
+    def setUp(self):
+        self.client = Client()
+        self.password = 'this_is_a_fake_password'
+        self.user = User.objects.create_user(username="bulk_user", password=self.password)
+        self.client.login(username=self.user.username, password=self.password)
+        self.media = []
+        for i in range(3):
+            with open('fixtures/test_image2.jpg', "rb") as f:
+                self.media.append(Media.objects.create(title=f"Bulk Media {i}", user=self.user, media_file=File(f)))
+        self.tokens = [media.friendly_token for media in self.media]
+
+    def post(self, **data):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/v1/media/user/bulk_actions/', data=data, content_type="application/json")
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data
+
+    def test_category_counts_and_listing_version(self):
+        category = Category.objects.first()
+        self.media[0].category.add(category)
+        version = cache.get(MEDIA_LIST_VERSION_KEY)
+
+        data = self.post(media_ids=self.tokens, action="add_to_category", category_uids=[category.uid])
+        self.assertEqual(data["detail"], "Added 2 media items to 1 categories", "Existing relations should not be counted")
+        category.refresh_from_db()
+        self.assertEqual(category.media_count, 3)
+        self.assertNotEqual(cache.get(MEDIA_LIST_VERSION_KEY), version, "Cached listings should be invalidated")
+
+        data = self.post(media_ids=self.tokens[:2], action="remove_from_category", category_uids=[category.uid])
+        self.assertEqual(data["detail"], "Removed 2 media items from 1 categories")
+        category.refresh_from_db()
+        self.assertEqual(category.media_count, 1)
+
+    def test_tags(self):
+        tag = Tag.objects.create(title="bulk", user=self.user)
+
+        data = self.post(media_ids=self.tokens, action="add_tags", tag_titles=["bulk"])
+        self.assertEqual(data["detail"], "Added 3 media items to 1 tags")
+        tag.refresh_from_db()
+        self.assertEqual(tag.media_count, 3)
+
+        data = self.post(media_ids=self.tokens, action="add_tags", tag_titles=["bulk"])
+        self.assertEqual(data["detail"], "Added 0 media items to 1 tags")
+
+    def test_add_to_playlist(self):
+        playlist = Playlist.objects.create(title="Bulk Playlist", user=self.user)
+        PlaylistMedia.objects.create(playlist=playlist, media=self.media[0], ordering=1)
+
+        data = self.post(media_ids=self.tokens, action="add_to_playlist", playlist_ids=[playlist.id])
+        self.assertEqual(data["detail"], "Added 2 media items to 1 playlists")
+        playlist_media = PlaylistMedia.objects.filter(playlist=playlist)
+        self.assertEqual(set(playlist_media.values_list("media_id", flat=True)), {media.id for media in self.media})
+        self.assertEqual(sorted(playlist_media.values_list("ordering", flat=True)), [1, 2, 3], "New media should be appended")
+
+    def test_change_owner(self):
+        new_owner = User.objects.create_user(username="bulk_new_owner", password=self.password)
+
+        data = self.post(media_ids=self.tokens, action="change_owner", owner=new_owner.username)
+        self.assertEqual(data["detail"], "Owner changed for 3 media items")
+        self.assertEqual(Media.objects.filter(user=new_owner).count(), 3)
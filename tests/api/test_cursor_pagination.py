@@ -0,0 +1,60 @@
+from django.core.files import File
+from django.test import Client, TestCase
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from apps.files.models import Media
+from apps.users.models import User
+from config.custom_pagination import MediaCursorPagination
+
+
+class TestMediaCursorPagination(TestCase):
+    fixtures = ["fixtures/categories.json", "fixtures/encoding_profiles.json"]
+
+    def setUp(self):
+        self.factory = APIRequestFactory()
+        self.user = User.objects.create_user(username="cursor_user", password="this_is_a_fake_password")
+        for i in range(7):
+            with open('fixtures/test_image2.jpg', "rb") as f:
+                Media.objects.create(title=f"Media {i}", user=self.user, media_file=File(f))
+        # ties on the sort field, as for media that were never viewed
+        Media.objects.update(views=0)
+        Media.objects.filter(title="Media 3").update(views=5)
+
+    def paginate(self, url):
+        paginator = MediaCursorPagination("views", "-")
+        paginator.page_size = 3
+        page = paginator.paginate_queryset(Media.objects.all(), Request(self.factory.get(url)))
+        return paginator, [media.id for media in page]
+
+    def test_pages_through_ties(self):
+        expected = list(Media.objects.order_by("-views", "-id").values_list("id", flat=True))
+
+        pages = []
+        url = "/api/v1/media?pagination=cursor"
+        while url:
+            paginator, ids = self.paginate(url)
+            pages.append(ids)
+            url = paginator.get_next_link()
+
+        self.assertEqual([len(ids) for ids in pages], [3, 3, 1])
+        self.assertEqual(sum(pages, []), expected, "Pages should follow (views, id) without gaps or repeats")
+
+        # back from the last page
+        paginator, ids = self.paginate(paginator.get_previous_link())
+        self.assertEqual(ids, pages[1], "Previous link should return the previous page")
+        paginator, ids = self.paginate(paginator.get_previous_link())
+        self.assertEqual(ids, pages[0])
+        self.assertIsNone(paginator.get_previous_link(), "First page should have no previous link")
+
+    def test_invalid_cursor(self):
+        response = Client().get("/api/v1/media?pagination=cursor&cursor=not-a-cursor")
+        self.assertEqual(response.status_code, 404, "Invalid cursors should return 404")
+
+    def test_search_cursor_requires_sort_by(self):
+        client = Client()
+        response = client.get("/api/v1/search?q=media&pagination=cursor")
+        self.assertEqual(response.status_code, 400, "Relevance ranked search has no cursor")
+
+        response = client.get("/api/v1/search?q=media&pagination=cursor&sort_by=views")
+        self.assertEqual(response.status_code, 200)
@@ -0,0 +1,52 @@
+import array
+import hashlib
+import os
+import tempfile
+
+from django.test import TestCase
+
+from apps.files.helpers import checksum_files, file_checksum, file_signature, get_stream_duration, keyframe_before, keyframe_index_path, load_keyframe_index
+
+
+class TestMediaProbeHelpers(TestCase):
+    """Test the helpers used by media_file_info"""
+
+    def test_stream_duration_fallbacks(self):
+        self.assertEqual(get_stream_duration({"duration": "12.5"}, {}), 12.5)
+        self.assertEqual(get_stream_duration({"tags": {"DURATION": "00:01:02.500000000"}}, {}), 62.5)
+        self.assertEqual(get_stream_duration({}, {"duration": "30.0"}), 30.0)
+        self.assertIsNone(get_stream_duration({}, {}))
+
+    def test_file_checksum_and_signature(self):
+        content = os.urandom(3 * 1024 * 1024 + 17)
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(content)
+        try:
+            self.assertEqual(file_checksum(f.name, algorithm="md5", block_size=1024 * 1024), hashlib.md5(content).hexdigest())
+            self.assertEqual(checksum_files([f.name, "/nonexistent"], algorithm="md5"), {f.name: hashlib.md5(content).hexdigest(), "/nonexistent": ""})
+            signature = file_signature(f.name)
+            self.assertEqual(signature, file_signature(f.name))
+            with open(f.name, "ab") as fa:
+                fa.write(b"x")
+            self.assertNotEqual(signature, file_signature(f.name))
+        finally:
+            os.remove(f.name)
+
+    def test_keyframe_index(self):
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(b"media")
+        index_file = keyframe_index_path(f.name)
+        try:
+            self.assertIsNone(keyframe_before(f.name, 5))
+            with open(index_file, "wb") as fi:
+                array.array("q", [3]).tofile(fi)
+                array.array("d", [0.0, 4.0, 8.0]).tofile(fi)
+                array.array("q", [48, 1000, 2000]).tofile(fi)
+            timestamps, offsets = load_keyframe_index(f.name)
+            self.assertEqual(list(offsets), [48, 1000, 2000])
+            self.assertEqual(keyframe_before(f.name, 5), 4.0)
+            self.assertEqual(keyframe_before(f.name, 8), 8.0)
+            self.assertEqual(keyframe_before(f.name, 0.5), 0.0)
+        finally:
+            os.remove(f.name)
+            os.remove(index_file)
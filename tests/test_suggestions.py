@@ -0,0 +1,47 @@
+from datetime import timedelta
+
+from django.core.files import File
+from django.test import TestCase
+
+from apps.files import suggestions
+from apps.files.models import Media
+from apps.users.models import User
+
+
+class TestTitleSuggestions(TestCase):
+    fixtures = ["fixtures/categories.json", "fixtures/encoding_profiles.json"]
+
+    def setUp(self):
+        if suggestions.get_connection() is None:
+            self.skipTest("the title index needs a redis cache")
+
+        user = User.objects.create_user(username="titles_user", password="this_is_a_fake_password")
+        for title, listable in [("Python Tutorial", True), ("Advanced Python", True), ("Private Python", False), ("Django Framework", True)]:
+            with open('fixtures/test_image2.jpg', "rb") as f:
+                Media.objects.create(title=title, user=user, media_file=File(f))
+            Media.objects.filter(title=title).update(listable=listable)
+        self.addCleanup(suggestions.get_connection().delete, suggestions.TITLES_KEY, suggestions.MEMBERS_KEY, suggestions.TITLES_BUILT_KEY)
+        suggestions.rebuild()
+
+    def titles(self, query):
+        return sorted(entry["title"] for entry in suggestions.suggest_titles(query))
+
+    def test_prefix_of_any_word(self):
+        self.assertEqual(self.titles("pyth"), ["Advanced Python", "Python Tutorial"], "Non listable titles should not be suggested")
+        self.assertEqual(self.titles("Django"), ["Django Framework"])
+
+    def test_newest_first(self):
+        media = Media.objects.get(title="Python Tutorial")
+        media.add_date = Media.objects.get(title="Advanced Python").add_date + timedelta(days=1)
+        suggestions.index_media(media)
+        self.assertEqual([entry["title"] for entry in suggestions.suggest_titles("python")], ["Python Tutorial", "Advanced Python"])
+
+    def test_index_updates(self):
+        media = Media.objects.get(title="Django Framework")
+        media.title = "Flask Framework"
+        suggestions.index_media(media)
+        self.assertEqual(self.titles("fla"), ["Flask Framework"])
+        self.assertIsNone(suggestions.suggest_titles("djan"), "No match should fall back to the database")
+
+        suggestions.remove_media(media.id)
+        self.assertIsNone(suggestions.suggest_titles("fram"))
@@ -0,0 +1,49 @@
+from django.core.files import File
+from django.test import TestCase
+
+from apps.files.models import Media, MediaPermission
+from apps.users.models import MediaAccess, User
+
+
+class TestMediaAccess(TestCase):
+    fixtures = ["fixtures/categories.json", "fixtures/encoding_profiles.json"]
+
+    def setUp(self):
+        self.owner = User.objects.create_user(username="media_owner", password="this_is_a_fake_password")
+        self.user = User.objects.create_user(username="media_user", password="this_is_a_fake_password")
+        with open('fixtures/test_image2.jpg', "rb") as f:
+            self.media = Media.objects.create(title="Shared Media", user=self.owner, state="private", media_file=File(f))
+
+    def levels(self, user):
+        access = MediaAccess(user)
+        return [level for level in ("member", "contributor", "owner") if access.has_access(self.media, level)]
+
+    def test_owner_without_queries(self):
+        access = MediaAccess(self.owner)
+        with self.assertNumQueries(0):
+            self.assertTrue(access.has_access(self.media, "owner"))
+
+    def test_permission_levels(self):
+        self.assertEqual(self.levels(self.user), [])
+
+        permission = MediaPermission.objects.create(owner_user=self.owner, user=self.user, media=self.media, permission="viewer")
+        self.assertEqual(self.levels(self.user), ["member"])
+
+        permission.permission = "editor"
+        permission.save()
+        self.assertEqual(self.levels(self.user), ["member", "contributor"])
+
+        permission.permission = "owner"
+        permission.save()
+        self.assertEqual(self.levels(self.user), ["member", "contributor", "owner"])
+
+        permission.delete()
+        self.assertEqual(self.levels(self.user), [], "Removed shares should not be served from cache")
+
+    def test_bulk(self):
+        MediaPermission.objects.create(owner_user=self.owner, user=self.user, media=self.media, permission="viewer")
+        with open('fixtures/test_image2.jpg', "rb") as f:
+            other = Media.objects.create(title="Other Media", user=self.owner, state="private", media_file=File(f))
+
+        access = MediaAccess(self.user)
+        self.assertEqual(access.has_access_bulk([self.media, other], "member"), {self.media.id: True, other.id: False})
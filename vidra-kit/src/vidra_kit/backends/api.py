@@ -1,9 +1,14 @@
 import ftplib
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timezone
 from time import sleep
 from uuid import uuid4
 
+import requests
 from django.conf import settings
+from django.utils.dateparse import parse_datetime
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 
 logger = logging.getLogger(__name__)
@@ -13,18 +18,38 @@ from typing import Optional, Dict, Any
 import uuid
 
 
+def as_utc(value):
+    """Aware UTC datetime, naive datetimes are taken as UTC"""
+    if value.tzinfo is None or value.utcoffset() is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
 class EdgewareAPIError(Exception):
     """Custom exception for Edgeware API errors"""
 
     pass
 
 
+class EdgewareAuthError(EdgewareAPIError):
+    """Invalid API key or forbidden, not retried"""
+
+    pass
+
+
 class EdgewareApi:
     EW_KEY = "wgXfC6EHEAjQt8wvzErgRE"
     EW_API = "http://ew-api.tv.telekom.si:8090/api/2"
     OFFSET = 0
     LIMIT = 1000
     TOTAL = None
+    # connections kept open, also the upper bound of crawl workers
+    POOL_SIZE = 8
+    # failed requests are retried after BACKOFF, 2*BACKOFF, 4*BACKOFF... seconds
+    RETRIES = 3
+    BACKOFF = 1
+    # content filter used by incremental crawls
+    MODIFIED_SINCE_PARAM = "modification_time_from"
 
     def __init__(self, offset=None, content_id: Optional[str] = None) -> None:
         if offset is not None:
@@ -35,23 +60,41 @@ class EdgewareApi:
         self.headers = {"x-account-api-key": self.EW_KEY}
         self.session = requests.Session()
         self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=self.POOL_SIZE, pool_maxsize=self.POOL_SIZE)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
 
-    def _get(
+    def _request(
         self, endpoint: str, params: Optional[Dict[str, Any]] = None
     ) -> Dict[str, Any]:
         url = f"{self.EW_API.rstrip('/')}/{endpoint.lstrip('/')}"
         try:
             response = self.session.get(url, params=params, timeout=30)
             if response.status_code == 401:
-                raise EdgewareAPIError("Unauthorized - invalid API key")
+                raise EdgewareAuthError("Unauthorized - invalid API key")
             if response.status_code == 403:
-                raise EdgewareAPIError("Forbidden")
+                raise EdgewareAuthError("Forbidden")
             if not response.ok:
                 raise EdgewareAPIError(f"HTTP {response.status_code}: {response.text}")
             return response.json()
         except requests.RequestException as e:
             raise EdgewareAPIError(f"Request failed: {e}")
 
+    def _get(
+        self, endpoint: str, params: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        for attempt in range(self.RETRIES + 1):
+            try:
+                return self._request(endpoint, params=params)
+            except EdgewareAuthError:
+                raise
+            except EdgewareAPIError as e:
+                if attempt == self.RETRIES:
+                    raise
+                delay = self.BACKOFF * 2**attempt
+                logger.warning("Edgeware request failed (%s), retrying in %ss", e, delay)
+                sleep(delay)
+
     def check_content(self, content_id: Optional[str] = None) -> Dict[str, Any]:
         """
         Check status of a specific content by ID
@@ -89,6 +132,49 @@ class EdgewareApi:
             return True
         return self.OFFSET < self.TOTAL
 
+    def crawl(self, workers: int = 4, modified_since=None, **filters):
+        """
+        Yield the content pages from OFFSET on. The first page gives the
+        total, the remaining pages are fetched concurrently by up to
+        `workers` threads over the pooled session. Pages are yielded in
+        order and at most 2 * workers of them are held in memory.
+
+        With `modified_since` (datetime) only content modified after it
+        is returned.
+        """
+        workers = max(1, min(workers, self.POOL_SIZE))
+        if modified_since is not None:
+            modified_since = as_utc(modified_since)
+            filters[self.MODIFIED_SINCE_PARAM] = modified_since.isoformat()
+
+        def is_modified(c):
+            # content without a modification time is always returned
+            modification_time = parse_datetime(c.get("modification_time") or "")
+            return modification_time is None or as_utc(modification_time) > modified_since
+
+        def fetch(offset):
+            data = self.list_content_page(limit=self.LIMIT, offset=offset, **filters)
+            content = data.get("content", [])
+            if modified_since is not None:
+                # in case the API ignores the filter
+                content = [c for c in content if is_modified(c)]
+            return data, content
+
+        data, content = fetch(self.OFFSET)
+        self.TOTAL = data.get("total") or 0
+        yield content
+
+        offsets = iter(range(self.OFFSET + self.LIMIT, self.TOTAL, self.LIMIT))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = [executor.submit(fetch, offset) for offset, _ in zip(offsets, range(2 * workers))]
+            while pending:
+                data, content = pending.pop(0).result()
+                offset = next(offsets, None)
+                if offset is not None:
+                    pending.append(executor.submit(fetch, offset))
+                yield content
+        self.OFFSET = max(self.OFFSET, self.TOTAL)
+
 
 class Pager:
     LIMIT = 100
@@ -347,7 +433,6 @@ def fetch_rabbitmq_queues():
         ]
 
 
-import requests
 from typing import List, Dict, Optional, Any
 from dataclasses import dataclass
 import json